@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+import pandas as pd
+from datetime import timedelta
+from config import ANOMALY_CACHE_DIR, ANOMALY_CACHE_MAX_BYTES, ANOMALY_CACHE_TOP_UP, ANOMALY_CACHE_REFRESH_DAYS
+
+
+class AnomalyCache:
+    '''
+    On-disk Parquet cache of anomaly tables, keyed by (project_id, dataset_id, table_id, period).
+
+    Each entry records the table's last-modified time from BigQuery. While that is unchanged the
+    cached rows are served as they are; once the table has been written to, it is read again in full.
+    With top_up, only the rows from refresh_days before the last cached date onwards are read again
+    and spliced in, which is only safe for tables whose older rows are never rewritten.
+    Entries are evicted least recently used first once the cache is over max_bytes.
+    '''
+    def __init__(self, cache_dir=ANOMALY_CACHE_DIR, max_bytes=ANOMALY_CACHE_MAX_BYTES, top_up=ANOMALY_CACHE_TOP_UP, refresh_days=ANOMALY_CACHE_REFRESH_DAYS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.top_up = top_up
+        self.refresh_days = refresh_days
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'top_ups': 0, 'misses': 0, 'bytes_saved': 0}
+
+    def get_paths(self, key):
+        project_id, dataset_id, table_id, period = key
+        path = os.path.join(self.cache_dir, project_id, dataset_id, f'{table_id}.{period}')
+        return f'{path}.parquet', f'{path}.json'
+
+    def load(self, key):
+        data_path, meta_path = self.get_paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            df = pd.read_parquet(data_path)
+        except Exception:
+            return None, None
+
+        return meta, df
+
+    def store(self, key, meta, df):
+        data_path, meta_path = self.get_paths(key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+
+        # write then rename, so concurrent readers never see half a file
+        tmp_path = f'{data_path}.{threading.get_ident()}.tmp'
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, data_path)
+        meta = dict(meta, bytes=os.path.getsize(data_path), last_used=time.time())
+        self.write_meta(meta_path, meta)
+
+        self.evict()
+
+    def write_meta(self, meta_path, meta):
+        tmp_path = f'{meta_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def touch(self, key, meta):
+        _, meta_path = self.get_paths(key)
+        meta['last_used'] = time.time()
+        self.write_meta(meta_path, meta)
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if name.endswith('.json'):
+                        meta_path = os.path.join(root, name)
+                        try:
+                            with open(meta_path) as f:
+                                meta = json.load(f)
+                        except Exception:
+                            continue
+                        entries.append((meta.get('last_used', 0), meta.get('bytes', 0), meta_path))
+
+            total_bytes = sum(entry[1] for entry in entries)
+            for last_used, nbytes, meta_path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                for path in [meta_path, meta_path[:-len('.json')] + '.parquet']:
+                    if os.path.exists(path):
+                        os.remove(path)
+                total_bytes -= nbytes
+
+    def read(self, key, date_col, columns, start_date, modified, fetch):
+        '''
+        Returns the rows of the table from start_date on (every row when None), from the cache where it can.
+        fetch(start_date) reads the rows from start_date on from BigQuery.
+        '''
+        from helper import concat_anomaly_frames
+
+        meta, cached_df = self.load(key)
+
+        covers = (
+            meta is not None
+            and meta['columns'] == columns
+            and (meta['start_date'] is None or (start_date is not None and str(start_date) >= meta['start_date']))
+        )
+
+        if covers and meta['modified'] == modified:
+            self.touch(key, meta)
+            df = self.trim(cached_df, date_col, start_date)
+            with self._lock:
+                self.stats['hits'] += 1
+                self.stats['bytes_saved'] += int(df.memory_usage(deep=True).sum())
+            return df
+
+        if self.top_up and covers and meta['max_date'] is not None:
+            top_up_start = (pd.Timestamp(meta['max_date']) - timedelta(days=self.refresh_days)).date()
+            new_df = fetch(top_up_start)
+            old_df = cached_df[pd.to_datetime(cached_df[date_col]) < pd.Timestamp(top_up_start)]
+            df = concat_anomaly_frames([old_df, new_df])
+            with self._lock:
+                self.stats['top_ups'] += 1
+                self.stats['bytes_saved'] += int(old_df.memory_usage(deep=True).sum())
+            self.store(key, self.get_meta(df, date_col, columns, meta['start_date'], modified), df)
+
+        else:
+            df = fetch(start_date)
+            with self._lock:
+                self.stats['misses'] += 1
+            self.store(key, self.get_meta(df, date_col, columns, start_date, modified), df)
+
+        return self.trim(df, date_col, start_date)
+
+    def trim(self, df, date_col, start_date):
+        if start_date is not None:
+            df = df[pd.to_datetime(df[date_col]) >= pd.Timestamp(start_date)]
+
+        return df.reset_index(drop=True)
+
+    def get_meta(self, df, date_col, columns, start_date, modified):
+        return {
+            'columns': columns,
+            'start_date': None if start_date is None else str(start_date),
+            'max_date': str(pd.to_datetime(df[date_col]).max()) if df.shape[0] > 0 else None,
+            'modified': modified,
+        }
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+_anomaly_cache = None
+_anomaly_cache_lock = threading.Lock()
+
+
+def get_anomaly_cache():
+    global _anomaly_cache
+    with _anomaly_cache_lock:
+        if _anomaly_cache is None:
+            _anomaly_cache = AnomalyCache()
+
+        return _anomaly_cache
+
+
+def print_anomaly_cache_stats():
+    if ANOMALY_CACHE_MAX_BYTES <= 0:
+        return
+
+    stats = get_anomaly_cache().get_stats()
+    print(f"Anomaly cache - hits {stats['hits']} top-ups {stats['top_ups']} misses {stats['misses']} "
+          f"saved {stats['bytes_saved'] / 2 ** 20:.1f} MB")
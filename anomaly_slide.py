@@ -1,25 +1,27 @@
 import numpy as np
-from config import in_production
-from helper import print_formatted, print_delta, fix_name, always_include_data_source, not_none, filter_data_by_kpi
+import pandas as pd
+from io import BytesIO
+from config import in_production, ANOMALY_CHART_MODE
+from helper import print_formatted, print_delta, fix_name, always_include_data_source, not_none, get_kpi_mask
+from helper import get_color_array, get_number_format
 from dates import yesterday, sdlw, get_previous_week_start_date_end_date, timedelta
-from graph import get_graph
+from chart_renderer import get_chart_renderer
 from pptx.enum.shapes import MSO_SHAPE
 from pptx.util import Inches, Cm, Pt
 from pptx.enum.text import PP_ALIGN, MSO_ANCHOR
 from pptx.chart.data import ChartData
-from pptx.enum.chart import XL_CHART_TYPE
+from pptx.enum.chart import XL_CHART_TYPE, XL_MARKER_STYLE
+from pptx.enum.dml import MSO_LINE_DASH_STYLE
 from pptx.dml.color import RGBColor
 from pptx.oxml.xmlchemy import OxmlElement
-import plotly.io as pio
 
 
-def is_kpi(row, asset_df, kpi_list):
-    for kpi in kpi_list:
-        filtered_row = filter_data_by_kpi(asset_df, kpi)
-        if (not filtered_row.empty) and row.equals(filtered_row.iloc[0, :]):
-            return True
+MAX_CARDS = 3
 
-    return False
+MARKER_COLORS = {
+    'green': RGBColor(0, 128, 0),
+    'red': RGBColor(255, 0, 0),
+}
 
 
 def add_anomaly_heading(slide, asset):
@@ -329,19 +331,10 @@ def add_divider(anomaly_slide, left, top, width, height, color):
     line.fill.background()
 
 
-def add_anomaly_chart(anomaly_slide, left, top, width, height, row):
-    metric = row['metric']
-    xaxis_data = row['xaxis_data']
-    yaxis_data = row['yaxis_data']
-    trend_data = row['trend_data']
-    yhat_upper_data = row['yhat_upper_data']
-    yhat_lower_data = row['yhat_lower_data']
-    anomaly_type_data = row['yhat_anomaly_type_data']
-    fig = get_graph(metric, xaxis_data, yaxis_data, trend_data, yhat_upper_data, yhat_lower_data, anomaly_type_data)
-    img_path = "/tmp/anomaly.png" if in_production else "anomaly.png"
-    fig.write_image(img_path, width=536, height=362)
+def add_anomaly_chart(anomaly_slide, left, top, width, height, chart):
+    image = chart.result()
     anomaly_slide.shapes.add_picture(
-        img_path,
+        BytesIO(image),
         left=left,
         top=top,
         width=width,
@@ -349,6 +342,85 @@ def add_anomaly_chart(anomaly_slide, left, top, width, height, row):
     )
 
 
+def get_series_values(series_data):
+    return [None if value != value else value for value in series_data]
+
+
+def add_native_anomaly_chart(anomaly_slide, left, top, width, height, row):
+    metric = row['metric']
+    anomaly_type_data = row['yhat_anomaly_type_data']
+
+    chart_data = ChartData()
+    chart_data.categories = list(row['xaxis_data'])
+    chart_data.add_series('Lower', get_series_values(row['yhat_lower_data']))
+    chart_data.add_series('Upper', get_series_values(row['yhat_upper_data']))
+    chart_data.add_series('Trend', get_series_values(row['trend_data']))
+    chart_data.add_series('Actual', get_series_values(row['yaxis_data']))
+
+    chart = anomaly_slide.shapes.add_chart(
+        XL_CHART_TYPE.LINE_MARKERS, left, top, width, height, chart_data
+    ).chart
+    chart.has_title = False
+    chart.has_legend = False
+
+    xaxis = chart.category_axis
+    xaxis.has_major_gridlines = False
+    xaxis.tick_labels.font.size = Pt(7)
+
+    yaxis = chart.value_axis
+    yaxis.minimum_scale = 0
+    yaxis.has_major_gridlines = False
+    yaxis.tick_labels.font.size = Pt(7)
+    yaxis.tick_labels.number_format = get_number_format(metric)
+    yaxis.tick_labels.number_format_is_linked = False
+
+    lower_series, upper_series, trend_series, actual_series = chart.plots[0].series
+
+    for series in [lower_series, upper_series]:
+        series.smooth = False
+        series.marker.style = XL_MARKER_STYLE.NONE
+        series.format.line.color.rgb = RGBColor(173, 216, 230)
+        series.format.line.width = Pt(1)
+
+    trend_series.smooth = False
+    trend_series.marker.style = XL_MARKER_STYLE.NONE
+    trend_series.format.line.color.rgb = RGBColor(118, 133, 145)
+    trend_series.format.line.dash_style = MSO_LINE_DASH_STYLE.DASH
+    trend_series.format.line.width = Pt(1)
+
+    actual_series.smooth = False
+    actual_series.format.line.color.rgb = RGBColor(70, 177, 255)
+    actual_series.format.line.width = Pt(1.5)
+    actual_series.marker.style = XL_MARKER_STYLE.CIRCLE
+    actual_series.marker.size = 4
+    actual_series.marker.format.fill.solid()
+    actual_series.marker.format.fill.fore_color.rgb = RGBColor(70, 177, 255)
+    actual_series.marker.format.line.fill.background()
+
+    colors = get_color_array(anomaly_type_data, metric)
+    for point_i, color in enumerate(colors):
+        if color is not None:
+            marker = actual_series.points[point_i].marker
+            marker.style = XL_MARKER_STYLE.CIRCLE
+            marker.size = 5
+            marker.format.fill.solid()
+            marker.format.fill.fore_color.rgb = MARKER_COLORS[color]
+            marker.format.line.fill.background()
+
+
+def submit_anomaly_charts(anomaly_df):
+    '''
+    Starts rendering the plotly chart of each row; native charts are built with the card instead.
+    '''
+    if ANOMALY_CHART_MODE == 'native':
+        return [None] * anomaly_df.shape[0]
+
+    from graph import get_row_graph
+
+    renderer = get_chart_renderer()
+    return [renderer.submit(get_row_graph, row) for i, row in anomaly_df.iterrows()]
+
+
 def add_footer(anomaly_slide, left, top, width, height, color):
     divider_shape = anomaly_slide.shapes.add_shape(
         MSO_SHAPE.ROUND_2_SAME_RECTANGLE, left, top, width, height
@@ -364,7 +436,7 @@ def add_footer(anomaly_slide, left, top, width, height, color):
     line.fill.background()
 
 
-def add_anomaly_card(anomaly_slide, row, period, left, top, color):
+def add_anomaly_card(anomaly_slide, row, period, left, top, color, chart):
     width = Cm(6.81)
     height = Cm(7.98)
 
@@ -460,14 +532,24 @@ def add_anomaly_card(anomaly_slide, row, period, left, top, color):
     )
 
     try:
-        add_anomaly_chart(
-            anomaly_slide,
-            left=Inches(left.inches + width.inches / 2 - Cm(5.68).inches / 2),
-            top=Inches(top.inches + 1.45),
-            width=Cm(5.68),
-            height=Cm(3.84),
-            row=row
-        )
+        if chart is None:
+            add_native_anomaly_chart(
+                anomaly_slide,
+                left=Inches(left.inches + width.inches / 2 - Cm(5.68).inches / 2),
+                top=Inches(top.inches + 1.45),
+                width=Cm(5.68),
+                height=Cm(3.84),
+                row=row
+            )
+        else:
+            add_anomaly_chart(
+                anomaly_slide,
+                left=Inches(left.inches + width.inches / 2 - Cm(5.68).inches / 2),
+                top=Inches(top.inches + 1.45),
+                width=Cm(5.68),
+                height=Cm(3.84),
+                chart=chart
+            )
     except:
         print("No anomaly chart")
 
@@ -481,7 +563,70 @@ def add_anomaly_card(anomaly_slide, row, period, left, top, color):
     # )
 
 
-def add_anomaly_cards(anomaly_slide, period, asset_df, kpi_list):
+def get_top_positions(is_kpi, revenue_impact, n=MAX_CARDS):
+    '''
+    Positions of the first n rows when sorted by is_kpi and revenue_impact descending (NaN impacts
+    last, ties in row order), selected with nlargest rather than a full sort.
+    '''
+    has_impact = ~np.isnan(revenue_impact)
+    tiers = [
+        (is_kpi & has_impact, True),
+        (is_kpi & ~has_impact, False),
+        (~is_kpi & has_impact, True),
+        (~is_kpi & ~has_impact, False),
+    ]
+
+    positions = []
+    for tier_mask, by_impact in tiers:
+        remaining = n - len(positions)
+        if remaining <= 0:
+            break
+
+        tier_positions = np.flatnonzero(tier_mask)
+        if by_impact:
+            top = pd.Series(revenue_impact[tier_positions]).nlargest(remaining, keep='first').index
+            positions.extend(tier_positions[top])
+        else:
+            positions.extend(tier_positions[:remaining])
+
+    return np.array(positions, dtype=np.intp)
+
+
+def get_anomaly_card_rows(asset_df, kpi_list):
+    '''
+    The negative and positive anomalies that get a card - KPIs first, then by revenue impact.
+    Only the rows that get a card are copied out of asset_df.
+    '''
+    positive_anomaly_mask = (asset_df['yhat_color'] == 'green').values
+    negative_anomaly_mask = (asset_df['yhat_color'] == 'red').values
+    warning_or_critical_mask = ((asset_df['is_warning'] == 1) | (asset_df['is_critical'] == 1)).values
+    infinity_mask = np.isinf(asset_df['delta'].astype(float).values)
+
+    kpi_mask = get_kpi_mask(asset_df, kpi_list)
+    revenue_impact = asset_df['revenue_impact'].astype(float).values
+
+    card_rows = []
+    for anomaly_mask in [negative_anomaly_mask, positive_anomaly_mask]:
+        candidates = np.flatnonzero(anomaly_mask & warning_or_critical_mask & ~infinity_mask)
+        top = candidates[get_top_positions(kpi_mask[candidates], revenue_impact[candidates])]
+        card_rows.append(asset_df.iloc[top].assign(is_kpi=kpi_mask[top]))
+
+    negative_anomaly_df, positive_anomaly_df = card_rows
+    return negative_anomaly_df, positive_anomaly_df
+
+
+class AnomalyCards:
+    '''
+    The rows that get a card on an asset's anomaly slide, with their charts already submitted for rendering.
+    Can be prepared ahead of (and concurrently with) building the slide.
+    '''
+    def __init__(self, asset_df, kpi_list):
+        self.negative_anomaly_df, self.positive_anomaly_df = get_anomaly_card_rows(asset_df, kpi_list)
+        self.negative_charts = submit_anomaly_charts(self.negative_anomaly_df)
+        self.positive_charts = submit_anomaly_charts(self.positive_anomaly_df)
+
+
+def add_anomaly_cards(anomaly_slide, period, asset_df, kpi_list, anomaly_cards=None):
 
     negative_top = Inches(0.75)
     positive_top = Inches(4.25)
@@ -498,39 +643,32 @@ def add_anomaly_cards(anomaly_slide, period, asset_df, kpi_list):
         (Inches(6.5), positive_top),
     ]
 
-    positive_anomaly_mask = asset_df['yhat_color'] == 'green'
-    negative_anomaly_mask = asset_df['yhat_color'] == 'red'
-    warning_or_critical_mask = (asset_df['is_warning'] == 1) | (asset_df['is_critical'] == 1)
-    infinity_mask = np.isinf(asset_df['delta'])
-
-    positive_anomaly_df = asset_df[positive_anomaly_mask & warning_or_critical_mask & (~infinity_mask)]
-    positive_anomaly_df['is_kpi'] = positive_anomaly_df.apply(lambda row: is_kpi(row, asset_df, kpi_list), axis=1)
-    positive_anomaly_df.sort_values(by=['is_kpi', 'revenue_impact'], ascending=False, inplace=True)
-
-    negative_anomaly_df = asset_df[negative_anomaly_mask & warning_or_critical_mask & (~infinity_mask)]
-    negative_anomaly_df['is_kpi'] = negative_anomaly_df.apply(lambda row: is_kpi(row, asset_df, kpi_list), axis=1)
-    negative_anomaly_df.sort_values(by=['is_kpi', 'revenue_impact'], ascending=False, inplace=True)
+    if anomaly_cards is None:
+        anomaly_cards = AnomalyCards(asset_df, kpi_list)
 
     negative_warning_count = 0
     negative_critical_count = 0
     total_count = 0
 
-    for (i, row), (left, top) in zip(negative_anomaly_df.iterrows(), negative_card_locations):
-        add_anomaly_card(anomaly_slide, row, period, left, top, color='red')
+    negative_anomaly_df, negative_charts = anomaly_cards.negative_anomaly_df, anomaly_cards.negative_charts
+    positive_anomaly_df, positive_charts = anomaly_cards.positive_anomaly_df, anomaly_cards.positive_charts
+
+    for (i, row), (left, top), chart in zip(negative_anomaly_df.iterrows(), negative_card_locations, negative_charts):
+        add_anomaly_card(anomaly_slide, row, period, left, top, color='red', chart=chart)
         total_count += 1
         if row['is_warning']:
             negative_warning_count += 1
         if row['is_critical']:
             negative_critical_count += 1
 
-    for (i, row), (left, top) in zip(positive_anomaly_df.iterrows(), positive_card_locations):
-        add_anomaly_card(anomaly_slide, row, period, left, top, color='green')
+    for (i, row), (left, top), chart in zip(positive_anomaly_df.iterrows(), positive_card_locations, positive_charts):
+        add_anomaly_card(anomaly_slide, row, period, left, top, color='green', chart=chart)
         total_count += 1
 
     return negative_warning_count, negative_critical_count, total_count
 
 
-def add_anomaly_slide(ppt, period, asset, asset_df, kpi_list):
+def add_anomaly_slide(ppt, period, asset, asset_df, kpi_list, anomaly_cards=None):
     blank_slide_layout = ppt.slide_layouts[6]
     anomaly_slide = ppt.slides.add_slide(blank_slide_layout)
     add_anomaly_heading(anomaly_slide, asset)
@@ -545,7 +683,7 @@ def add_anomaly_slide(ppt, period, asset, asset_df, kpi_list):
     add_date(anomaly_slide, period, weekday)
     add_anomaly_subheadings(anomaly_slide)
     print(f"Creating {asset} anomaly cards...")
-    negative_warning_count, negative_critical_count, total_count = add_anomaly_cards(anomaly_slide, period, asset_df, kpi_list)
+    negative_warning_count, negative_critical_count, total_count = add_anomaly_cards(anomaly_slide, period, asset_df, kpi_list, anomaly_cards)
     print(f"Created {asset} anomaly cards")
 
     return negative_warning_count, negative_critical_count, total_count
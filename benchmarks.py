@@ -0,0 +1,887 @@
+'''
+Micro benchmarks for the data pipeline, run on synthetic data without BigQuery.
+
+    python benchmarks.py <name> [<name> ...]
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def make_data_dicts(n_series, n_points=90, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.Series(pd.date_range('2021-01-01', periods=n_points).strftime('%Y-%m-%d'))
+    data_dicts = []
+    for i in range(n_series):
+        y = rng.normal(100, 10, n_points)
+        data_dicts.append({
+            'asset': 'Benchmark',
+            'data_source': 'Ecommerce',
+            'period': 'daily',
+            'weekday': None,
+            'dimension': 'Source_medium',
+            'dim_label': f'label_{i // 10}',
+            'metric': f'Metric_{i % 10}',
+            'y': y[-1],
+            'y_prev_lower': y[-8] - 5,
+            'y_prev_upper': y[-8] + 5,
+            'y_prev': y[-8],
+            'yhat': 100.0,
+            'yhat_lower': 90.0,
+            'yhat_upper': 110.0,
+            'is_anomaly': bool(i % 2),
+            'is_warning': False,
+            'is_critical': bool(i % 3 == 0),
+            'anomaly_type': i % 3 - 1,
+            'yhat_anomaly_type': i % 3 - 1,
+            'color': None,
+            'yhat_color': None,
+            'is_year_maximum': False,
+            'is_six_month_maximum': False,
+            'is_three_month_maximum': False,
+            'xaxis_data': dates,
+            'yaxis_data': pd.Series(y),
+            'trend_data': pd.Series(np.full(n_points, 100.0)),
+            'yhat_data': pd.Series(np.full(n_points, 100.0)),
+            'yhat_upper_data': pd.Series(np.full(n_points, 110.0)),
+            'yhat_lower_data': pd.Series(np.full(n_points, 90.0)),
+            'yhat_anomaly_type_data': pd.Series(np.where(y > 110, 1, np.where(y < 90, -1, 0))),
+        })
+
+    return data_dicts
+
+
+def bench_frame_builder(n_series=10000, legacy_limit=2000):
+    from helper import RecordFrameBuilder
+
+    data_dicts = make_data_dicts(n_series)
+    columns = list(data_dicts[0])[:20]
+
+    def build():
+        builder = RecordFrameBuilder(columns)
+        for data_dict in data_dicts:
+            builder.append(data_dict)
+        return builder.build()
+
+    def append(records):
+        df = pd.DataFrame(columns=columns)
+        for record in records:
+            df = pd.concat([df, pd.DataFrame([record])], ignore_index=True)
+        return df
+
+    asset_df, seconds = timed(build)
+    print(f"RecordFrameBuilder: {asset_df.shape[0]} series in {seconds:.3f}s")
+
+    legacy_df, seconds = timed(append, data_dicts[:legacy_limit])
+    print(f"Row-by-row append: {legacy_df.shape[0]} series in {seconds:.3f}s")
+
+
+def make_edge_values(n, seed=0):
+    '''
+    n floats drawn from NaN, +-inf, +-0, values around the 10% and 30% thresholds and ordinary values.
+    '''
+    rng = np.random.default_rng(seed)
+    special = np.array([np.nan, np.inf, -np.inf, 0.0, -0.0, 1.0, -1.0, 1e-300, -1e-300, 1e300, 100.0, 110.0, 130.0, 70.0, 90.0])
+    values = rng.normal(100, 50, n)
+    is_special = rng.random(n) < 0.5
+    values[is_special] = rng.choice(special, is_special.sum())
+    return values
+
+
+def bench_array_helpers(n=20000):
+    '''
+    Checks delta_pct_array, get_anomaly_type_array, check_warning_array, check_critical_array and
+    get_color_array against their scalar versions element by element, on NaN, inf, 0 and negative inputs.
+    '''
+    from config import REVERSE_METRICS
+    from helper import delta_pct, get_anomaly_type, check_warning, check_critical, get_color
+    from helper import delta_pct_array, get_anomaly_type_array, check_warning_array, check_critical_array, get_color_array
+
+    y, upper, lower = make_edge_values(n, 0), make_edge_values(n, 1), make_edge_values(n, 2)
+    rng = np.random.default_rng(3)
+    anomaly_types = rng.choice(np.array([-1.0, 0.0, 1.0, np.nan]), n)
+    metric_names = np.array(['Revenue', 'Orders', 'Traffic'] + REVERSE_METRICS + [metric.upper() for metric in REVERSE_METRICS], dtype=object)
+    metrics = rng.choice(metric_names, n)
+
+    def is_same(a, b):
+        if isinstance(a, float) and isinstance(b, float) and np.isnan(a) and np.isnan(b):
+            return True
+        return a == b
+
+    checks = [
+        ('delta_pct', lambda i: delta_pct(y[i], upper[i]), lambda: delta_pct_array(y, upper)),
+        ('get_anomaly_type', lambda i: get_anomaly_type(y[i], upper[i], lower[i]), lambda: get_anomaly_type_array(y, upper, lower)),
+        ('check_warning', lambda i: check_warning(y[i], upper[i], lower[i]), lambda: check_warning_array(y, upper, lower)),
+        ('check_critical', lambda i: check_critical(y[i], upper[i], lower[i]), lambda: check_critical_array(y, upper, lower)),
+        ('get_color', lambda i: get_color(anomaly_types[i], metrics[i]), lambda: get_color_array(anomaly_types, metrics)),
+        ('get_color one metric', lambda i: get_color(anomaly_types[i], 'acos'), lambda: get_color_array(anomaly_types, 'acos')),
+    ]
+
+    mismatches = []
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for name, scalar, array in checks:
+            expected, scalar_seconds = timed(lambda: [scalar(i) for i in range(n)])
+            actual, array_seconds = timed(array)
+            print(f"{name}: {n} values, scalar {scalar_seconds:.3f}s array {array_seconds:.4f}s")
+
+            for i, (a, b) in enumerate(zip(actual.tolist(), expected)):
+                if not is_same(a, b):
+                    mismatches.append(f"{name} y={y[i]!r} upper={upper[i]!r} lower={lower[i]!r} "
+                                      f"anomaly_type={anomaly_types[i]!r} metric={metrics[i]} : array {a!r} != scalar {b!r}")
+
+    if mismatches:
+        print('\n'.join(mismatches[:20]))
+        print(f"{len(mismatches)} mismatches between the array and scalar helpers")
+        sys.exit(1)
+
+
+def make_asset_df(n_series, seed=0):
+    from helper import RecordFrameBuilder, delta_pct_array, get_color_array
+
+    builder = RecordFrameBuilder([])
+    for data_dict in make_data_dicts(n_series, seed=seed):
+        builder.append(data_dict)
+
+    asset_df = builder.build()
+    asset_df['yhat_color'] = get_color_array(asset_df['yhat_anomaly_type'], asset_df['metric'])
+    asset_df['is_warning'] = ~asset_df['is_critical']
+    asset_df['delta'] = delta_pct_array(asset_df['y'], asset_df['yhat'])
+    asset_df['revenue_impact'] = asset_df['delta'].abs()
+
+    return asset_df
+
+
+def bench_anomaly_chart_modes(n_slides=10):
+    from io import BytesIO
+    import anomaly_slide
+    from create_ppt import new_ppt
+
+    asset_df = make_asset_df(60)
+
+    for mode in ['native', 'kaleido']:
+        anomaly_slide.ANOMALY_CHART_MODE = mode
+
+        def build():
+            ppt = new_ppt()
+            for _ in range(n_slides):
+                anomaly_slide.add_anomaly_slide(ppt, 'daily', 'Benchmark', asset_df, [])
+            stream = BytesIO()
+            ppt.save(stream)
+            return stream.getbuffer().nbytes
+
+        try:
+            size, seconds = timed(build)
+        except Exception as e:
+            print(f"{mode}: failed - {e}")
+            continue
+
+        print(f"{mode}: {n_slides} slides in {seconds:.3f}s, {size / 1024:.0f} KB")
+
+
+def bench_anomaly_card_rows(n_series=10000):
+    from anomaly_slide import get_anomaly_card_rows
+    from config import default_kpi_list
+
+    asset_df = make_asset_df(n_series)
+    asset_df['yhat_color'] = np.resize(['red', 'green', None], n_series)
+
+    (negative_df, positive_df), seconds = timed(get_anomaly_card_rows, asset_df, default_kpi_list)
+    print(f"get_anomaly_card_rows: {len(negative_df)} + {len(positive_df)} cards from {n_series} series in {seconds:.3f}s")
+
+
+def make_rca_asset_df(n_labels, seed=0):
+    '''
+    Asset rows for the Ecommerce association rules, plus Source rows for n_labels dim_labels.
+    '''
+    rng = np.random.default_rng(seed)
+    keys = [
+        ('Ecommerce', None, None, 'Total_Sales'),
+        ('Ecommerce', None, None, 'AOV'),
+        ('Ecommerce', None, None, 'Orders'),
+        ('mwsAds', None, None, 'Conversion_Rate'),
+        ('mwsAds', None, None, 'Clicks'),
+        ('mwsAds', None, None, 'Ad_Spend'),
+        ('mwsAds', None, None, 'ACOS'),
+    ]
+    for i in range(n_labels):
+        for metric in ['Clicks', 'Ad_Spend', 'ACOS']:
+            keys.append(('mwsAds', 'Source', f'campaign {i}', metric))
+
+    asset_df = pd.DataFrame(keys, columns=['data_source', 'dimension', 'dim_label', 'metric'])
+    n = asset_df.shape[0]
+    asset_df['period'] = 'daily'
+    asset_df['y'] = rng.normal(100, 30, n)
+    asset_df['y_prev'] = rng.normal(100, 30, n)
+    asset_df['yhat'] = 100.0
+    asset_df['y_prev_lower'] = 90.0
+    asset_df['y_prev_upper'] = 110.0
+    asset_df['yhat_upper'] = 110.0
+    asset_df['yhat_lower'] = 90.0
+    asset_df['yhat_anomaly_type'] = np.where(asset_df['y'] > 110, 1, np.where(asset_df['y'] < 90, -1, 0))
+    asset_df['revenue_impact'] = rng.normal(0, 100, n)
+
+    return asset_df
+
+
+def make_rca_rules():
+    '''
+    The Ecommerce association rules, with Clicks broken down by every Source dim_label.
+    '''
+    import re
+    from rca_association_rules import AssociationTreeNode
+
+    n1 = AssociationTreeNode(id='n1', data_source='Ecommerce', dimension=None, dim_label=None, metric='Total_Sales')
+    AssociationTreeNode(id='n2', data_source='Ecommerce', dimension=None, dim_label=None, metric='AOV', parent=n1)
+    n3 = AssociationTreeNode(id='n3', data_source='Ecommerce', dimension=None, dim_label=None, metric='Orders', parent=n1)
+    AssociationTreeNode(id='n4', data_source='mwsAds', dimension=None, dim_label=None, metric='Conversion_Rate', parent=n3)
+    n5 = AssociationTreeNode(id='n5', data_source='mwsAds', dimension=None, dim_label=None, metric='Clicks', parent=n3)
+    n8 = AssociationTreeNode(id='n8', data_source='mwsAds', dimension='Source', dim_label=re.compile('campaign'), metric='Clicks', parent=n5)
+    AssociationTreeNode(id='n9', data_source='same_as_parent', dimension='same_as_parent', dim_label='same_as_parent', metric='Ad_Spend', parent=n8)
+    AssociationTreeNode(id='n10', data_source='same_as_parent', dimension='same_as_parent', dim_label='same_as_parent', metric='ACOS', parent=n8, reverse_effect_on_parent=True)
+
+    return n1
+
+
+def bench_rca_matcher(n_labels=1000):
+    '''
+    Builds the reference RCA tree, with a frame scan per rule lookup, then runs the same lookups
+    through the compiled rule matcher.
+    '''
+    import rca
+    import rca_reference
+
+    asset_df = make_rca_asset_df(n_labels)
+    rules = make_rca_rules()
+
+    lookups = []
+    scan = rca_reference.filter_data_by_association_rules_node
+
+    def recording_scan(asset_df, rule, parent_node=None):
+        lookups.append((rule, parent_node))
+        return scan(asset_df, rule, parent_node)
+
+    rca_reference.filter_data_by_association_rules_node = recording_scan
+    try:
+        nodes, seconds = timed(rca_reference.build_tree_with_all_metrics, asset_df, rules)
+    finally:
+        rca_reference.filter_data_by_association_rules_node = scan
+    print(f"reference: tree of {sum(1 + len(node.descendants) for node in nodes)} nodes, "
+          f"{len(lookups)} rule lookups over {asset_df.shape[0]} rows in {seconds:.3f}s")
+
+    def lookup(get_rows):
+        for rule, parent in lookups:
+            get_rows(rule, parent)
+
+    _, seconds = timed(lookup, rca.AssociationRulesMatcher(asset_df).match)
+    print(f"compiled matcher: the {len(lookups)} lookups, compiling included, in {seconds:.3f}s")
+
+    _, seconds = timed(lookup, lambda rule, parent: scan(asset_df, rule, parent))
+    print(f"frame scans: the same {len(lookups)} lookups in {seconds:.3f}s")
+
+
+def bench_rca_tree(n_labels=500):
+    '''
+    Builds, prunes and walks the RCA tree as the reference anytree nodes and as an RcaTree,
+    and checks both render the same tree.
+    '''
+    import rca
+    import rca_reference
+    from anytree import RenderTree
+
+    asset_df = make_rca_asset_df(n_labels)
+    # every series anomalous in the same direction, so pruning keeps the whole tree
+    asset_df['yhat_anomaly_type'] = 1
+    rules = make_rca_rules()
+
+    def reference_path():
+        nodes = rca_reference.keep_only_anomalies(rca_reference.build_tree_with_all_metrics(asset_df, rules))
+        return [(pre, node.data_source, node.dim_label, node.metric, node.reverse_effect_on_parent)
+                for root in nodes for pre, _, node in RenderTree(root)]
+
+    def array_path():
+        rca_tree = rca.RcaTree(asset_df)
+        nodes = rca_tree.keep_only_anomalies(rca_tree.build(rules, rca.AssociationRulesMatcher(asset_df)))
+        rendered = [(pre, node) for root in nodes for pre, node in rca_tree.render(root)]
+        node_df = rca_tree.get_node_table([node for _, node in rendered])
+        return [(pre, row.data_source, row.dim_label, row.metric, row.reverse_effect_on_parent)
+                for (pre, _), row in zip(rendered, node_df.itertuples(index=False))]
+
+    trees = {}
+    for name, func in [('reference', reference_path), ('RcaTree', array_path)]:
+        trees[name], seconds = timed(func)
+        print(f"{name}: {len(trees[name])} nodes built, pruned and rendered in {seconds:.3f}s")
+
+    if trees['reference'] != trees['RcaTree']:
+        print("RcaTree renders a different tree from the reference")
+        sys.exit(1)
+
+
+def bench_percentile_sketch(n_series=50, n_hours=24 * 365, n_stream=24 * 7, window=3, max_error=0.02):
+    '''
+    Streams the last n_stream hours of each series into a sketch one run at a time, and checks the
+    business filter ranks of each window against rank(pct=True) over the full history.
+    '''
+    from percentile_sketch import PercentileSketch
+
+    rng = np.random.default_rng(0)
+    series = np.maximum(rng.lognormal(3, 1, (n_series, n_hours)), 0)
+    series[:, ::7] = 0
+
+    def exact_run(history):
+        return pd.Series(history).rank(pct=True).iloc[-window:].to_numpy()
+
+    def sketch_run(sketch, new_values, window_values):
+        sketch.update(new_values)
+        return sketch.rank(window_values)
+
+    sketches = [PercentileSketch() for _ in range(n_series)]
+    for sketch, values in zip(sketches, series[:, :-n_stream]):
+        sketch.update(values)
+
+    exact_seconds, sketch_seconds, errors, flips = 0.0, 0.0, [], 0
+    for end in range(n_hours - n_stream + 1, n_hours + 1):
+        for sketch, values in zip(sketches, series):
+            exact, seconds = timed(exact_run, values[:end])
+            exact_seconds += seconds
+            approx, seconds = timed(sketch_run, sketch, values[end - 1:end], values[end - window:end])
+            sketch_seconds += seconds
+
+            errors.append(np.abs(approx - exact).max())
+            flips += (exact.min() < 0.4) != (approx.min() < 0.4)
+
+    runs = n_series * n_stream
+    print(f"rank(pct=True): {runs} series runs in {exact_seconds:.3f}s")
+    print(f"PercentileSketch: {runs} series runs in {sketch_seconds:.3f}s")
+    print(f"max rank error {max(errors):.4f}, mean {np.mean(errors):.4f}, business filter flips {flips} of {runs}")
+
+    sketch_values = sum(level.shape[0] for level in sketches[0].levels)
+    print(f"sketch size after {n_hours} hours: {sketch_values} values")
+
+    if max(errors) > max_error:
+        print(f"rank error over {max_error}")
+        sys.exit(1)
+
+
+def make_arrow_anomaly_table(n_rows, n_labels=200, n_metrics=6, seed=0, start_date='2020-01-01'):
+    '''
+    Synthetic daily anomaly table as BigQuery returns it: string dates and dimension,
+    NUMERIC metrics and FLOAT64 forecast columns.
+    '''
+    import pyarrow as pa
+
+    rng = np.random.default_rng(seed)
+    dates = pa.array(pd.date_range(start_date, periods=n_rows // n_labels + 1).strftime('%Y-%m-%d'))
+    labels = pa.array([f'google / cpc campaign {i}' for i in range(n_labels)])
+
+    columns = {
+        'Date': dates.take(pa.array(np.arange(n_rows) // n_labels)),
+        'Source_medium': labels.take(pa.array(np.arange(n_rows) % n_labels)),
+    }
+    for i in range(n_metrics):
+        metric = f'Metric_{i}'
+        y = rng.normal(1000, 100, n_rows).round(2)
+        columns[metric] = pa.array(y).cast(pa.decimal128(38, 9))
+        for suffix in ['_yhat', '_yhat_upper', '_yhat_lower', '_trend']:
+            columns[f'{metric}{suffix}'] = pa.array(y + rng.normal(0, 10, n_rows))
+
+    return pa.table(columns)
+
+
+class ParquetRowIterator:
+    '''
+    Stands in for a BigQuery RowIterator over a Parquet file, streaming it in record batches.
+    '''
+    def __init__(self, path, batch_size=100000):
+        import pyarrow.parquet as pq
+
+        self.parquet_file = pq.ParquetFile(path)
+        self.batch_size = batch_size
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        return self.parquet_file.iter_batches(batch_size=self.batch_size)
+
+
+def measure_read_memory(path, mode):
+    '''
+    Reads the table at path the way the legacy or compact read path does.
+    Prints the RSS growth of the read and conversion and the size of the resulting frame.
+    '''
+    import gc
+    import resource
+    import pyarrow.parquet as pq
+    import helper
+
+    gc.collect()
+    start_rss = int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+
+    if mode == 'legacy':
+        # what to_dataframe() of the whole result followed by pd.to_numeric on each metric did
+        anomaly_df = pq.read_table(path).to_pandas()
+        for column in anomaly_df.columns:
+            if column.startswith('Metric_') and '_' not in column[len('Metric_'):]:
+                anomaly_df[column] = pd.to_numeric(anomaly_df[column])
+    else:
+        helper.get_bqstorage_client = lambda project_id: None
+        anomaly_df = helper.read_anomaly_df(ParquetRowIterator(path), 'benchmark', 'Date', 'Source_medium')
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(f"{mode}: peak RSS {peak_rss / 2 ** 20:.0f} MB, "
+          f"{max(peak_rss - start_rss, 0) / 2 ** 20:.0f} MB over the start, "
+          f"frame {anomaly_df.memory_usage(deep=True).sum() / 2 ** 20:.0f} MB")
+
+
+def bench_read_memory(n_rows=1000000):
+    '''
+    Peak RSS of turning a query result into an anomaly frame, each path in a fresh interpreter.
+    The compact path streams the result through read_anomaly_df in record batches.
+    '''
+    import os
+    import subprocess
+    import tempfile
+    import pyarrow.parquet as pq
+
+    path = os.path.join(tempfile.mkdtemp(), 'anomaly.parquet')
+    pq.write_table(make_arrow_anomaly_table(n_rows), path, row_group_size=100000)
+    print(f"{n_rows} rows, {os.path.getsize(path) / 2 ** 20:.0f} MB as Parquet")
+
+    for mode, float_dtype in [('legacy', 'float64'), ('compact', 'float64'), ('compact', 'float32')]:
+        print(f"{float_dtype} ", end='', flush=True)
+        subprocess.run(
+            [sys.executable, '-c', f'import benchmarks; benchmarks.measure_read_memory({path!r}, {mode!r})'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+            env=dict(os.environ, ANOMALY_FLOAT_DTYPE=float_dtype, GCP_PROJECT=os.getenv('GCP_PROJECT', 'benchmark')),
+        )
+
+
+def bench_group_slices(n_labels=1000, n_days=400, n_metrics=3):
+    '''
+    Data dicts of one daily table with n_labels dim_labels, ending yesterday, by the per-group copy
+    path (groupby, then clipping and get_data_dict on each group), by slices of the table sorted once
+    and by the batch engine.
+    '''
+    import data
+    from dates import yesterday
+    from helper import get_compact_anomaly_df, normalize_anomaly_df, clip_forecasts, get_group_slices
+
+    start_date = yesterday - pd.Timedelta(days=n_days - 1)
+    table = make_arrow_anomaly_table(n_labels * n_days, n_labels, n_metrics, start_date=start_date)
+    anomaly_df = normalize_anomaly_df(get_compact_anomaly_df(table, 'Date', 'Source_medium'), 'Date')
+    metrics = [f'Metric_{i}' for i in range(n_metrics)]
+
+    def copies():
+        data_dicts = []
+        for dim_label, group_df in anomaly_df.groupby('Source_medium', observed=True):
+            group_df = group_df.copy()
+            clip_forecasts(group_df, metrics)
+            for metric in metrics:
+                data_dicts.append(data.get_data_dict('Benchmark', 'Ecommerce', 'daily', group_df, metric, 'Source_medium', dim_label))
+        return data_dicts
+
+    def slices():
+        df = anomaly_df.copy()
+        clip_forecasts(df, metrics)
+        df, groups = get_group_slices(df, 'Source_medium', 'Date')
+        return list(data.get_serial_data_dicts('Benchmark', 'Ecommerce', 'daily', df, metrics, 'Source_medium', groups))
+
+    def batch():
+        return list(data.get_data_dicts('Benchmark', 'Ecommerce', 'daily', anomaly_df.copy(), metrics, 'Source_medium'))
+
+    print(f"{n_labels} dim_labels x {n_days} days x {n_metrics} metrics, {anomaly_df.shape[0]} rows")
+    for name, func in [('groupby copies', copies), ('sorted slices', slices), ('batch engine', batch)]:
+        data_dicts, seconds = timed(func)
+        print(f"{name}: {len(data_dicts)} series in {seconds:.3f}s")
+
+
+
+def start_fake_slack(rate_limit_every=0, retry_after=1, latency=0.05):
+    '''
+    Serves chat.postMessage and files.upload on localhost, like the Slack Web API.
+    Every rate_limit_every-th request is answered with a 429 and Retry-After.
+    Returns the server, its base url and the list of (method, form fields) it has accepted.
+    '''
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    requests = []
+    lock = threading.Lock()
+    counter = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            method = self.path.rsplit('/', 1)[-1]
+            with lock:
+                counter[0] += 1
+                limited = rate_limit_every > 0 and counter[0] % rate_limit_every == 0
+            time.sleep(latency)
+
+            if limited:
+                status, payload = 429, {'ok': False, 'error': 'ratelimited'}
+            else:
+                fields = {}
+                for key in [b'channel', b'channels', b'thread_ts', b'text', b'initial_comment']:
+                    start = body.find(b'name="' + key + b'"')
+                    if start >= 0:
+                        value = body[start:].split(b'\r\n\r\n', 1)[1].split(b'\r\n', 1)[0]
+                        fields[key.decode()] = value.decode()
+                if not fields and body:
+                    from urllib.parse import parse_qsl
+                    is_json = self.headers.get('Content-Type', '').startswith('application/json')
+                    fields = json.loads(body) if is_json else dict(parse_qsl(body.decode()))
+                with lock:
+                    requests.append((method, fields))
+                    ts = f'{len(requests)}.000'
+                status, payload = 200, {'ok': True, 'ts': ts, 'file': {'id': f'F{ts}'}}
+
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            if limited:
+                self.send_header('Retry-After', str(retry_after))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/api/', requests
+
+
+def bench_slack_delivery(n_alerts=40, rate_limit_every=15):
+    '''
+    Posts n_alerts chart uploads to a local fake Slack that rate limits every rate_limit_every-th request,
+    one new WebClient per alert as before, and through a SlackDeliveryQueue.
+    The queue paces uploads past the first 20 to the files.upload tier, so it takes longer but loses none.
+    Then checks that a queue mixing messages and uploads replies in each channel's thread in queue order.
+    '''
+    from slack_sdk import WebClient
+    import slack_delivery
+
+    image = b'\x89PNG' + bytes(20000)
+    for name in ['client per alert', 'delivery queue']:
+        server, url, requests = start_fake_slack(rate_limit_every)
+        slack_delivery.SLACK_API_URL = url
+        slack_delivery._slack_clients.clear()
+        slack_delivery._rate_limiters.clear()
+
+        def per_alert():
+            failed = 0
+            for i in range(n_alerts):
+                try:
+                    WebClient(token='benchmark', base_url=url).files_upload(
+                        channels='alerts', file=image, filename='anomaly.png', initial_comment=f'alert {i}')
+                except Exception:
+                    failed += 1
+            return failed
+
+        def queued():
+            queue = slack_delivery.SlackDeliveryQueue(title='Hourly alerts for Benchmark', token='benchmark')
+            for i in range(n_alerts):
+                queue.upload_file('alerts', image, filename='anomaly.png', initial_comment=f'alert {i}')
+            queue.flush()
+            return 0
+
+        failed, seconds = timed(per_alert if name == 'client per alert' else queued)
+        server.shutdown()
+        top_level = sum(1 for method, fields in requests if 'thread_ts' not in fields)
+        print(f"{name}: {len(requests)} posts ({top_level} top level), {failed} lost to 429s, in {seconds:.2f}s")
+
+    # messages and uploads queued for two channels come out in each thread in the order they were queued
+    server, url, requests = start_fake_slack(rate_limit_every)
+    slack_delivery.SLACK_API_URL = url
+    slack_delivery._slack_clients.clear()
+    slack_delivery._rate_limiters.clear()
+    queue = slack_delivery.SlackDeliveryQueue(title='Data recency alerts for Benchmark', token='benchmark')
+    queued = {'recency': [], 'alerts': []}
+    for i in range(20):
+        channel = 'recency' if i % 3 else 'alerts'
+        text = f'item {i}'
+        if i % 2:
+            queue.upload_file(channel, image, filename='anomaly.png', initial_comment=text)
+        else:
+            queue.post_message(channel, text)
+        queued[channel].append(text)
+    queue.flush()
+    server.shutdown()
+
+    for channel, texts in queued.items():
+        posted = [fields.get('text', fields.get('initial_comment')) for method, fields in requests
+                  if channel in (fields.get('channel'), fields.get('channels')) and 'thread_ts' in fields]
+        print(f"{channel}: {len(posted)} replies, in queue order {posted == texts}")
+        if posted != texts:
+            print(f"expected {texts}, got {posted}")
+            sys.exit(1)
+
+
+SMTP_SERVER_SCRIPT = '''
+import asyncore, email, hashlib, smtpd, sys
+
+class Server(smtpd.SMTPServer):
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        parts = email.message_from_bytes(data).get_payload()
+        attachment = parts[1].get_payload(decode=True) if len(parts) > 1 else b''
+        print(peer[1], hashlib.sha256(attachment).hexdigest(), flush=True)
+
+server = Server(('127.0.0.1', 0), None, decode_data=False)
+print(server.socket.getsockname()[1], flush=True)
+asyncore.loop()
+'''
+
+
+def start_debugging_smtp():
+    '''
+    Runs Python's local SMTP server (smtpd, up to Python 3.11) on localhost, without TLS or AUTH, in a subprocess.
+    It prints the client port and the sha256 of the attachment of each message it receives.
+    Returns the subprocess and the server's port.
+    '''
+    import subprocess
+
+    process = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', SMTP_SERVER_SCRIPT], stdout=subprocess.PIPE, text=True)
+    return process, int(process.stdout.readline())
+
+
+def bench_smtp_delivery(n_messages=10, attachment_mb=5):
+    '''
+    Emails n_messages decks of attachment_mb to a local SMTP server, with a connection per message
+    and the deck read and encoded whole as before, and through one SmtpSession streaming the attachment.
+    '''
+    import hashlib
+    import os
+    import smtplib
+    import tempfile
+    import tracemalloc
+    from email import encoders
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from smtp_session import SmtpSession, get_message_bytes
+
+    with tempfile.NamedTemporaryFile(suffix='.pptx', delete=False) as f:
+        f.write(os.urandom(attachment_mb * 2 ** 20))
+        filepath = f.name
+
+    with open(filepath, 'rb') as f:
+        deck_hash = hashlib.sha256(f.read()).hexdigest()
+
+    process, port = start_debugging_smtp()
+
+    def per_message():
+        for i in range(n_messages):
+            msg = MIMEMultipart()
+            msg['From'], msg['To'], msg['Subject'] = 'watchdog@example.com', 'team@example.com', f'Deck {i}'
+            msg.attach(MIMEText(''))
+            with open(filepath, 'rb') as attachment:
+                p = MIMEBase('application', 'octet-stream')
+                p.set_payload(attachment.read())
+            encoders.encode_base64(p)
+            p.add_header('Content-Disposition', f"attachment; filename= {os.path.basename(filepath)}")
+            msg.attach(p)
+            server = smtplib.SMTP('127.0.0.1', port)
+            server.ehlo()
+            server.sendmail('watchdog@example.com', 'team@example.com', msg.as_string())
+            server.close()
+
+    def session():
+        smtp_session = SmtpSession('127.0.0.1', port, starttls=False)
+        for i in range(n_messages):
+            message_bytes, marker = get_message_bytes('watchdog@example.com', 'team@example.com', f'Deck {i}', '', filepath)
+            smtp_session.send('watchdog@example.com', ['team@example.com'], message_bytes, marker, filepath)
+        smtp_session.close()
+
+    try:
+        for name, func in [('connection per message', per_message), ('smtp session', session)]:
+            tracemalloc.start()
+            _, seconds = timed(func)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            messages = [process.stdout.readline().split() for _ in range(n_messages)]
+            connections = len({client_port for client_port, _ in messages})
+            intact = all(attachment_hash == deck_hash for _, attachment_hash in messages)
+            print(f"{name}: {len(messages)} messages over {connections} connections in {seconds:.2f}s, "
+                  f"peak {peak / 2 ** 20:.1f} MB, attachments intact {intact}")
+    finally:
+        process.kill()
+        os.remove(filepath)
+
+
+def make_series_anomaly_df(period, n_labels=60, n_points=120, seed=0):
+    '''
+    Synthetic compact anomaly table ending on the period's current date, with the edge cases get_data_dict
+    handles: missing values, a dim_label without a current row, dim_labels with too few points,
+    negative forecasts and a metric without its _trend column.
+    '''
+    from data import get_current_prev_dates
+    from helper import get_date_col
+
+    rng = np.random.default_rng(seed)
+    date_col = get_date_col(period)
+    current_date, _ = get_current_prev_dates(period, weekday=6)
+    dates = pd.date_range(end=current_date, periods=n_points, freq='D' if period == 'daily' else '7D')
+
+    label_points = np.full(n_labels, n_points)
+    label_points[1] = n_points - 1  # no current row
+    label_points[2] = 5  # too few points
+    label_points[3] = 12
+    frames = []
+    for label, points in enumerate(label_points):
+        frames.append(pd.DataFrame({
+            date_col: dates[:points],
+            'Source_medium': f'source {label}',
+        }))
+    anomaly_df = pd.concat(frames, ignore_index=True)
+    anomaly_df['Source_medium'] = anomaly_df['Source_medium'].astype('category')
+
+    n_rows = anomaly_df.shape[0]
+    for metric in ['Revenue', 'Orders', 'Bounce_rate']:
+        y = rng.normal(100, 30, n_rows)
+        y[rng.random(n_rows) < 0.05] = np.nan
+        anomaly_df[metric] = y
+        anomaly_df[f'{metric}_yhat'] = y + rng.normal(0, 20, n_rows)
+        anomaly_df[f'{metric}_yhat_upper'] = anomaly_df[f'{metric}_yhat'] + rng.normal(30, 10, n_rows)
+        anomaly_df[f'{metric}_yhat_lower'] = anomaly_df[f'{metric}_yhat'] - rng.normal(30, 10, n_rows) - 100
+        anomaly_df[f'{metric}_trend'] = y + rng.normal(0, 5, n_rows)
+    anomaly_df = anomaly_df.drop(columns=['Bounce_rate_trend'])
+
+    # shuffled, as rows arrive from BigQuery
+    return anomaly_df.sample(frac=1, random_state=seed).reset_index(drop=True), ['Revenue', 'Orders', 'Bounce_rate']
+
+
+def is_same_value(a, b):
+    if isinstance(a, pd.Series) or isinstance(b, pd.Series):
+        try:
+            pd.testing.assert_series_equal(a, b)
+        except AssertionError:
+            return False
+        return True
+
+    if isinstance(a, float) and isinstance(b, float) and np.isnan(a) and np.isnan(b):
+        return True
+
+    return type(a) == type(b) and a == b
+
+
+def bench_batch_data_dicts():
+    '''
+    Checks that the batch engine returns exactly the data_dicts and errors of get_data_dict looped over
+    every series, on daily and weekly tables with and without a dimension.
+    '''
+    import data
+    from helper import clip_forecasts, get_group_slices, get_date_col, normalize_anomaly_df
+
+    mismatches = []
+    for period in ['daily', 'weekly']:
+        anomaly_df, metrics = make_series_anomaly_df(period)
+        anomaly_df = normalize_anomaly_df(anomaly_df, get_date_col(period))
+        overall_df = anomaly_df[anomaly_df['Source_medium'] == 'source 0'].drop(columns=['Source_medium']).reset_index(drop=True)
+
+        for dimension, table_df in [('Source_medium', anomaly_df), (None, overall_df)]:
+            batch_results, batch_seconds = timed(lambda: list(data.get_data_dicts('Benchmark', 'Ecommerce', period, table_df.copy(), metrics, dimension)))
+
+            df = table_df.copy()
+            clip_forecasts(df, metrics)
+            if dimension is None:
+                groups = [(np.nan, 0, df.shape[0])]
+            else:
+                df, groups = get_group_slices(df, dimension, get_date_col(period))
+            serial_results, serial_seconds = timed(lambda: list(data.get_serial_data_dicts('Benchmark', 'Ecommerce', period, df, metrics, dimension, groups)))
+
+            name = f"{period} {dimension or 'overall'}"
+            print(f"{name}: {len(batch_results)} series, batch {batch_seconds:.3f}s serial {serial_seconds:.3f}s")
+            if len(batch_results) != len(serial_results):
+                mismatches.append(f"{name} : {len(batch_results)} batch series, {len(serial_results)} serial")
+                continue
+
+            for batch_result, serial_result in zip(batch_results, serial_results):
+                (dim_label, metric, batch_dict, batch_e), (_, _, serial_dict, serial_e) = batch_result, serial_result
+                series = f"{name} {dim_label} {metric}"
+                if repr(batch_e) != repr(serial_e):
+                    mismatches.append(f"{series} : error {batch_e!r} != {serial_e!r}")
+                elif (batch_dict is None) != (serial_dict is None):
+                    mismatches.append(f"{series} : data_dict {batch_dict is None} is None != {serial_dict is None}")
+                elif batch_dict is not None:
+                    if list(batch_dict) != list(serial_dict):
+                        mismatches.append(f"{series} : keys {list(batch_dict)} != {list(serial_dict)}")
+                        continue
+                    for key in batch_dict:
+                        if not is_same_value(batch_dict[key], serial_dict[key]):
+                            mismatches.append(f"{series} : {key} {batch_dict[key]!r} != {serial_dict[key]!r}")
+
+    if mismatches:
+        print('\n'.join(mismatches[:20]))
+        print(f"{len(mismatches)} mismatches between the batch and per-series data_dicts")
+        sys.exit(1)
+
+# cold import budgets in seconds, and the heavy packages each entry module must not load
+IMPORT_TIME_BUDGETS = {
+    'main': 0.25,
+    'hourly': 2.5,
+    'data_recency': 2.5,
+    'create_ppt': 3.0,
+}
+IMPORT_FORBIDDEN_MODULES = {
+    'main': ['pandas', 'numpy', 'plotly', 'pptx', 'anytree', 'slack_sdk', 'google.cloud.bigquery'],
+    'hourly': ['pptx', 'plotly', 'anytree'],
+    'data_recency': ['pptx', 'plotly', 'anytree'],
+    'create_ppt': ['plotly', 'anytree', 'slack_sdk'],
+}
+
+
+def get_import_times(module, runs=3):
+    '''
+    Imports module in fresh interpreters under `python -X importtime`.
+    Returns the fastest cumulative import time in seconds and the names of every module it loaded.
+    '''
+    import os
+    import subprocess
+
+    env = dict(os.environ, GCP_PROJECT=os.getenv('GCP_PROJECT', 'benchmark'))
+    best, loaded = None, set()
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            env=env, capture_output=True, text=True, check=True,
+        )
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            loaded.add(name.strip())
+            if name.strip() == module:
+                seconds = int(cumulative) / 1e6
+                best = seconds if best is None else min(best, seconds)
+
+    return best, loaded
+
+
+def bench_import_time():
+    failures = []
+    for module, budget in IMPORT_TIME_BUDGETS.items():
+        seconds, loaded = get_import_times(module)
+        forbidden = [name for name in IMPORT_FORBIDDEN_MODULES[module] if name in loaded]
+        print(f"import {module}: {seconds:.3f}s (budget {budget:.2f}s)" + (f", loads {forbidden}" if forbidden else ""))
+
+        if seconds > budget:
+            failures.append(f"import {module} took {seconds:.3f}s, over its {budget:.2f}s budget")
+        if forbidden:
+            failures.append(f"import {module} loads {', '.join(forbidden)}")
+
+    if failures:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:]:
+        globals()[f'bench_{name}']()
@@ -1,19 +1,72 @@
+import threading
 from google.cloud import bigquery
 from google.oauth2 import service_account
 from config import in_production
 
 
-def get_bigquery_client(project_id):
+_clients = {}
+_clients_lock = threading.Lock()
+_client_stats = {'hits': 0, 'misses': 0}
+_bqstorage_clients = {}
+
+
+def get_credentials():
+    if in_production:
+        return None
+
+    return service_account.Credentials.from_service_account_file(
+        'watchdog_private_key.json', scopes=["https://www.googleapis.com/auth/cloud-platform"],
+        # 'firestore_key.json', scopes=["https://www.googleapis.com/auth/cloud-platform"],
+    )
+
+
+def create_bigquery_client(project_id):
     if in_production:
         client = bigquery.Client(project=project_id)
 
     else:
-        credentials = service_account.Credentials.from_service_account_file(
-            'watchdog_private_key.json', scopes=["https://www.googleapis.com/auth/cloud-platform"],
-            # 'firestore_key.json', scopes=["https://www.googleapis.com/auth/cloud-platform"],
-        )
-
         # client = bigquery.Client(credentials=credentials, project='daton-272504')
-        client = bigquery.Client(credentials=credentials, project=project_id)
+        client = bigquery.Client(credentials=get_credentials(), project=project_id)
+
+    return client
+
+
+def get_bigquery_client(project_id):
+    '''
+    Returns the pooled client for project_id, creating it on first use.
+    One client (and so one authorized HTTP session) is kept per project for the life of the process.
+    '''
+    with _clients_lock:
+        client = _clients.get(project_id)
+        if client is None:
+            _client_stats['misses'] += 1
+            client = create_bigquery_client(project_id)
+            _clients[project_id] = client
+        else:
+            _client_stats['hits'] += 1
+
+    return client
+
+
+def get_bqstorage_client(project_id):
+    '''
+    Returns the pooled BigQuery Storage read client for project_id.
+    None when google-cloud-bigquery-storage is not installed, in which case results are downloaded over REST.
+    '''
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        return None
+
+    with _clients_lock:
+        client = _bqstorage_clients.get(project_id)
+        if client is None:
+            client = bigquery_storage.BigQueryReadClient(credentials=get_credentials())
+            _bqstorage_clients[project_id] = client
+
+    return client
+
 
-    return client
\ No newline at end of file
+def get_client_pool_stats():
+    with _clients_lock:
+        return dict(_client_stats, clients=len(_clients))
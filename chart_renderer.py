@@ -0,0 +1,60 @@
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from config import CHART_RENDER_WORKERS
+
+
+CHART_WIDTH = 536
+CHART_HEIGHT = 362
+
+
+class ChartRenderer:
+    '''
+    Renders plotly figures to PNG bytes on a pool of persistent Kaleido processes.
+    Each Kaleido scope serialises its own requests, so up to `workers` charts render at the same time.
+    '''
+    def __init__(self, workers=CHART_RENDER_WORKERS):
+        self.workers = max(1, workers)
+        self._scopes = Queue()
+        self._scopes_created = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def _acquire_scope(self):
+        with self._lock:
+            if self._scopes.empty() and self._scopes_created < self.workers:
+                from kaleido.scopes.plotly import PlotlyScope
+                self._scopes_created += 1
+                return PlotlyScope()
+
+        return self._scopes.get()
+
+    def render(self, fig, width=CHART_WIDTH, height=CHART_HEIGHT):
+        scope = self._acquire_scope()
+        try:
+            return scope.transform(fig, format='png', width=width, height=height)
+        finally:
+            self._scopes.put(scope)
+
+    def submit(self, make_fig, *args, width=CHART_WIDTH, height=CHART_HEIGHT):
+        '''
+        Builds the figure with make_fig(*args) and renders it on the pool.
+        Returns a future whose result is the PNG bytes, or the error of that chart alone.
+        '''
+        def build_and_render():
+            return self.render(make_fig(*args), width, height)
+
+        return self._executor.submit(build_and_render)
+
+
+_chart_renderer = None
+_chart_renderer_lock = threading.Lock()
+
+
+def get_chart_renderer():
+    global _chart_renderer
+    with _chart_renderer_lock:
+        if _chart_renderer is None:
+            _chart_renderer = ChartRenderer()
+
+        return _chart_renderer
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from collections import defaultdict
 
 
@@ -21,6 +22,84 @@ REVERSE_METRICS = [
 
 in_production = os.getenv('GCP_PROJECT')
 
+# anomaly queries running at once in the process, however many accounts and assets are prepared concurrently
+MAX_CONCURRENT_QUERIES = int(os.getenv('MAX_CONCURRENT_QUERIES', '8'))
+
+# seconds a dataset's table schemas are reused before INFORMATION_SCHEMA is read again
+SCHEMA_CATALOG_TTL_SECONDS = int(os.getenv('SCHEMA_CATALOG_TTL_SECONDS', '300'))
+
+MAX_CONCURRENT_ASSETS = int(os.getenv('MAX_CONCURRENT_ASSETS', '4'))
+
+MAX_CONCURRENT_ACCOUNTS = int(os.getenv('MAX_CONCURRENT_ACCOUNTS', '4'))
+
+CHART_RENDER_WORKERS = int(os.getenv('CHART_RENDER_WORKERS', '3'))
+
+# 'kaleido' renders anomaly card charts as plotly images, 'native' builds them as PowerPoint charts
+ANOMALY_CHART_MODE = os.getenv('ANOMALY_CHART_MODE', 'kaleido')
+
+if ANOMALY_CHART_MODE not in ('kaleido', 'native'):
+    raise ValueError(f"Invalid anomaly chart mode - {ANOMALY_CHART_MODE}")
+
+# hourly alerts read only the hours since the last run and skip alerts already posted
+HOURLY_INCREMENTAL = os.getenv('HOURLY_INCREMENTAL', 'false').lower() == 'true'
+
+# incremental hourly state goes to this GCS bucket, or to HOURLY_STATE_DIR when it is not set
+HOURLY_STATE_BUCKET = os.getenv('HOURLY_STATE_BUCKET')
+
+HOURLY_STATE_DIR = os.getenv('HOURLY_STATE_DIR', os.path.join(tempfile.gettempdir(), 'watchdog_hourly_state'))
+
+# dtype of the metric columns of anomaly frames; float32 halves their memory at about 7 significant digits
+ANOMALY_FLOAT_DTYPE = os.getenv('ANOMALY_FLOAT_DTYPE', 'float64')
+
+# on-disk Parquet cache of anomaly tables, 0 turns it off. /tmp counts against a Cloud Function's memory
+ANOMALY_CACHE_MAX_BYTES = int(os.getenv('ANOMALY_CACHE_MAX_BYTES', str(256 * 2 ** 20)))
+
+ANOMALY_CACHE_DIR = os.getenv('ANOMALY_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'watchdog_anomaly_cache'))
+
+# a cached table that has been written to is read again in full. With ANOMALY_CACHE_TOP_UP=true only
+# its last ANOMALY_CACHE_REFRESH_DAYS days are, which serves stale rows if older rows were rewritten
+# (a backfill, or a model refit changing historical forecasts), so only use it for append-only tables
+ANOMALY_CACHE_TOP_UP = os.getenv('ANOMALY_CACHE_TOP_UP', 'false').lower() == 'true'
+
+ANOMALY_CACHE_REFRESH_DAYS = int(os.getenv('ANOMALY_CACHE_REFRESH_DAYS', '7'))
+
+# RCA association rules per account, from the ASSOCIATION_RULES_PATH JSON file or, when 'bigquery',
+# from the ASSOCIATION_RULES_TABLE table next to config.account_assets
+ASSOCIATION_RULES_SOURCE = os.getenv('ASSOCIATION_RULES_SOURCE', 'file')
+
+ASSOCIATION_RULES_PATH = os.getenv('ASSOCIATION_RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'association_rules.json'))
+
+ASSOCIATION_RULES_TABLE = os.getenv('ASSOCIATION_RULES_TABLE', f'{WATCHDOG_PROJECT_ID}.config.association_rules')
+
+# how often a process checks the rules source for changes
+ASSOCIATION_RULES_CHECK_SECONDS = int(os.getenv('ASSOCIATION_RULES_CHECK_SECONDS', '60'))
+
+
+SLACK_BOT_TOKEN = os.getenv('SLACK_BOT_TOKEN', 'replace_slack_bot_token')
+
+# Slack Web API base url, pointed at a local fake server to test delivery
+SLACK_API_URL = os.getenv('SLACK_API_URL', 'https://slack.com/api/')
+
+# times a Slack call rate limited with a 429 is retried, after waiting its Retry-After
+SLACK_MAX_RETRIES = int(os.getenv('SLACK_MAX_RETRIES', '5'))
+
+# channels a SlackDeliveryQueue delivers to at once; each channel's items go out one at a time, in order
+SLACK_UPLOAD_WORKERS = int(os.getenv('SLACK_UPLOAD_WORKERS', '4'))
+
+
+SMTP_USERNAME = os.getenv('ALERT_SMTP_USERNAME', 'your_smtp_username')
+
+SMTP_PASSWORD = os.getenv('ALERT_SMTP_PASSWORD', 'your_smtp_password')
+
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp-mail.outlook.com')
+
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+
+# 'false' for a local server without TLS, e.g. python -m smtpd -n -c DebuggingServer localhost:1025
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'true').lower() == 'true'
+
+SMTP_TIMEOUT = int(os.getenv('SMTP_TIMEOUT', '60'))
+
 
 class Kpi:
     def __init__(self, data_source, dimension, dim_label, metric):
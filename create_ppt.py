@@ -2,10 +2,11 @@ from pptx import Presentation
 from pptx.util import Inches
 from bigquery import get_bigquery_client
 from data import get_asset_df
+from helper import bounded_map
 from kpi_slide import add_kpi_slide
-from anomaly_slide import add_anomaly_slide
-from rca_slide import add_rca_slide
-from config import kpi_list_dict
+from anomaly_slide import add_anomaly_slide, AnomalyCards
+from config import kpi_list_dict, MAX_CONCURRENT_ASSETS
+from concurrent.futures import ThreadPoolExecutor
 
 
 BASE_FONT_SIZE = 18
@@ -30,15 +31,37 @@ def get_anomaly_type_counts(asset_df):
     return negative_warning_count, negative_critical_count
 
 
-def add_asset_slides(ppt, account, project_id, dataset_id, asset, period):
-    print(f"\n\nGetting data for {asset}...")
-    asset_df, errors = get_asset_df(account, project_id, dataset_id, period)
+def has_anomaly_slide(account, asset):
+    return not (account == 'Athletic Greens' and asset == 'Overall')
+
+
+class PreparedAsset:
+    '''
+    An asset's data and anomaly cards, computed before any of its slides are added to the deck.
+    '''
+    def __init__(self, account, project_id, dataset_id, asset, period):
+        print(f"\n\nGetting data for {asset}...")
+        self.asset_df, self.errors = get_asset_df(account, project_id, dataset_id, period)
+        self.anomaly_cards = None
+
+        if self.asset_df.empty:
+            return
+
+        print(f"Got data for {asset}")
+
+        if has_anomaly_slide(account, asset):
+            self.anomaly_cards = AnomalyCards(self.asset_df, kpi_list_dict[account])
+
+
+def add_asset_slides(ppt, account, project_id, dataset_id, asset, period, prepared_asset=None):
+    if prepared_asset is None:
+        prepared_asset = PreparedAsset(account, project_id, dataset_id, asset, period)
+
+    asset_df = prepared_asset.asset_df
     if asset_df.empty:
         print(f"asset_df is empty for {account} {asset}")
         return 0, 0, 0
 
-    print(f"Got data for {asset}")
-
     kpi_list = kpi_list_dict[account]
     if period == 'weekly':
         add_kpi_slide(ppt, period, asset, asset_df, kpi_list)
@@ -47,14 +70,15 @@ def add_asset_slides(ppt, account, project_id, dataset_id, asset, period):
     negative_critical_count = 0
     total_count = 0
 
-    if not (account == 'Athletic Greens' and asset == 'Overall'):
+    if has_anomaly_slide(account, asset):
     # if True:
         print(f"\n\nPreparing anomaly slide for {asset}...")
-        w, c, t = add_anomaly_slide(ppt, period, asset, asset_df, kpi_list)
+        w, c, t = add_anomaly_slide(ppt, period, asset, asset_df, kpi_list, prepared_asset.anomaly_cards)
         negative_warning_count += w
         negative_critical_count += c
         total_count += t
-        # add_rca_slide(ppt, period, asset_df)
+        # from rca_slide import add_rca_slide
+        # add_rca_slide(ppt, period, asset_df, account)
 
     return negative_warning_count, negative_critical_count, total_count
 
@@ -82,10 +106,16 @@ def create_ppt(project_id, account, period):
     negative_critical_count = 0
     total_count = 0
 
-    for i, row in dataset_df.iterrows():
-        w, c, t = add_asset_slides(ppt, account, project_id, dataset_id=row['dataset_id'], asset=row['asset'], period=period)
-        negative_warning_count += w
-        negative_critical_count += c
-        total_count += t
+    def prepare(row):
+        return PreparedAsset(account, project_id, row['dataset_id'], row['asset'], period)
+
+    # Assets are prepared concurrently, slides are added one asset at a time in sequence_no order
+    rows = [row for i, row in dataset_df.iterrows()]
+    with ThreadPoolExecutor(max_workers=max(1, MAX_CONCURRENT_ASSETS)) as executor:
+        for row, prepared_asset in zip(rows, bounded_map(executor, prepare, rows, MAX_CONCURRENT_ASSETS)):
+            w, c, t = add_asset_slides(ppt, account, project_id, dataset_id=row['dataset_id'], asset=row['asset'], period=period, prepared_asset=prepared_asset)
+            negative_warning_count += w
+            negative_critical_count += c
+            total_count += t
 
     return ppt, negative_warning_count, negative_critical_count, total_count
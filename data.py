@@ -1,74 +1,60 @@
-from helper import get_anomaly_type, delta_pct, get_anomaly_df, get_table_details, check_critical, get_color, get_tables, check_warning, is_none
+from helper import get_anomaly_type, get_table_details, check_critical, get_color, get_tables, check_warning
+from helper import fetch_anomaly_dfs, RecordFrameBuilder, delta_pct_array, get_anomaly_type_array, get_color_array
+from helper import get_date_col, clip_forecasts, get_group_slices
 import numpy as np
 import pandas as pd
 from dates import yesterday, sdlw, get_previous_week_start_date_end_date
-from datetime import date, datetime, timedelta
+from datetime import date, timedelta
 
 
 year_ago = date.today() - timedelta(days=365)
 six_months_ago = date.today() - timedelta(days=6*30)
 three_months_ago = date.today() - timedelta(days=3*30)
 
+MIN_SERIES_POINTS = 10 # Change to 15
 
-def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.nan, dim_label=np.nan):
 
+def get_current_prev_dates(period, weekday=None):
     if period == 'daily':
-        date_col = 'Date'
-        weekday = None
-        current_date = yesterday.strftime('%Y-%m-%d')
-        prev_date = sdlw.strftime('%Y-%m-%d')
+        current_date = yesterday
+        prev_date = sdlw
     elif period == 'weekly':
-        date_col = 'Week'
-        weekday = pd.to_datetime(anomaly_df[date_col]).dt.weekday.iloc[0]
         week_start, week_end = get_previous_week_start_date_end_date(weekday=weekday)
         prev_week_start, prev_week_end = get_previous_week_start_date_end_date(weekday=weekday, current_date=week_start)
-        current_date = week_start.strftime('%Y-%m-%d')
-        prev_date = prev_week_start.strftime('%Y-%m-%d')
+        current_date = week_start
+        prev_date = prev_week_start
     else:
         raise Exception(f"Invalid period - {period}")
 
-    anomaly_df[f'{metric}_yhat'] = np.maximum(anomaly_df[f'{metric}_yhat'], 0)
-    anomaly_df[f'{metric}_yhat_upper'] = np.maximum(anomaly_df[f'{metric}_yhat_upper'], 0)
-    anomaly_df[f'{metric}_yhat_lower'] = np.maximum(anomaly_df[f'{metric}_yhat_lower'], 0)
+    return pd.Timestamp(current_date), pd.Timestamp(prev_date)
 
-    not_null_mask = anomaly_df[metric].notnull()
-    if anomaly_df[not_null_mask].shape[0] < 10: # Change to 15
-        return
 
-    current_date_mask = anomaly_df[date_col] == current_date
-    current_value = anomaly_df[current_date_mask][metric].iloc[0]
+def get_date_position(dates, value, side='left'):
+    return np.searchsorted(dates, pd.Timestamp(value).to_datetime64(), side=side)
 
-    year_mask = (anomaly_df[date_col] >= year_ago.strftime('%Y-%m-%d')) & (anomaly_df[date_col] <= current_date)
-    year_maximum = anomaly_df[year_mask][metric].max()
-    is_year_maximum = current_value == year_maximum
 
-    six_month_mask = (anomaly_df[date_col] >= six_months_ago.strftime('%Y-%m-%d')) & (anomaly_df[date_col] <= current_date)
-    six_month_maximum = anomaly_df[six_month_mask][metric].max()
-    is_six_month_maximum = current_value == six_month_maximum
+def get_date_slice(dates, value):
+    '''
+    Start and end positions of the rows on date value, in an array of dates in ascending order.
+    '''
+    return get_date_position(dates, value, 'left'), get_date_position(dates, value, 'right')
 
-    three_month_mask = (anomaly_df[date_col] >= three_months_ago.strftime('%Y-%m-%d')) & (anomaly_df[date_col] <= current_date)
-    three_month_maximum = anomaly_df[three_month_mask][metric].max()
-    is_three_month_maximum = current_value == three_month_maximum
 
-    current_anomaly_df = anomaly_df[anomaly_df[date_col] == current_date]
-    prev_anomaly_df = anomaly_df[anomaly_df[date_col] == prev_date]
+def get_date_labels(dates, period):
+    '''
+    Chart labels of datetime64 dates - YYYY-MM-DD for daily, W and the strftime('%U') week number for weekly.
+    '''
+    dates = pd.DatetimeIndex(dates)
+    if period == 'weekly':
+        # %U counts weeks from the year's first Sunday, with the days before it in week 00
+        sunday_weekday = (dates.weekday.values + 1) % 7
+        weeks = (dates.dayofyear.values - 1 + 7 - sunday_weekday) // 7
+        return np.char.add('W', np.char.zfill(weeks.astype(str), 2))
 
-    if not current_anomaly_df.empty:
-        y = current_anomaly_df[metric].iloc[-1]
-        yhat = current_anomaly_df[f'{metric}_yhat'].iloc[-1]
-        yhat_upper = current_anomaly_df[f'{metric}_yhat_upper'].iloc[-1]
-        yhat_lower = current_anomaly_df[f'{metric}_yhat_lower'].iloc[-1]
-    else:
-        y = 0
-        yhat = prev_anomaly_df[f'{metric}_yhat'].iloc[-1]
-        yhat_upper = prev_anomaly_df[f'{metric}_yhat_upper'].iloc[-1]
-        yhat_lower = prev_anomaly_df[f'{metric}_yhat_lower'].iloc[-1]
+    return np.datetime_as_string(dates.values, unit='D')
 
-    if prev_anomaly_df.empty:
-        y_prev = 0
-    else:
-        y_prev = prev_anomaly_df[metric].iloc[-1]
 
+def make_data_dict(asset, data_source, period, weekday, dimension, dim_label, metric, y, y_prev, yhat, yhat_upper, yhat_lower, is_year_maximum, is_six_month_maximum, is_three_month_maximum):
     threshold = (yhat_upper - yhat_lower)/2
     y_prev_upper = y_prev + threshold
     y_prev_lower = y_prev - threshold
@@ -108,107 +94,356 @@ def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.n
         'is_three_month_maximum': is_three_month_maximum,
     }
 
+    return data_dict
+
+
+def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.nan, dim_label=np.nan):
+
     if period == 'daily':
-        mask = three_month_mask & not_null_mask
+        date_col = 'Date'
+        weekday = None
+    elif period == 'weekly':
+        date_col = 'Week'
+        weekday = anomaly_df[date_col].iloc[0].weekday()
     else:
-        mask = six_month_mask & not_null_mask
+        raise Exception(f"Invalid period - {period}")
 
-    if period == 'weekly':
-        data_dict['xaxis_data'] = anomaly_df[mask][date_col].apply(lambda d: f"W{datetime.strptime(d, '%Y-%m-%d').date().strftime('%U')}")
+    current_date, prev_date = get_current_prev_dates(period, weekday)
+
+    not_null_mask = anomaly_df[metric].notnull()
+    if not_null_mask.sum() < MIN_SERIES_POINTS:
+        return
+
+    # rows are in date order (normalize_anomaly_df), so every window is a slice found by binary search
+    dates = anomaly_df[date_col].values
+    current_start, current_end = get_date_slice(dates, current_date)
+    prev_start, prev_end = get_date_slice(dates, prev_date)
+
+    y_series = anomaly_df[metric]
+    current_value = y_series.iloc[current_start:current_end].iloc[0]
+
+    year_maximum = y_series.iloc[get_date_position(dates, year_ago):current_end].max()
+    is_year_maximum = current_value == year_maximum
+
+    six_month_start = get_date_position(dates, six_months_ago)
+    six_month_maximum = y_series.iloc[six_month_start:current_end].max()
+    is_six_month_maximum = current_value == six_month_maximum
+
+    three_month_start = get_date_position(dates, three_months_ago)
+    three_month_maximum = y_series.iloc[three_month_start:current_end].max()
+    is_three_month_maximum = current_value == three_month_maximum
+
+    current_anomaly_df = anomaly_df.iloc[current_start:current_end]
+    prev_anomaly_df = anomaly_df.iloc[prev_start:prev_end]
+
+    if not current_anomaly_df.empty:
+        y = current_anomaly_df[metric].iloc[-1]
+        yhat = current_anomaly_df[f'{metric}_yhat'].iloc[-1]
+        yhat_upper = current_anomaly_df[f'{metric}_yhat_upper'].iloc[-1]
+        yhat_lower = current_anomaly_df[f'{metric}_yhat_lower'].iloc[-1]
+    else:
+        y = 0
+        yhat = prev_anomaly_df[f'{metric}_yhat'].iloc[-1]
+        yhat_upper = prev_anomaly_df[f'{metric}_yhat_upper'].iloc[-1]
+        yhat_lower = prev_anomaly_df[f'{metric}_yhat_lower'].iloc[-1]
+
+    if prev_anomaly_df.empty:
+        y_prev = 0
     else:
-        data_dict['xaxis_data'] = anomaly_df[mask][date_col]
-    data_dict['yaxis_data'] = anomaly_df[mask][metric]
-    data_dict['trend_data'] = anomaly_df[mask][f'{metric}_trend']
-    data_dict['yhat_data'] = anomaly_df[mask][f'{metric}_yhat']
-    data_dict['yhat_upper_data'] = anomaly_df[mask][f'{metric}_yhat_upper']
-    data_dict['yhat_lower_data'] = anomaly_df[mask][f'{metric}_yhat_lower']
-    data_dict['yhat_anomaly_type_data'] = anomaly_df[mask].apply(lambda row: get_anomaly_type(y=row[metric], upper=row[f'{metric}_yhat_upper'], lower=row[f'{metric}_yhat_lower']), axis=1)
+        y_prev = prev_anomaly_df[metric].iloc[-1]
+
+    data_dict = make_data_dict(asset, data_source, period, weekday, dimension, dim_label, metric, y, y_prev, yhat, yhat_upper, yhat_lower, is_year_maximum, is_six_month_maximum, is_three_month_maximum)
+
+    chart_start = three_month_start if period == 'daily' else six_month_start
+    chart_df = anomaly_df.iloc[chart_start:current_end]
+    chart_df = chart_df[chart_df[metric].notnull()]
+
+    data_dict['xaxis_data'] = pd.Series(get_date_labels(chart_df[date_col].values, period), index=chart_df.index, name=date_col)
+    data_dict['yaxis_data'] = chart_df[metric]
+    data_dict['trend_data'] = chart_df[f'{metric}_trend']
+    data_dict['yhat_data'] = chart_df[f'{metric}_yhat']
+    data_dict['yhat_upper_data'] = chart_df[f'{metric}_yhat_upper']
+    data_dict['yhat_lower_data'] = chart_df[f'{metric}_yhat_lower']
+    data_dict['yhat_anomaly_type_data'] = pd.Series(get_anomaly_type_array(chart_df[metric], chart_df[f'{metric}_yhat_upper'], chart_df[f'{metric}_yhat_lower']), index=chart_df.index)
 
     return data_dict
 
 
-def get_revenue_impact_for_row(row, asset_df):
-    # print(row['data_source'], row['dimension'], row['dim_label'], row['metric'])
+def get_data_dict_or_error(asset, data_source, period, anomaly_df, metric, dimension=np.nan, dim_label=np.nan):
+    try:
+        return get_data_dict(asset, data_source, period, anomaly_df, metric, dimension, dim_label), None
+    except Exception as e:
+        return None, e
 
-    is_subscription_type = 'New_Subscription' in asset_df['dim_label'].unique()
 
-    if row['data_source'] == 'Google Ads':
-        data_source_mask = asset_df['data_source'] == 'Google Analytics'
-    elif row['data_source'] == 'Google Analytics' and is_none(row['dimension']):
-        data_source_mask = asset_df['data_source'] == 'Ecommerce'
+def get_serial_data_dicts(asset, data_source, period, anomaly_df, metrics, dimension, groups):
+    series_dimension = np.nan if dimension is None else dimension
+    for dim_label, start, end in groups:
+        group_df = anomaly_df.iloc[start:end]
+        for metric in metrics:
+            data_dict, e = get_data_dict_or_error(asset, data_source, period, group_df, metric, series_dimension, dim_label)
+            yield dim_label, metric, data_dict, e
+
+
+def get_batch_data_dicts(asset, data_source, period, anomaly_df, metrics, dimension, groups):
+    '''
+    Computes the get_data_dict statistics for every (dim_label, metric) series of a table in one pass.
+    Date masks and current/previous rows are computed once per table, maxima and anomaly types once
+    per metric, so the per-series work is only slicing out the chart data.
+    Series that hit an edge case (no row for the current date, no chart points) are handed to get_data_dict.
+    Returns the list of (dim_label, metric, data_dict, exception) in the serial order.
+    '''
+    if period == 'daily':
+        date_col = 'Date'
+        chart_months_ago = three_months_ago
+    elif period == 'weekly':
+        date_col = 'Week'
+        chart_months_ago = six_months_ago
     else:
-        data_source_mask = asset_df['data_source'] == row['data_source']
-
-    if is_none(row['dimension']):
-        if row['data_source'] == 'Google Ads':
-            dimension_mask = asset_df['dimension'] == 'Source_medium'
-        elif row['data_source'] == 'Facebook':
-            dimension_mask = asset_df['dimension'].isnull()
-        elif row['metric'] == 'Revenue':
-            dimension_mask = asset_df['dimension'].isnull()
-        elif row['metric'] == 'Cancelled_Subscriptions':
-            dimension_mask = asset_df['dimension'] == 'User_Type'
-        else:
-            if is_subscription_type:
-                dimension_mask = asset_df['dimension'] == 'User_Type'
-            else:
-                dimension_mask = asset_df['dimension'].isnull()
+        raise Exception(f"Invalid period - {period}")
+
+    index = anomaly_df.index
+    series_dimension = np.nan if dimension is None else dimension
+
+    # rows are sorted by (dim_label, date), each group is a contiguous run of rows
+    dim_labels = [dim_label for dim_label, _, _ in groups]
+    group_starts = np.array([start for _, start, _ in groups], dtype=np.intp)
+    group_ends = np.array([end for _, _, end in groups], dtype=np.intp)
+    n_groups = len(groups)
+    codes = np.repeat(np.arange(n_groups), group_ends - group_starts)
+
+    def get_group_df(group):
+        return anomaly_df.iloc[group_starts[group]:group_ends[group]]
+
+    dates = anomaly_df[date_col]
+    if period == 'weekly':
+        group_weekdays = [dates.iloc[start].weekday() for start in group_starts]
     else:
-        dimension_mask = asset_df['dimension'] == row['dimension']
-
-    if is_none(row['dim_label']):
-        if row['data_source'] == 'Google Ads':
-            dim_label_mask = asset_df['dim_label'] == 'google / cpc'
-            # print('using google / cpc revenue')
-        elif row['data_source'] == 'Facebook':
-            dim_label_mask = asset_df['dim_label'].isnull()
-        elif row['metric'] == 'Revenue':
-            dim_label_mask = asset_df['dim_label'].isnull()
-        elif row['metric'] == 'Cancelled_Subscriptions':
-            dim_label_mask = asset_df['dim_label'] == 'New_Subscription'
-            # print('using New_Subscription revenue')
-        else:
-            if is_subscription_type:
-                dim_label_mask = asset_df['dim_label'] == 'New_Subscription'
+        group_weekdays = [None] * n_groups
+    date_labels = get_date_labels(dates.values, period)
+
+    period_dates = {}
+    group_current_dates = np.full(n_groups, np.datetime64('NaT'), dtype='datetime64[ns]')
+    group_prev_dates = np.full(n_groups, np.datetime64('NaT'), dtype='datetime64[ns]')
+    for group, weekday in enumerate(group_weekdays):
+        if weekday not in period_dates:
+            period_dates[weekday] = get_current_prev_dates(period, weekday)
+        group_current_dates[group], group_prev_dates[group] = period_dates[weekday]
+
+    current_dates = pd.Series(group_current_dates[codes], index=index)
+    prev_dates = pd.Series(group_prev_dates[codes], index=index)
+
+    current_mask = (dates == current_dates).values
+    prev_mask = (dates == prev_dates).values
+    up_to_current_mask = (dates <= current_dates).values
+    window_masks = {
+        'year': (dates >= pd.Timestamp(year_ago)).values & up_to_current_mask,
+        'six_month': (dates >= pd.Timestamp(six_months_ago)).values & up_to_current_mask,
+        'three_month': (dates >= pd.Timestamp(three_months_ago)).values & up_to_current_mask,
+    }
+    chart_mask = (dates >= pd.Timestamp(chart_months_ago)).values & up_to_current_mask
+
+    current_positions = pd.Series(np.flatnonzero(current_mask)).groupby(codes[current_mask])
+    first_current_positions = current_positions.first().to_dict()
+    last_current_positions = current_positions.last().to_dict()
+    last_prev_positions = pd.Series(np.flatnonzero(prev_mask)).groupby(codes[prev_mask]).last().to_dict()
+
+    results = [[None] * len(metrics) for _ in range(n_groups)]
+
+    for metric_i, metric in enumerate(metrics):
+        columns = [metric, f'{metric}_yhat', f'{metric}_yhat_upper', f'{metric}_yhat_lower', f'{metric}_trend']
+        if any(column not in anomaly_df.columns for column in columns):
+            for group in range(n_groups):
+                data_dict, e = get_data_dict_or_error(asset, data_source, period, get_group_df(group), metric, series_dimension, dim_labels[group])
+                results[group][metric_i] = (data_dict, e)
+            continue
+
+        y_series = anomaly_df[metric]
+        y_values = y_series.values
+        yhat_values = anomaly_df[f'{metric}_yhat'].values
+        yhat_upper_values = anomaly_df[f'{metric}_yhat_upper'].values
+        yhat_lower_values = anomaly_df[f'{metric}_yhat_lower'].values
+        trend_values = anomaly_df[f'{metric}_trend'].values
+
+        not_null_mask = y_series.notnull().values
+        not_null_counts = np.bincount(codes[not_null_mask], minlength=n_groups)
+
+        maxima = {}
+        for window, window_mask in window_masks.items():
+            window_maxima = y_series[window_mask].groupby(codes[window_mask]).max()
+            maxima[window] = dict(zip(window_maxima.index, window_maxima.values))
+
+        anomaly_types = get_anomaly_type_array(y_values, yhat_upper_values, yhat_lower_values)
+
+        metric_chart_positions = np.flatnonzero(chart_mask & not_null_mask)
+        chart_codes = codes[metric_chart_positions]
+        chart_starts = np.searchsorted(chart_codes, np.arange(n_groups), side='left')
+        chart_ends = np.searchsorted(chart_codes, np.arange(n_groups), side='right')
+
+        for group in range(n_groups):
+            if not_null_counts[group] < MIN_SERIES_POINTS:
+                results[group][metric_i] = (None, None)
+                continue
+
+            chart_positions = metric_chart_positions[chart_starts[group]:chart_ends[group]]
+            if group not in first_current_positions or len(chart_positions) == 0:
+                data_dict, e = get_data_dict_or_error(asset, data_source, period, get_group_df(group), metric, series_dimension, dim_labels[group])
+                results[group][metric_i] = (data_dict, e)
+                continue
+
+            current_value = y_values[first_current_positions[group]]
+            current_position = last_current_positions[group]
+            y = y_values[current_position]
+            yhat = yhat_values[current_position]
+            yhat_upper = yhat_upper_values[current_position]
+            yhat_lower = yhat_lower_values[current_position]
+
+            if group in last_prev_positions:
+                y_prev = y_values[last_prev_positions[group]]
             else:
-                dim_label_mask = asset_df['dim_label'].isnull()
-            # print('using New_Subscription revenue')
+                y_prev = 0
+
+            data_dict = make_data_dict(
+                asset, data_source, period, group_weekdays[group], series_dimension, dim_labels[group], metric,
+                y, y_prev, yhat, yhat_upper, yhat_lower,
+                is_year_maximum=current_value == maxima['year'].get(group, np.nan),
+                is_six_month_maximum=current_value == maxima['six_month'].get(group, np.nan),
+                is_three_month_maximum=current_value == maxima['three_month'].get(group, np.nan),
+            )
+
+            chart_index = index[chart_positions]
+            data_dict['xaxis_data'] = pd.Series(date_labels[chart_positions], index=chart_index, name=date_col)
+            data_dict['yaxis_data'] = pd.Series(y_values[chart_positions], index=chart_index, name=metric)
+            data_dict['trend_data'] = pd.Series(trend_values[chart_positions], index=chart_index, name=f'{metric}_trend')
+            data_dict['yhat_data'] = pd.Series(yhat_values[chart_positions], index=chart_index, name=f'{metric}_yhat')
+            data_dict['yhat_upper_data'] = pd.Series(yhat_upper_values[chart_positions], index=chart_index, name=f'{metric}_yhat_upper')
+            data_dict['yhat_lower_data'] = pd.Series(yhat_lower_values[chart_positions], index=chart_index, name=f'{metric}_yhat_lower')
+            data_dict['yhat_anomaly_type_data'] = pd.Series(anomaly_types[chart_positions], index=chart_index)
+
+            results[group][metric_i] = (data_dict, None)
+
+    return [
+        (dim_labels[group], metric, data_dict, e)
+        for group in range(n_groups)
+        for metric, (data_dict, e) in zip(metrics, results[group])
+    ]
+
+
+def get_data_dicts(asset, data_source, period, anomaly_df, metrics, dimension=None):
+    '''
+    Yields (dim_label, metric, data_dict, exception) for every series of a table, in the order of
+    looping get_data_dict over anomaly_df.groupby(dimension) and metrics.
+    The forecasts are clipped and the rows sorted by (dimension, date) once for the table,
+    and each series is read from a slice of the sorted rows.
+    '''
+    clip_forecasts(anomaly_df, metrics)
+    if dimension is None:
+        groups = [(np.nan, 0, anomaly_df.shape[0])]
     else:
-        dim_label_mask = asset_df['dim_label'] == row['dim_label']
-        # print(f"using {row['dim_label']} revenue")
+        anomaly_df, groups = get_group_slices(anomaly_df, dimension, get_date_col(period))
 
-    revenue_mask = asset_df['metric'].isin(['Revenue', 'Gross_Revenue', 'Total_Sales', 'Ad_Sales'])
+    if period in ['daily', 'weekly']:
+        series_results = get_batch_data_dicts(asset, data_source, period, anomaly_df, metrics, dimension, groups)
+    else:
+        # get_data_dict reports the invalid period as the error of every series
+        series_results = get_serial_data_dicts(asset, data_source, period, anomaly_df, metrics, dimension, groups)
 
-    filtered_df = asset_df[data_source_mask & dimension_mask & dim_label_mask & revenue_mask]
-    if filtered_df.shape[0] > 1:
+    for series_result in series_results:
+        yield series_result
+
+
+REVENUE_METRICS = ['Revenue', 'Gross_Revenue', 'Total_Sales', 'Ad_Sales']
+
+REVENUE_INDEX_COLUMNS = ['data_source', 'dimension', 'dim_label']
+
+
+def get_revenue_index(asset_df):
+    '''
+    Revenue rows of an asset keyed by (data_source, dimension, dim_label), with null dimension/dim_label as keys.
+    Keys with more than one revenue row are flagged so lookups against them can fail like the row-wise version did.
+    '''
+    revenue_df = asset_df.loc[asset_df['metric'].isin(REVENUE_METRICS), REVENUE_INDEX_COLUMNS + ['y', 'yhat']]
+    revenue_df = revenue_df.rename(columns={'y': 'revenue', 'yhat': 'revenue_yhat'})
+    revenue_df['has_duplicates'] = revenue_df.duplicated(REVENUE_INDEX_COLUMNS, keep=False)
+    revenue_index = revenue_df.drop_duplicates(REVENUE_INDEX_COLUMNS, keep='first')
+
+    return revenue_index
+
+
+def get_revenue_lookup_keys(asset_df):
+    '''
+    The (data_source, dimension, dim_label) of the revenue row each row's impact is measured against.
+    Google Ads rows use Google Analytics google / cpc revenue, overall Google Analytics rows use Ecommerce revenue,
+    and overall subscription metrics use New_Subscription revenue.
+    '''
+    is_subscription_type = 'New_Subscription' in asset_df['dim_label'].unique()
+
+    data_source = asset_df['data_source']
+    metric = asset_df['metric']
+    is_google_ads = data_source == 'Google Ads'
+    is_facebook = data_source == 'Facebook'
+    is_revenue = metric == 'Revenue'
+    is_cancelled_subscriptions = metric == 'Cancelled_Subscriptions'
+    no_dimension = asset_df['dimension'].isnull()
+
+    def overall_key(google_ads_key, subscription_key):
+        key = pd.Series(subscription_key if is_subscription_type else None, index=asset_df.index, dtype=object)
+        key[is_cancelled_subscriptions] = subscription_key
+        key[is_revenue] = None
+        key[is_facebook] = None
+        key[is_google_ads] = google_ads_key
+        return key
+
+    keys_df = pd.DataFrame(index=asset_df.index)
+    keys_df['data_source'] = data_source.mask(is_google_ads, 'Google Analytics').mask((data_source == 'Google Analytics') & no_dimension, 'Ecommerce')
+    keys_df['dimension'] = asset_df['dimension'].astype(object).where(~no_dimension, overall_key('Source_medium', 'User_Type'))
+    keys_df['dim_label'] = asset_df['dim_label'].astype(object).where(asset_df['dim_label'].notnull(), overall_key('google / cpc', 'New_Subscription'))
+
+    return keys_df
+
+
+def get_revenue_impact(asset_df):
+    if asset_df.empty:
+        return pd.Series(dtype=float, index=asset_df.index)
+
+    revenue_index = get_revenue_index(asset_df)
+    keys_df = get_revenue_lookup_keys(asset_df)
+    joined_df = keys_df.merge(revenue_index, how='left', on=REVENUE_INDEX_COLUMNS, indicator=True)
+
+    is_matched = (joined_df['_merge'] == 'both').values
+    has_duplicates = is_matched & joined_df['has_duplicates'].fillna(False).values.astype(bool)
+    if has_duplicates.any():
+        row = asset_df.iloc[np.flatnonzero(has_duplicates)[0]]
         raise ValueError(f'Error while calculating Revenue impact: More than one rows for row - {row}')
-    elif filtered_df.empty:
-        # print(f' No revenue impact for - {row}')
-        return 0
-    else:
-        revenue = filtered_df['y'].iloc[0]
-        revenue_yhat = filtered_df['yhat'].iloc[0]
-        if revenue_yhat == 0:
-            print('revenue_prev is 0')
-            # print(revenue)
-            return abs(revenue)
-        else:
-            if np.isinf(row['delta']) or row['metric'] == 'ACOS':
-            # if np.isinf(row['delta']):
-                revenue_impact = revenue - revenue_yhat
-            else:
-                revenue_impact = revenue_yhat * row['delta']/100
-                
-            max_revenue_impact = (revenue - revenue_yhat) * 10
-            # print(f"revenue_yhat is {revenue_yhat} delta is {row['delta']/100}")
-            # print(abs(revenue_impact))
-            return min(abs(revenue_impact), abs(max_revenue_impact))
+
+    if not is_matched.any():
+        return pd.Series(0, index=asset_df.index)
+
+    revenue = joined_df['revenue'].values.astype(float)
+    revenue_yhat = joined_df['revenue_yhat'].values.astype(float)
+    delta = asset_df['delta'].values.astype(float)
+    is_acos = (asset_df['metric'] == 'ACOS').values
+
+    zero_yhat_count = (is_matched & (revenue_yhat == 0)).sum()
+    if zero_yhat_count:
+        print(f'revenue_prev is 0 for {zero_yhat_count} rows')
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        revenue_impact = np.abs(np.where(np.isinf(delta) | is_acos, revenue - revenue_yhat, revenue_yhat * delta/100))
+        max_revenue_impact = np.abs((revenue - revenue_yhat) * 10)
+    # min() keeps the first argument unless the second is smaller, so a NaN impact stays NaN
+    capped_revenue_impact = np.where(max_revenue_impact < revenue_impact, max_revenue_impact, revenue_impact)
+
+    revenue_impact = np.where(revenue_yhat == 0, np.abs(revenue), capped_revenue_impact)
+    revenue_impact = np.where(is_matched, revenue_impact, 0)
+
+    return pd.Series(revenue_impact, index=asset_df.index)
 
 
 def get_asset_df(account, project_id, dataset_id, period):
     errors = []
 
-    asset_df = pd.DataFrame(
+    asset_builder = RecordFrameBuilder(
         columns=[
             'asset',
             'data_source',
@@ -234,10 +469,8 @@ def get_asset_df(account, project_id, dataset_id, period):
 
     table_ids = get_tables(project_id, dataset_id, period)
 
-    for table_id in table_ids:
-        try:
-            anomaly_df = get_anomaly_df(project_id, dataset_id, table_id, period)
-        except Exception as e:
+    for table_id, anomaly_df, e in fetch_anomaly_dfs(project_id, dataset_id, table_ids, period):
+        if e is not None:
             error_msg = f"Error while getting data for - {project_id} {dataset_id} {table_id} : {e}"
             print(error_msg)
             errors.append(error_msg)
@@ -245,41 +478,29 @@ def get_asset_df(account, project_id, dataset_id, period):
 
         data_source, dim, metrics = get_table_details(project_id, dataset_id, table_id)
 
-        if dim is None:
-            for metric in metrics:
-                try:
-                    data_dict = get_data_dict(dataset_id, data_source, period, anomaly_df, metric)
-                except Exception as e:
+        for dim_label, metric, data_dict, e in get_data_dicts(dataset_id, data_source, period, anomaly_df, metrics, dim):
+            if e is not None:
+                if dim is None:
                     error_msg = f"Error while getting yesterday data for dataset_id-{dataset_id} data_source-{data_source} metric-{metric} : {e}"
-                    print(error_msg)
-                    errors.append(error_msg)
-                    continue
                 else:
-                    asset_df = asset_df.append(data_dict, ignore_index=True)
-
-        else:
-            groups = anomaly_df.groupby(dim)
-            for dim_label, group_df in groups:
-                for metric in metrics:
-                    try:
-                        data_dict = get_data_dict(dataset_id, data_source, period, group_df, metric, dim, dim_label)
-                    except Exception as e:
-                        error_msg = f"Error while getting yesterday data for dataset_id-{dataset_id} data_source-{data_source} dimension-{dim} dim_label-{dim_label} metric-{metric} : {e}"
-                        print(error_msg)
-                        errors.append(error_msg)
-                        continue
-                    else:
-                        asset_df = asset_df.append(data_dict, ignore_index=True)
+                    error_msg = f"Error while getting yesterday data for dataset_id-{dataset_id} data_source-{data_source} dimension-{dim} dim_label-{dim_label} metric-{metric} : {e}"
+                print(error_msg)
+                errors.append(error_msg)
+                continue
+
+            asset_builder.append(data_dict)
+
+    asset_df = asset_builder.build()
 
     if asset_df.empty:
         return asset_df, errors
 
-    asset_df['delta'] = asset_df.apply(lambda row: delta_pct(now=row['y'], prev=row['yhat']), axis=1)
+    asset_df['delta'] = delta_pct_array(now=asset_df['y'], prev=asset_df['yhat'])
     asset_df['abs_delta'] = asset_df['delta'].abs()
 
-    asset_df['color'] = asset_df.apply(lambda row: get_color(row['anomaly_type'], row['metric']), axis=1)
+    asset_df['color'] = get_color_array(asset_df['anomaly_type'], asset_df['metric'])
 
-    asset_df['revenue_impact'] = asset_df.apply(lambda row: get_revenue_impact_for_row(row, asset_df), axis=1)
+    asset_df['revenue_impact'] = get_revenue_impact(asset_df)
 
     # asset_df.sort_values(by=['color', 'abs_delta'], ascending=False, inplace=True)
     asset_df.sort_values(by='revenue_impact', ascending=False, inplace=True)
@@ -1,5 +1,6 @@
 from bigquery import get_bigquery_client
-from send_ppt import send_text_to_slack
+from send_ppt import get_text_location
+from slack_delivery import SlackDeliveryQueue
 
 
 def send_data_recency_alerts(project_id, account, location):
@@ -24,7 +25,10 @@ def send_data_recency_alerts(project_id, account, location):
         print("All source tables are updated")
 
     else:
+        # one post per run, with a reply for each table
+        queue = SlackDeliveryQueue(title=f"Data recency alerts for {account} - {not_updated_df.shape[0]} tables not updated")
         for i, row in not_updated_df.iterrows():
             msg = f"{row['project_id']}.{row['dataset_id']}.{row['table_id']} has not been updated since {row['hours_since_update']} hours"
-            send_text_to_slack(msg, location)
+            queue.post_message(get_text_location(location), msg)
+        queue.flush()
         print("Some tables were not updated. Sent data recency alerts")
@@ -1,5 +1,5 @@
 from plotly import graph_objects as go
-from helper import fix_name, REVERSE_METRICS
+from helper import fix_name, get_color_array
 
 
 def get_hover_format(metric):
@@ -23,18 +23,6 @@ def get_hover_format(metric):
         return '.2'
 
 
-def get_color(anomaly_type, metric):
-    if metric.lower() in REVERSE_METRICS:
-        anomaly_type *= -1
-
-    if anomaly_type == 1:
-        return 'green'
-    elif anomaly_type == -1:
-        return 'red'
-    else:
-        return '#46B1FF'
-
-
 def get_graph(metric, xaxis_data, yaxis_data, trend_data, yhat_upper_data, yhat_lower_data, anomaly_type_data):
     fact = go.Scatter(
         x=xaxis_data,
@@ -42,7 +30,7 @@ def get_graph(metric, xaxis_data, yaxis_data, trend_data, yhat_upper_data, yhat_
         mode='lines+markers',
         showlegend=False,
         line=dict(color="#46B1FF"),
-        marker=dict(color=list(anomaly_type_data.apply(lambda x: get_color(x, metric)))),
+        marker=dict(color=list(get_color_array(anomaly_type_data, metric, default='#46B1FF'))),
         hoverinfo='skip'
     )
 
@@ -97,3 +85,15 @@ def get_graph(metric, xaxis_data, yaxis_data, trend_data, yhat_upper_data, yhat_
     fig = go.Figure(data, layout)
 
     return fig
+
+
+def get_row_graph(row):
+    return get_graph(
+        row['metric'],
+        row['xaxis_data'],
+        row['yaxis_data'],
+        row['trend_data'],
+        row['yhat_upper_data'],
+        row['yhat_lower_data'],
+        row['yhat_anomaly_type_data'],
+    )
@@ -1,9 +1,19 @@
+import threading
+import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from bigquery import get_bigquery_client
-from config import REVERSE_METRICS
-from pptx.util import Inches, Cm, Pt
-from pptx.dml.color import RGBColor
+from pandas.api.types import union_categoricals
+from bigquery import get_bigquery_client, get_bqstorage_client
+from config import REVERSE_METRICS, MAX_CONCURRENT_QUERIES, ANOMALY_CACHE_MAX_BYTES, ANOMALY_FLOAT_DTYPE, SCHEMA_CATALOG_TTL_SECONDS
+from anomaly_cache import get_anomaly_cache
+from datetime import date, timedelta
+
+
+# the anomaly queries and downloads running in the process, across every account, asset and table pool
+_query_slots = threading.BoundedSemaphore(max(1, MAX_CONCURRENT_QUERIES))
 
 
 def delta_pct(now, prev):
@@ -103,6 +113,19 @@ def get_metric_type(metric):
 
 
 
+def get_number_format(metric):
+    metric_type = get_metric_type(metric)
+
+    if metric_type == 'revenue':
+        return '[<1000]"$"0.0;[<999950]"$"0.0,"K";[<999950000]"$"0.0,,"M";"$"0.0,,,"B"'
+    elif metric_type == 'aov':
+        return '"$"0'
+    elif metric_type == 'rate':
+        return '0%'
+    else:
+        return '[<1000]0.0;[<999950]0.0,"K";[<999950000]0.0,,"M";0.0,,,"B"'
+
+
 def print_formatted(value, metric):
     metric = metric.lower()
 
@@ -144,11 +167,113 @@ def is_none(number):
     return not not_none(number)
 
 
+NUMERIC_COLUMN_TYPES = ['NUMERIC', 'FLOAT64', 'INT64']
+
+_schema_catalogs = {}
+_schema_catalog_locks = {}
+_schema_catalogs_lock = threading.Lock()
+
+
+def load_schema_catalog(project_id, dataset_id):
+    # __TABLES__ adds each table's last-modified time (ms since the epoch), for the anomaly cache
+    query = f"""
+            SELECT c.table_name, c.column_name, c.data_type, t.last_modified_time FROM
+            `{project_id}.{dataset_id}.INFORMATION_SCHEMA.COLUMNS` c
+            LEFT JOIN `{project_id}.{dataset_id}.__TABLES__` t ON t.table_id = c.table_name
+            WHERE ENDS_WITH(c.table_name, '_anomaly') OR ENDS_WITH(c.table_name, '_view')
+            ORDER BY c.table_name, c.ordinal_position
+            """
+
+    client = get_bigquery_client(project_id)
+    columns_df = (
+        client.query(query)
+            .result()
+            .to_dataframe()
+    )
+
+    columns = {}
+    modified = {}
+    for table_id, column_name, data_type, last_modified_time in columns_df[['table_name', 'column_name', 'data_type', 'last_modified_time']].itertuples(index=False):
+        columns.setdefault(table_id, []).append((column_name, data_type))
+        if not pd.isna(last_modified_time):
+            modified[table_id] = int(last_modified_time)
+
+    return SchemaCatalog(columns, modified)
+
+
+class SchemaCatalog:
+    def __init__(self, columns, modified):
+        self.columns = columns
+        self.modified = modified
+        self.loaded_at = time.monotonic()
+
+
+def get_schema_catalog(project_id, dataset_id, refresh=False):
+    '''
+    Columns of every *_anomaly table and *_view view in the dataset as {table_id: [(column_name, data_type), ...]},
+    and their last-modified times as {table_id: ms since the epoch}.
+    Loaded with a single query and reused for SCHEMA_CATALOG_TTL_SECONDS, so columns added to a table
+    are seen by warm processes. Each dataset loads under its own lock.
+    '''
+    key = (project_id, dataset_id)
+    with _schema_catalogs_lock:
+        lock = _schema_catalog_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        catalog = _schema_catalogs.get(key)
+        if refresh or catalog is None or time.monotonic() - catalog.loaded_at >= SCHEMA_CATALOG_TTL_SECONDS:
+            catalog = load_schema_catalog(project_id, dataset_id)
+            with _schema_catalogs_lock:
+                _schema_catalogs[key] = catalog
+
+    return catalog
+
+
+def clear_schema_catalogs():
+    with _schema_catalogs_lock:
+        _schema_catalogs.clear()
+
+
+class RecordFrameBuilder:
+    '''
+    Collects row dicts and builds the DataFrame once, instead of growing it with DataFrame.append.
+    Columns start with `columns`, followed by any other record keys in first-seen order.
+    '''
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.records = []
+
+    def append(self, record):
+        if record is not None:
+            self.records.append(record)
+
+    def build(self):
+        if not self.records:
+            return pd.DataFrame(columns=self.columns)
+
+        columns = list(self.columns)
+        seen = set(columns)
+        record_keys = set()
+        for record in self.records:
+            for key in record:
+                record_keys.add(key)
+                if key not in seen:
+                    seen.add(key)
+                    columns.append(key)
+
+        df = pd.DataFrame.from_records(self.records, columns=columns)
+
+        for column in columns:
+            if column not in record_keys:
+                df[column] = df[column].astype(object)
+
+        return df
+
+
 def get_tables(project_id, dataset_id, period):
     result = []
-    client = get_bigquery_client(project_id)
-    table_ids = [table.table_id for table in client.list_tables(dataset_id)]
-    for table_id in table_ids:
+    table_ids = get_schema_catalog(project_id, dataset_id).columns.keys()
+    for table_id in sorted(table_ids):
         if table_id.endswith('_view') and (period in table_id) and ('raw_funnel' not in table_id):
             result.append(table_id[:-5] + '_anomaly')
 
@@ -156,21 +281,22 @@ def get_tables(project_id, dataset_id, period):
 
 
 def get_dim_metrics(project_id, dataset_id, table_id):
-    client = get_bigquery_client(project_id)
-    dataset_ref = client.dataset(dataset_id, project=project_id)
-    table_ref = dataset_ref.table(table_id)
-    table = client.get_table(table_ref)
+    columns = get_schema_catalog(project_id, dataset_id).columns.get(table_id)
+    if columns is None:
+        columns = get_schema_catalog(project_id, dataset_id, refresh=True).columns.get(table_id)
+    if columns is None:
+        raise ValueError(f'Error while getting dim and metrics for {project_id}.{dataset_id}.{table_id} : table not found')
 
     dims = []
     metrics = []
-    for schema in table.schema:
-        if schema.field_type in ['NUMERIC', 'FLOAT', 'INTEGER']:
-            if schema.name.endswith('_yhat'):
-                metrics.append(schema.name[:-5])
-        elif schema.name.lower() in ['date', 'datehour', 'week']:
+    for column_name, data_type in columns:
+        if data_type in NUMERIC_COLUMN_TYPES:
+            if column_name.endswith('_yhat'):
+                metrics.append(column_name[:-5])
+        elif column_name.lower() in ['date', 'datehour', 'week']:
             continue
         else:
-            dims.append(schema.name)
+            dims.append(column_name)
 
     if len(dims) == 0:
         return None, metrics
@@ -182,45 +308,281 @@ def get_dim_metrics(project_id, dataset_id, table_id):
         raise ValueError(f'Error while getting dim and metrics for {project_id}.{dataset_id}.{table_id} : length of dims is {len(dims)}')
 
 
-def get_anomaly_df(project_id, dataset_id, table_id, period, date_filter=None):
+# Days of history each period reads; None reads the whole table.
+# daily/weekly only look back as far as data.year_ago, hourly ranks yhat over the full history.
+ANOMALY_LOOKBACK_DAYS = {
+    'hourly': None,
+    'daily': 365,
+    'weekly': 365,
+}
+
+METRIC_COLUMN_SUFFIXES = ['', '_yhat', '_yhat_upper', '_yhat_lower', '_trend']
+
+
+def get_date_col(period):
     if period == 'hourly':
-        date_col = 'DateHour'
+        return 'DateHour'
     elif period == 'daily':
-        date_col = 'Date'
+        return 'Date'
     elif period == 'weekly':
-        date_col = 'Week'
+        return 'Week'
     else:
         raise Exception(f"Invalid period - {period}")
 
+
+def get_anomaly_columns(date_col, dim, metrics, table_columns=None):
+    '''
+    Columns read for the metrics, leaving out any the table doesn't have (table_columns, when known),
+    so a missing column only fails its own series in get_data_dict.
+    '''
+    columns = [date_col]
+    if dim is not None:
+        columns.append(dim)
+
+    for metric in metrics:
+        for suffix in METRIC_COLUMN_SUFFIXES:
+            column = f'{metric}{suffix}'
+            if table_columns is None or column in table_columns:
+                columns.append(column)
+
+    return columns
+
+
+def get_table_columns(project_id, dataset_id, table_id):
+    columns = get_schema_catalog(project_id, dataset_id).columns.get(table_id)
+    if columns is None:
+        return None
+
+    return {column_name for column_name, _ in columns}
+
+
+def get_default_start_date(period):
+    lookback_days = ANOMALY_LOOKBACK_DAYS[period]
+    if lookback_days is None:
+        return None
+
+    return date.today() - timedelta(days=lookback_days)
+
+
+def get_date_filter(start_date):
+    if start_date is None:
+        return None
+
+    return f">= '{start_date.strftime('%Y-%m-%d')}'"
+
+
+def query_anomaly_df(project_id, dataset_id, table_id, date_col, dim, columns, date_filter=None):
+    select_columns = ', '.join(f'`{column}`' for column in columns)
+
     if date_filter:
         query = f"""
-                SELECT * FROM
+                SELECT {select_columns} FROM
                 `{project_id}.{dataset_id}.{table_id}`
                 WHERE {date_col} {date_filter}
                 ORDER BY {date_col}
                 """
     else:
         query = f"""
-                SELECT * FROM
+                SELECT {select_columns} FROM
                 `{project_id}.{dataset_id}.{table_id}`
                 ORDER BY {date_col}
                 """
 
     client = get_bigquery_client(project_id)
-    anomaly_df = (
-        client.query(query)
-            .result()
-            .to_dataframe()
-    )
+    with _query_slots:
+        rows = client.query(query).result()
+        return read_anomaly_df(rows, project_id, date_col, dim)
 
-    _, metrics = get_dim_metrics(project_id, dataset_id, table_id)
 
-    for metric in metrics:
-        anomaly_df[metric] = pd.to_numeric(anomaly_df[metric])
+def read_anomaly_df(rows, project_id, date_col, dim):
+    '''
+    Downloads a query result as Arrow record batches, over the BigQuery Storage API when it is installed,
+    and converts each batch to compact dtypes as it arrives.
+    '''
+    bqstorage_client = get_bqstorage_client(project_id)
+
+    frames = []
+    for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        frames.append(get_compact_anomaly_df(batch, date_col, dim))
+
+    if not frames:
+        frames.append(get_compact_anomaly_df(get_empty_arrow_table([field.name for field in rows.schema], date_col, dim), date_col, dim))
+
+    return concat_anomaly_frames(frames)
+
+
+def get_empty_arrow_table(columns, date_col, dim):
+    import pyarrow as pa
+
+    def get_type(name):
+        if name == date_col:
+            return pa.timestamp('us')
+        elif name == dim:
+            return pa.string()
+        return pa.float64()
+
+    return pa.table({name: pa.array([], type=get_type(name)) for name in columns})
+
+
+def get_float_values(column):
+    import pyarrow as pa
+
+    try:
+        column = column.cast(pa.float64())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return pd.to_numeric(column.to_pandas()).astype(ANOMALY_FLOAT_DTYPE)
+
+    return column.to_pandas().astype(ANOMALY_FLOAT_DTYPE, copy=False)
+
+
+def get_compact_anomaly_df(arrow_data, date_col, dim):
+    '''
+    Converts an Arrow table or record batch of an anomaly table to pandas: the date column as datetime64,
+    the dimension as a categorical with sorted categories and every other column as ANOMALY_FLOAT_DTYPE floats.
+    '''
+    data = {}
+    for name, column in zip(arrow_data.schema.names, arrow_data.columns):
+        if name == date_col:
+            data[name] = pd.to_datetime(column.to_pandas())
+        elif name == dim:
+            values = column.dictionary_encode().to_pandas()
+            data[name] = values.cat.reorder_categories(sorted(values.cat.categories))
+        else:
+            data[name] = get_float_values(column)
+
+    return pd.DataFrame(data, columns=arrow_data.schema.names)
+
+
+def concat_anomaly_frames(frames):
+    '''
+    pd.concat for compact anomaly frames - categorical columns stay categorical even when their categories differ.
+    '''
+    if len(frames) == 1:
+        return frames[0]
+
+    columns = list(frames[0].columns)
+    categorical_columns = [column for column in columns if isinstance(frames[0][column].dtype, pd.CategoricalDtype)]
+
+    anomaly_df = pd.concat([frame.drop(columns=categorical_columns) for frame in frames], ignore_index=True)
+    for column in categorical_columns:
+        values = union_categoricals([frame[column] for frame in frames], sort_categories=True)
+        anomaly_df.insert(columns.index(column), column, values)
 
     return anomaly_df
 
 
+def get_table_modified(project_id, dataset_id, table_id):
+    '''
+    Last-modified time of the table from the dataset's schema catalog, without a request per table.
+    '''
+    modified = get_schema_catalog(project_id, dataset_id).modified.get(table_id)
+    if modified is None:
+        client = get_bigquery_client(project_id)
+        return int(client.get_table(f'{project_id}.{dataset_id}.{table_id}').modified.timestamp() * 1000)
+
+    return modified
+
+
+def get_anomaly_df(project_id, dataset_id, table_id, period, date_filter=None, start_date=None):
+    '''
+    Reads the table from start_date on (by default the period's lookback) through the anomaly cache.
+    A raw SQL date_filter on the date column is read straight from BigQuery instead.
+    '''
+    date_col = get_date_col(period)
+    dim, metrics = get_dim_metrics(project_id, dataset_id, table_id)
+    columns = get_anomaly_columns(date_col, dim, metrics, get_table_columns(project_id, dataset_id, table_id))
+
+    if date_filter is not None:
+        anomaly_df = query_anomaly_df(project_id, dataset_id, table_id, date_col, dim, columns, date_filter)
+        return normalize_anomaly_df(anomaly_df, date_col)
+
+    if start_date is None:
+        start_date = get_default_start_date(period)
+
+    def fetch(start_date):
+        return query_anomaly_df(project_id, dataset_id, table_id, date_col, dim, columns, get_date_filter(start_date))
+
+    if ANOMALY_CACHE_MAX_BYTES <= 0:
+        anomaly_df = fetch(start_date)
+    else:
+        modified = get_table_modified(project_id, dataset_id, table_id)
+        anomaly_df = get_anomaly_cache().read((project_id, dataset_id, table_id, period), date_col, columns, start_date, modified, fetch)
+
+    return normalize_anomaly_df(anomaly_df, date_col)
+
+
+def normalize_anomaly_df(anomaly_df, date_col):
+    '''
+    Date column as datetime64 and rows in date order, so windows over a series are binary-search slices.
+    '''
+    if not pd.api.types.is_datetime64_any_dtype(anomaly_df[date_col]):
+        anomaly_df[date_col] = pd.to_datetime(anomaly_df[date_col])
+
+    if not anomaly_df[date_col].is_monotonic_increasing:
+        anomaly_df = anomaly_df.sort_values(date_col, kind='stable').reset_index(drop=True)
+
+    return anomaly_df
+
+
+def clip_forecasts(anomaly_df, metrics):
+    '''
+    Clips the forecast columns of every metric at 0, once for the whole table rather than per series.
+    '''
+    for metric in metrics:
+        for column in [f'{metric}_yhat', f'{metric}_yhat_upper', f'{metric}_yhat_lower']:
+            if column in anomaly_df.columns:
+                anomaly_df[column] = np.maximum(anomaly_df[column], 0)
+
+
+def get_group_slices(anomaly_df, dim, date_col):
+    '''
+    Sorts the table once by (dim, date). Returns the sorted table and the (dim_label, start, end) rows
+    of each dim_label in groupby order, so a series is sorted_df.iloc[start:end] - a slice, not a copy.
+    Rows without a dim_label are dropped, as groupby drops them.
+    '''
+    codes, uniques = pd.factorize(anomaly_df[dim], sort=True)
+    order = np.lexsort((anomaly_df[date_col].values, codes))
+    order = order[codes[order] >= 0]
+
+    sorted_codes = codes[order]
+    groups = np.arange(len(uniques))
+    starts = np.searchsorted(sorted_codes, groups, side='left')
+    ends = np.searchsorted(sorted_codes, groups, side='right')
+
+    return anomaly_df.take(order), list(zip(uniques, starts, ends))
+
+
+def bounded_map(executor, fn, items, max_pending):
+    '''
+    Yields fn(item) for each of items in order, run on executor. At most max_pending results exist at once,
+    counting those still running, those finished and waiting their turn, and the one the caller holds.
+    '''
+    items = iter(items)
+    pending = deque(executor.submit(fn, item) for item in islice(items, max(1, max_pending)))
+    while pending:
+        yield pending.popleft().result()
+        # the result just yielded is the caller's until it asks for the next one
+        for item in islice(items, 1):
+            pending.append(executor.submit(fn, item))
+
+
+def fetch_anomaly_dfs(project_id, dataset_id, table_ids, period, max_workers=MAX_CONCURRENT_QUERIES):
+    '''
+    Runs the anomaly queries for table_ids on a bounded thread pool.
+    Yields (table_id, anomaly_df, exception) in table_ids order, as soon as each table is ready;
+    no more than max_workers frames are fetched ahead of the caller.
+    '''
+    def fetch(table_id):
+        try:
+            return get_anomaly_df(project_id, dataset_id, table_id, period), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for table_id, (anomaly_df, exception) in zip(table_ids, bounded_map(executor, fetch, table_ids, max_workers)):
+            yield table_id, anomaly_df, exception
+
+
 def get_table_details(project_id, asset, table_id):
     data_source = get_data_source(table_id)
     dim, metrics = get_dim_metrics(project_id, asset, table_id)
@@ -260,6 +622,54 @@ def get_color(anomaly_type, metric):
         return None
 
 
+def delta_pct_array(now, prev):
+    '''Element-wise delta_pct over arrays or Series, with NaN treated as 0 and a 0 denominator giving +-inf or 0.'''
+    now = np.asarray(now, dtype=float)
+    prev = np.asarray(prev, dtype=float)
+    now = np.where(np.isnan(now), 0, now)
+    prev = np.where(np.isnan(prev), 0, prev)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        delta = (now / prev - 1) * 100
+
+    zero_prev_delta = np.where(now > 0, np.inf, np.where(now < 0, -np.inf, 0.0))
+    return np.where(prev == 0, zero_prev_delta, delta)
+
+
+def get_anomaly_type_array(y, upper, lower):
+    y = np.asarray(y, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    lower = np.asarray(lower, dtype=float)
+
+    return np.where(y > upper, 1, np.where(y < lower, -1, 0))
+
+
+def check_warning_array(y, upper, lower, lower_bound=10, upper_bound=30):
+    lower_delta = -delta_pct_array(y, lower)
+    upper_delta = delta_pct_array(y, upper)
+    return ((lower_bound < lower_delta) & (lower_delta <= upper_bound)) | ((lower_bound < upper_delta) & (upper_delta <= upper_bound))
+
+
+def check_critical_array(y, upper, lower, threshold=30):
+    return (-delta_pct_array(y, lower) > threshold) | (delta_pct_array(y, upper) > threshold)
+
+
+def get_color_array(anomaly_type, metric, default=None):
+    '''Element-wise get_color; metric is a single metric name or one per element.'''
+    anomaly_type = np.asarray(anomaly_type, dtype=float)
+    if isinstance(metric, str):
+        is_reverse = metric.lower() in REVERSE_METRICS
+    else:
+        is_reverse = pd.Series(metric, dtype=object).str.lower().isin(REVERSE_METRICS).values
+
+    anomaly_type = np.where(is_reverse, -anomaly_type, anomaly_type)
+
+    colors = np.full(anomaly_type.shape, default, dtype=object)
+    colors[anomaly_type == 1] = 'green'
+    colors[anomaly_type == -1] = 'red'
+    return colors
+
+
 def get_data_source(table_id):
     if table_id.startswith('ga_'):
         data_source = 'Google Analytics'
@@ -321,6 +731,9 @@ always_include_data_source = ['Google Ads', 'Facebook']
 
 
 def print_anomaly(p, row, pre):
+    # python-pptx is only needed by the slide paths, not by hourly or the queries
+    from pptx.util import Pt
+    from pptx.dml.color import RGBColor
 
     data_source = row.data_source
     dimension = row.dimension
@@ -446,3 +859,31 @@ def filter_data_by_kpi(asset_df, kpi):
     filtered_df = asset_df[data_source_mask & dimension_mask & dim_label_mask & metric_mask]
     return filtered_df
 
+
+
+KPI_KEY_COLUMNS = ['data_source', 'dimension', 'dim_label', 'metric']
+
+
+def get_kpi_mask(asset_df, kpi_list):
+    '''
+    True for the row filter_data_by_kpi picks for each KPI - the first row of asset_df with its keys.
+    Found with one merge of the KPI keys against asset_df, not a scan of asset_df per KPI.
+    '''
+    kpi_mask = np.zeros(asset_df.shape[0], dtype=bool)
+    if asset_df.empty or not kpi_list:
+        return kpi_mask
+
+    kpi_df = pd.DataFrame(
+        [[kpi.data_source, kpi.dimension or None, kpi.dim_label or None, kpi.metric] for kpi in kpi_list],
+        columns=KPI_KEY_COLUMNS,
+        dtype=object,
+    ).drop_duplicates()
+
+    keys_df = asset_df[KPI_KEY_COLUMNS].astype(object).reset_index(drop=True)
+    keys_df['position'] = np.arange(keys_df.shape[0])
+
+    matches_df = keys_df.merge(kpi_df, on=KPI_KEY_COLUMNS)
+    first_positions = matches_df.groupby(KPI_KEY_COLUMNS, dropna=False)['position'].min()
+    kpi_mask[first_positions.values] = True
+
+    return kpi_mask
@@ -1,15 +1,17 @@
-import os
 import numpy as np
 import pandas as pd
-from config import in_production
-from graph import get_graph
-from helper import get_tables, get_anomaly_df, get_table_details, get_anomaly_type, print_delta, print_formatted
-from helper import check_critical, check_warning, get_color, get_bigquery_client, delta_pct, not_none, fix_name
-from data import get_revenue_impact_for_row
+from config import in_production, HOURLY_INCREMENTAL
+from chart_renderer import get_chart_renderer
+from helper import get_tables, get_anomaly_df, get_table_details, print_delta, print_formatted
+from helper import get_color, get_bigquery_client, not_none, fix_name
+from helper import RecordFrameBuilder, delta_pct_array, get_anomaly_type_array, check_critical_array, get_color_array
+from helper import clip_forecasts, get_group_slices
+from data import get_revenue_impact, get_date_position
+from hourly_state import load_hourly_state, save_hourly_state, get_series_key, get_alert_key
+from percentile_sketch import PercentileSketch
+from anomaly_cache import print_anomaly_cache_stats
 from datetime import date, timedelta
-from slack_sdk import WebClient
-
-SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN", "replace_slack_bot_token")
+from slack_delivery import SlackDeliveryQueue
 
 
 year_ago = date.today() - timedelta(days=365)
@@ -18,7 +20,7 @@ three_months_ago = date.today() - timedelta(days=3*30)
 hourly_date_start = date.today() - timedelta(days=3)
 
 
-def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.nan, dim_label=np.nan):
+def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.nan, dim_label=np.nan, percentiles=None):
 
     date_col = 'DateHour'
 
@@ -26,18 +28,19 @@ def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.n
 
     WINDOW = 3
 
-    anomaly_df[f'{metric}_yhat'] = np.maximum(anomaly_df[f'{metric}_yhat'], 0)
-    anomaly_df[f'{metric}_yhat_upper'] = np.maximum(anomaly_df[f'{metric}_yhat_upper'], 0)
-    anomaly_df[f'{metric}_yhat_lower'] = np.maximum(anomaly_df[f'{metric}_yhat_lower'], 0)
-
-    anomaly_df['percentile'] = anomaly_df[f'{metric}_yhat'].rank(pct=True)
+    # forecasts were clipped at 0 for the whole table by clip_forecasts, and anomaly_df may be a
+    # slice of the table, so nothing is written back to it
+    if percentiles is None:
+        percentile = anomaly_df[f'{metric}_yhat'].rank(pct=True)
+    else:
+        # anomaly_df only holds the recent hours, the sketch has seen the whole series
+        percentile = pd.Series(percentiles.rank(anomaly_df[f'{metric}_yhat']), index=anomaly_df.index)
 
     current_anomaly_df = anomaly_df[not_null_mask].iloc[-WINDOW:]
-    current_anomaly_df['yhat_anomaly_type'] = current_anomaly_df.apply(lambda row: get_anomaly_type(y=row[metric], upper=row[f'{metric}_yhat_upper'], lower=row[f'{metric}_yhat_lower']), axis=1)
-    prev_anomaly_df = anomaly_df[not_null_mask].iloc[:-WINDOW]
-    prev_anomaly_df['yhat_anomaly_type'] = prev_anomaly_df.apply(lambda row: get_anomaly_type(y=row[metric], upper=row[f'{metric}_yhat_upper'], lower=row[f'{metric}_yhat_lower']), axis=1)
+    current_percentile = percentile[not_null_mask].iloc[-WINDOW:]
+    current_anomaly_types = get_anomaly_type_array(current_anomaly_df[metric], current_anomaly_df[f'{metric}_yhat_upper'], current_anomaly_df[f'{metric}_yhat_lower'])
 
-    anomaly_sum = current_anomaly_df['yhat_anomaly_type'].sum()
+    anomaly_sum = current_anomaly_types.sum()
     is_yhat_anomaly = abs(anomaly_sum) == WINDOW
 
     y = current_anomaly_df[metric].mean()
@@ -45,16 +48,16 @@ def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.n
     yhat_upper = current_anomaly_df[f'{metric}_yhat_upper'].mean()
     yhat_lower = current_anomaly_df[f'{metric}_yhat_lower'].mean()
 
-    if current_anomaly_df['percentile'].min() < 0.4:
+    if current_percentile.min() < 0.4:
         business_filter = False
     else:
         business_filter = True
         
     yhat_anomaly_type = anomaly_sum // WINDOW if is_yhat_anomaly and business_filter else 0
 
-    current_anomaly_df['is_yhat_critical'] = current_anomaly_df.apply(lambda row: check_critical(y=row[metric], upper=row[f'{metric}_yhat_upper'], lower=row[f'{metric}_yhat_lower'], threshold=20), axis=1)
+    current_is_yhat_critical = check_critical_array(current_anomaly_df[metric], current_anomaly_df[f'{metric}_yhat_upper'], current_anomaly_df[f'{metric}_yhat_lower'], threshold=20)
 
-    is_yhat_critical = current_anomaly_df['is_yhat_critical'].sum() // WINDOW if is_yhat_anomaly and business_filter else 0
+    is_yhat_critical = current_is_yhat_critical.sum() // WINDOW if is_yhat_anomaly and business_filter else 0
 
     # is_yhat_critical = check_critical(y, upper=yhat_upper, lower=yhat_lower, threshold=20) if is_yhat_anomaly and business_filter else False
     # is_yhat_warning = check_warning(y, upper=yhat_upper, lower=yhat_lower) if is_yhat_anomaly and business_filter else False
@@ -75,25 +78,78 @@ def get_data_dict(asset, data_source, period, anomaly_df, metric, dimension=np.n
         'is_yhat_critical': is_yhat_critical,
         'yhat_anomaly_type': yhat_anomaly_type,
         'yhat_color': get_color(yhat_anomaly_type, metric),
+        'date_hour': current_anomaly_df[date_col].max(),
     }
 
-    mask = anomaly_df[date_col] >= hourly_date_start.strftime('%Y-%m-%d')
+    # rows are in DateHour order, so the chart window starts at a binary-searched position
+    chart_df = anomaly_df.iloc[get_date_position(anomaly_df[date_col].values, hourly_date_start):]
 
-    data_dict['xaxis_data'] = anomaly_df[mask][date_col]
-    data_dict['yaxis_data'] = anomaly_df[mask][metric]
-    data_dict['trend_data'] = anomaly_df[mask][f'{metric}_trend']
-    data_dict['yhat_data'] = anomaly_df[mask][f'{metric}_yhat']
-    data_dict['yhat_upper_data'] = anomaly_df[mask][f'{metric}_yhat_upper']
-    data_dict['yhat_lower_data'] = anomaly_df[mask][f'{metric}_yhat_lower']
-    data_dict['yhat_anomaly_type_data'] = anomaly_df[mask].apply(lambda row: get_anomaly_type(y=row[metric], upper=row[f'{metric}_yhat_upper'], lower=row[f'{metric}_yhat_lower']), axis=1)
+    data_dict['xaxis_data'] = chart_df[date_col]
+    data_dict['yaxis_data'] = chart_df[metric]
+    data_dict['trend_data'] = chart_df[f'{metric}_trend']
+    data_dict['yhat_data'] = chart_df[f'{metric}_yhat']
+    data_dict['yhat_upper_data'] = chart_df[f'{metric}_yhat_upper']
+    data_dict['yhat_lower_data'] = chart_df[f'{metric}_yhat_lower']
+    data_dict['yhat_anomaly_type_data'] = pd.Series(get_anomaly_type_array(chart_df[metric], chart_df[f'{metric}_yhat_upper'], chart_df[f'{metric}_yhat_lower']), index=chart_df.index)
 
     return data_dict
 
 
-def get_hourly_asset_df(account, project_id, dataset_id):
+def get_hourly_start_date(table_state):
+    '''
+    The full history on the first run, afterwards the chart window - or back to the watermark if that is older.
+    '''
+    if table_state is None:
+        return None
+
+    return min(hourly_date_start, date.fromisoformat(table_state['watermark'][:10]))
+
+
+def update_table_state(state, table_id, anomaly_df, groups, metrics):
+    '''
+    Adds the hours after the table's watermark to the percentile sketch of each series and moves the watermark up.
+    anomaly_df is sorted by (dimension, DateHour) with the (dim_label, start, end) rows of each series in groups.
+    Returns the sketches by series key.
+    '''
+    date_col = 'DateHour'
+
+    table_state = state['tables'].get(table_id)
+    if table_state is None:
+        table_state = {'watermark': None, 'sketches': {}}
+
+    sketches = {key: PercentileSketch.from_dict(sketch) for key, sketch in table_state['sketches'].items()}
+
+    watermark = table_state['watermark']
+    dates = anomaly_df[date_col].values
+    for dim_label, start, end in groups:
+        if watermark is not None:
+            # the hours of a series are in order, so its new hours are the tail of its slice
+            start += get_date_position(dates[start:end], watermark, side='right')
+        group_df = anomaly_df.iloc[start:end]
+        for metric in metrics:
+            sketch = sketches.setdefault(get_series_key(dim_label, metric), PercentileSketch())
+            sketch.update(group_df[f'{metric}_yhat'])
+
+    if anomaly_df.shape[0] > 0 and (watermark is None or anomaly_df[date_col].max() > pd.Timestamp(watermark)):
+        watermark = str(anomaly_df[date_col].max())
+
+    if watermark is not None:
+        state['tables'][table_id] = {
+            'watermark': watermark,
+            'sketches': {key: sketch.to_dict() for key, sketch in sketches.items()},
+        }
+
+    return sketches
+
+
+def get_hourly_asset_df(account, project_id, dataset_id, state=None):
+    '''
+    With a state from load_hourly_state, each table is read from its watermark instead of in full
+    and the yhat percentiles come from the series sketches. The state is updated in place.
+    '''
     errors = []
 
-    asset_df = pd.DataFrame(
+    asset_builder = RecordFrameBuilder(
         columns=[
             'asset',
             'data_source',
@@ -116,8 +172,9 @@ def get_hourly_asset_df(account, project_id, dataset_id):
     table_ids = get_tables(project_id, dataset_id, period)
 
     for table_id in table_ids:
+        table_state = state['tables'].get(table_id) if state is not None else None
         try:
-            anomaly_df = get_anomaly_df(project_id, dataset_id, table_id, period)
+            anomaly_df = get_anomaly_df(project_id, dataset_id, table_id, period, start_date=get_hourly_start_date(table_state))
         except Exception as e:
             error_msg = f"Error while getting data for - {project_id} {dataset_id} {table_id} : {e}"
             print(error_msg)
@@ -126,38 +183,49 @@ def get_hourly_asset_df(account, project_id, dataset_id):
 
         data_source, dim, metrics = get_table_details(project_id, dataset_id, table_id)
 
+        # clipped and sorted by (dim, DateHour) once, each series is then a slice of the table
+        clip_forecasts(anomaly_df, metrics)
         if dim is None:
+            groups = [(None, 0, anomaly_df.shape[0])]
+        else:
+            anomaly_df, groups = get_group_slices(anomaly_df, dim, 'DateHour')
+
+        sketches = None
+        if state is not None:
+            sketches = update_table_state(state, table_id, anomaly_df, groups, metrics)
+
+        def get_percentiles(dim_label, metric):
+            if sketches is None:
+                return None
+            return sketches.get(get_series_key(dim_label, metric), PercentileSketch())
+
+        for dim_label, start, end in groups:
+            group_df = anomaly_df.iloc[start:end]
             for metric in metrics:
                 try:
-                    data_dict = get_data_dict(dataset_id, data_source, period, anomaly_df, metric)
+                    if dim is None:
+                        data_dict = get_data_dict(dataset_id, data_source, period, group_df, metric, percentiles=get_percentiles(None, metric))
+                    else:
+                        data_dict = get_data_dict(dataset_id, data_source, period, group_df, metric, dim, dim_label, get_percentiles(dim_label, metric))
                 except Exception as e:
-                    error_msg = f"Error while getting yesterday data for dataset_id-{dataset_id} data_source-{data_source} metric-{metric} : {e}"
+                    if dim is None:
+                        error_msg = f"Error while getting yesterday data for dataset_id-{dataset_id} data_source-{data_source} metric-{metric} : {e}"
+                    else:
+                        error_msg = f"Error while getting yesterday data for dataset_id-{dataset_id} data_source-{data_source} dimension-{dim} dim_label-{dim_label} metric-{metric} : {e}"
                     print(error_msg)
                     errors.append(error_msg)
                     continue
                 else:
-                    asset_df = asset_df.append(data_dict, ignore_index=True)
+                    asset_builder.append(data_dict)
 
-        else:
-            groups = anomaly_df.groupby(dim)
-            for dim_label, group_df in groups:
-                for metric in metrics:
-                    try:
-                        data_dict = get_data_dict(dataset_id, data_source, period, group_df, metric, dim, dim_label)
-                    except Exception as e:
-                        error_msg = f"Error while getting yesterday data for dataset_id-{dataset_id} data_source-{data_source} dimension-{dim} dim_label-{dim_label} metric-{metric} : {e}"
-                        print(error_msg)
-                        errors.append(error_msg)
-                        continue
-                    else:
-                        asset_df = asset_df.append(data_dict, ignore_index=True)
+    asset_df = asset_builder.build()
 
-    asset_df['delta'] = asset_df.apply(lambda row: delta_pct(now=row['y'], prev=row['yhat']), axis=1)
+    asset_df['delta'] = delta_pct_array(now=asset_df['y'], prev=asset_df['yhat'])
     asset_df['abs_delta'] = asset_df['delta'].abs()
 
-    asset_df['yhat_color'] = asset_df.apply(lambda row: get_color(row['yhat_anomaly_type'], row['metric']), axis=1)
+    asset_df['yhat_color'] = get_color_array(asset_df['yhat_anomaly_type'], asset_df['metric'])
 
-    asset_df['revenue_impact'] = asset_df.apply(lambda row: get_revenue_impact_for_row(row, asset_df), axis=1)
+    asset_df['revenue_impact'] = get_revenue_impact(asset_df)
 
     # asset_df.sort_values(by=['color', 'abs_delta'], ascending=False, inplace=True)
     asset_df.sort_values(by='revenue_impact', ascending=False, inplace=True)
@@ -175,18 +243,8 @@ def get_hourly_asset_df(account, project_id, dataset_id):
 
 
 def create_chart(row):
-    metric = row['metric']
-    xaxis_data = row['xaxis_data']
-    yaxis_data = row['yaxis_data']
-    trend_data = row['trend_data']
-    yhat_upper_data = row['yhat_upper_data']
-    yhat_lower_data = row['yhat_lower_data']
-    anomaly_type_data = row['yhat_anomaly_type_data']
-    fig = get_graph(metric, xaxis_data, yaxis_data, trend_data, yhat_upper_data, yhat_lower_data, anomaly_type_data)
-    img_path = "/tmp/anomaly.png" if in_production else "anomaly.png"
-    fig.write_image(img_path, width=536, height=362)
-
-    return img_path
+    from graph import get_row_graph
+    return get_chart_renderer().submit(get_row_graph, row)
 
 
 def send_hourly_alerts(project_id, account, location):
@@ -202,37 +260,77 @@ def send_hourly_alerts(project_id, account, location):
 
     print("Got list of assets")
 
-    client = WebClient(token=SLACK_BOT_TOKEN)
-
     location = '#watchdog-test'
 
     if not in_production:
         location = 'wdt2'
 
-    for i, row in dataset_df.iterrows():
-        if row['dataset_id'] != 'Overall':
-            hourly_asset_df, errors = get_hourly_asset_df(account, project_id, row['dataset_id'])
-            for i, row in hourly_asset_df.iterrows():
-                # if (row['is_yhat_warning'] or row['is_yhat_critical']):
-                if row['is_yhat_critical']:
-                    forecast_comment = f"{fix_name(row['asset'])} - {'Warning' if row['is_yhat_warning'] else ':bangbang:Critical'} -"
-                    if not_none(row['dim_label']):
-                        forecast_comment = forecast_comment + f" {fix_name(row['dim_label'])}"
-                    forecast_comment = forecast_comment + f" {fix_name(row['metric'])} ({print_formatted(row['y'], row['metric'])})"
-                    if row['metric'].endswith('s'):
-                        forecast_comment = forecast_comment + " are"
-                    else:
-                        forecast_comment = forecast_comment + " is"
+    # the alerts of every dataset go out together, as replies to one post
+    queue = SlackDeliveryQueue(title=f"Hourly alerts for {account}")
+    states = {}
+    try:
+        for i, row in dataset_df.iterrows():
+            if row['dataset_id'] != 'Overall':
+                dataset_id = row['dataset_id']
+                state = load_hourly_state(project_id, dataset_id) if HOURLY_INCREMENTAL else None
+                states[dataset_id] = state
+                send_dataset_alerts(queue, location, account, project_id, dataset_id, state)
+    finally:
+        try:
+            queue.flush()
+        finally:
+            # alerts are marked posted as their uploads succeed
+            for dataset_id, state in states.items():
+                if state is not None:
+                    save_hourly_state(project_id, dataset_id, state)
+
+    print_anomaly_cache_stats()
+
+
+def send_dataset_alerts(queue, location, account, project_id, dataset_id, state=None):
+    hourly_asset_df, errors = get_hourly_asset_df(account, project_id, dataset_id, state)
+    # critical_df = hourly_asset_df[hourly_asset_df['is_yhat_warning'] | hourly_asset_df['is_yhat_critical']]
+    critical_df = hourly_asset_df[hourly_asset_df['is_yhat_critical'].astype(bool)]
+
+    if state is not None:
+        # an alert is posted once while it stays critical, and again only after it has cleared
+        alert_keys = {i: get_alert_key(row) for i, row in critical_df.iterrows()}
+        posted = state['posted']
+        state['posted'] = {key: posted[key] for key in alert_keys.values() if key in posted}
+        is_posted = pd.Series([alert_keys[i] in posted for i in critical_df.index], index=critical_df.index, dtype=bool)
+        critical_df = critical_df[~is_posted]
+
+    charts = {i: create_chart(row) for i, row in critical_df.iterrows()}
+    for i, row in critical_df.iterrows():
+        forecast_comment = f"{fix_name(row['asset'])} - {'Warning' if row['is_yhat_warning'] else ':bangbang:Critical'} -"
+        if not_none(row['dim_label']):
+            forecast_comment = forecast_comment + f" {fix_name(row['dim_label'])}"
+        forecast_comment = forecast_comment + f" {fix_name(row['metric'])} ({print_formatted(row['y'], row['metric'])})"
+        if row['metric'].endswith('s'):
+            forecast_comment = forecast_comment + " are"
+        else:
+            forecast_comment = forecast_comment + " is"
 
-                    forecast_comment = forecast_comment + f" {print_delta(now=row['y'], prev=row['yhat'])}"
+        forecast_comment = forecast_comment + f" {print_delta(now=row['y'], prev=row['yhat'])}"
 
-                    if row['y'] > row['yhat']:
-                        forecast_comment = forecast_comment + " higher than"
-                    else:
-                        forecast_comment = forecast_comment + " lower than"
+        if row['y'] > row['yhat']:
+            forecast_comment = forecast_comment + " higher than"
+        else:
+            forecast_comment = forecast_comment + " lower than"
+
+        forecast_comment = forecast_comment + f" expected value of ({print_formatted(row['yhat'], row['metric'])})"
+
+        image = charts[i].result()
+
+        on_sent = None
+        if state is not None:
+            on_sent = get_mark_posted(state, alert_keys[i], str(row['date_hour']))
+
+        queue.upload_file(location, image, on_sent=on_sent, filename='anomaly.png', initial_comment=forecast_comment)
 
-                    forecast_comment = forecast_comment + f" expected value of ({print_formatted(row['yhat'], row['metric'])})"
 
-                    filepath = create_chart(row)
+def get_mark_posted(state, alert_key, date_hour):
+    def mark_posted(response):
+        state['posted'][alert_key] = date_hour
 
-                    response = client.files_upload(channels=location, file=filepath, initial_comment=forecast_comment)
+    return mark_posted
@@ -0,0 +1,84 @@
+import json
+import os
+from config import in_production, HOURLY_STATE_BUCKET, HOURLY_STATE_DIR
+from helper import not_none
+
+
+'''
+State kept between incremental hourly runs, one JSON document per project and dataset -
+
+{
+    "tables": {
+        table_id: {
+            "watermark": last DateHour read from the table,
+            "sketches": {series key: PercentileSketch.to_dict()},
+        },
+    },
+    "posted": {alert key: DateHour the alert was posted at},
+}
+'''
+
+
+def new_hourly_state():
+    return {'tables': {}, 'posted': {}}
+
+
+def get_state_name(project_id, dataset_id):
+    return f"hourly_state/{project_id}/{dataset_id}.json"
+
+
+def get_state_blob(project_id, dataset_id):
+    from google.cloud import storage
+
+    if in_production:
+        client = storage.Client(project=project_id)
+    else:
+        client = storage.Client.from_service_account_json('watchdog_private_key.json', project=project_id)
+
+    return client.bucket(HOURLY_STATE_BUCKET).blob(get_state_name(project_id, dataset_id))
+
+
+def load_hourly_state(project_id, dataset_id):
+    '''
+    Returns the saved state, or a new one when there is none yet.
+    State is kept in the HOURLY_STATE_BUCKET bucket, or under HOURLY_STATE_DIR when no bucket is set.
+    '''
+    if HOURLY_STATE_BUCKET:
+        blob = get_state_blob(project_id, dataset_id)
+        if not blob.exists():
+            return new_hourly_state()
+        text = blob.download_as_text()
+
+    else:
+        path = os.path.join(HOURLY_STATE_DIR, get_state_name(project_id, dataset_id))
+        if not os.path.exists(path):
+            return new_hourly_state()
+        with open(path) as f:
+            text = f.read()
+
+    return json.loads(text)
+
+
+def save_hourly_state(project_id, dataset_id, state):
+    text = json.dumps(state)
+
+    if HOURLY_STATE_BUCKET:
+        get_state_blob(project_id, dataset_id).upload_from_string(text, content_type='application/json')
+
+    else:
+        path = os.path.join(HOURLY_STATE_DIR, get_state_name(project_id, dataset_id))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so an interrupted run never leaves half a state file
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(text)
+        os.replace(f'{path}.tmp', path)
+
+
+def get_series_key(dim_label, metric):
+    return json.dumps([dim_label, metric], default=str)
+
+
+def get_alert_key(row):
+    dimension = row['dimension'] if not_none(row['dimension']) else None
+    dim_label = row['dim_label'] if not_none(row['dim_label']) else None
+    return json.dumps([row['data_source'], dimension, dim_label, row['metric']], default=str)
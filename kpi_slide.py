@@ -1,5 +1,5 @@
 from helper import print_formatted, print_delta, fix_name, print_comment
-from helper import REVERSE_METRICS, filter_data_by_kpi, get_metric_type
+from helper import REVERSE_METRICS, filter_data_by_kpi, get_number_format
 from dates import yesterday, sdlw, get_previous_week_start_date_end_date, timedelta
 from pptx.enum.shapes import MSO_SHAPE
 from pptx.util import Inches, Cm, Pt
@@ -280,16 +280,7 @@ def add_kpi_chart(kpi_slide, left, top, width, height, kpi, asset_df):
         else:
             line.color.rgb = RGBColor(229, 88, 1)
 
-    metric_type = get_metric_type(kpi.metric)
-
-    if metric_type == 'revenue':
-        yaxis.tick_labels.number_format = '[<1000]"$"0.0;[<999950]"$"0.0,"K";[<999950000]"$"0.0,,"M";"$"0.0,,,"B"'
-    elif metric_type == 'aov':
-        yaxis.tick_labels.number_format = '"$"0'
-    elif metric_type == 'rate':
-        yaxis.tick_labels.number_format = '0%'
-    else:
-        yaxis.tick_labels.number_format = '[<1000]0.0;[<999950]0.0,"K";[<999950000]0.0,,"M";0.0,,,"B"'
+    yaxis.tick_labels.number_format = get_number_format(kpi.metric)
 
 
 def add_kpi_card(kpi_slide, kpi, period, asset_df, left, top):
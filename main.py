@@ -1,11 +1,13 @@
-from create_ppt import create_ppt
-from config import in_production
+from config import in_production, MAX_CONCURRENT_ACCOUNTS
 import base64
 import json
-from send_ppt import send_ppt_to_slack
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from dates import yesterday, get_previous_week_start_date_end_date
-from hourly import send_hourly_alerts
-from data_recency import send_data_recency_alerts
 import warnings
 
 
@@ -45,6 +47,23 @@ def send_ppt(event, context):
         # location = 'watchdog-test'
 
 
+    send_account_ppt(period, account, project_id, location)
+
+    from bigquery import get_client_pool_stats
+    from anomaly_cache import print_anomaly_cache_stats
+    from smtp_session import close_smtp_sessions
+    print(f"BigQuery client pool stats - {get_client_pool_stats()}")
+    print_anomaly_cache_stats()
+    # decks emailed during the run shared one SMTP connection
+    close_smtp_sessions()
+
+
+def send_account_ppt(period, account, project_id, location):
+    # pandas, plotly, python-pptx and slack_sdk are imported on first use, not when the function instance starts
+    from create_ppt import create_ppt
+    from send_ppt import send_ppt_to_slack
+
+    # from data_recency import send_data_recency_alerts
     # send_data_recency_alerts(project_id, account, location)
     ppt, negative_warning_count, negative_critical_count, total_count = create_ppt(project_id, account, period)
 
@@ -71,14 +90,68 @@ def send_ppt(event, context):
     else:
         raise ValueError(f'Invalid period - {period}')
 
+    deck_dir = None
     if in_production:
-        filepath = f"/tmp/{filepath}"
-    ppt.save(filepath)
-    print(f"Saved {filepath}")
-    if total_count > 0:
-        send_ppt_to_slack(filepath, message, location)
+        # a directory per deck, so accounts running in the same process don't overwrite each other.
+        # /tmp is held in memory on Cloud Functions, so it is removed once the deck is sent
+        deck_dir = tempfile.mkdtemp(prefix='watchdog_')
+        filepath = os.path.join(deck_dir, filepath)
+    try:
+        ppt.save(filepath)
+        print(f"Saved {filepath}")
+        if total_count > 0:
+            send_ppt_to_slack(filepath, message, location)
+        else:
+            send_ppt_to_slack(None, message, location)
+    finally:
+        if deck_dir is not None:
+            shutil.rmtree(deck_dir, ignore_errors=True)
+
+
+def run_account_job(job):
+    start = time.perf_counter()
+    try:
+        send_account_ppt(job['period'], job['account'], job['project_id'], job['location'])
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
     else:
-        send_ppt_to_slack(None, message, location)
+        error = None
+
+    return {
+        'account': job['account'],
+        'period': job['period'],
+        'seconds': time.perf_counter() - start,
+        'error': error,
+    }
+
+
+def send_ppt_batch(event, context):
+    '''
+    Runs every {period, account, project_id, location} job of a Pub/Sub message in one warm process.
+    Accounts run concurrently and share the BigQuery clients, schema catalogs and chart renderer;
+    a failing account is logged and does not stop the others.
+    '''
+    pubsub_msg = base64.b64decode(event['data']).decode('utf-8')
+    jobs = json.loads(pubsub_msg)['jobs']
+    print(f"Running {len(jobs)} account jobs")
+
+    with ThreadPoolExecutor(max_workers=max(1, MAX_CONCURRENT_ACCOUNTS)) as executor:
+        results = list(executor.map(run_account_job, jobs))
+
+    for result in results:
+        status = f"failed - {result['error']}" if result['error'] else "ok"
+        print(f"{result['account']} {result['period']} : {result['seconds']:.1f}s {status}")
+
+    from bigquery import get_client_pool_stats
+    from anomaly_cache import print_anomaly_cache_stats
+    from smtp_session import close_smtp_sessions
+    print(f"BigQuery client pool stats - {get_client_pool_stats()}")
+    print_anomaly_cache_stats()
+    # decks emailed during the run shared one SMTP connection
+    close_smtp_sessions()
+
+    return results
 
 
 if not in_production:
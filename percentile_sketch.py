@@ -0,0 +1,105 @@
+import numpy as np
+
+
+DEFAULT_K = 200
+
+
+class PercentileSketch:
+    '''
+    Mergeable quantile sketch (KLL style) for the percentile ranks of a series that grows over time.
+
+    Level h holds values that each stand for 2**h added values. When a level holds more than k values
+    it is sorted and every other value is promoted to the next level, so the sketch keeps about k values
+    per level however long the series gets. Ranks are exact until the first compaction and within about
+    1/k of pandas rank(pct=True) after it.
+    '''
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.n = 0
+        self.compactions = 0
+        self.levels = [np.empty(0)]
+        self._cdf = None
+
+    def __len__(self):
+        return self.n
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.shape[0] == 0:
+            return
+
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += values.shape[0]
+        self._compress()
+
+    def merge(self, other):
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+
+        self.n += other.n
+        self._compress()
+        return self
+
+    def _compress(self):
+        self._cdf = None
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if level.shape[0] > self.k:
+                level = np.sort(level)
+                # an odd value out stays behind, so the weights still add up to n
+                keep = level.shape[0] % 2
+                # alternating which value of each pair survives keeps the rank error from drifting one way
+                offset = keep + self.compactions % 2
+                self.compactions += 1
+
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], level[offset::2]])
+                self.levels[h] = level[:keep]
+            h += 1
+
+    def _get_cdf(self):
+        if self._cdf is None:
+            values = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(level.shape[0], 2 ** h) for h, level in enumerate(self.levels)])
+            order = np.argsort(values, kind='stable')
+            self._cdf = values[order], np.concatenate([[0], np.cumsum(weights[order])])
+
+        return self._cdf
+
+    def rank(self, values):
+        '''
+        Percentile rank of each of values among everything added, as rank(pct=True) would give it.
+        Costs a binary search over the sketch, independent of how many values were added.
+        '''
+        values = np.asarray(values, dtype=float)
+        if self.n == 0:
+            return np.full(values.shape, np.nan)
+
+        sorted_values, cumulative_weights = self._get_cdf()
+        less = cumulative_weights[np.searchsorted(sorted_values, values, side='left')]
+        less_or_equal = cumulative_weights[np.searchsorted(sorted_values, values, side='right')]
+
+        # average rank of the tied values, as rank(method='average') gives
+        ranks = (less + less_or_equal + 1) / (2 * self.n)
+        return np.where(np.isnan(values), np.nan, ranks)
+
+    def to_dict(self):
+        return {
+            'k': self.k,
+            'n': self.n,
+            'compactions': self.compactions,
+            'levels': [level.tolist() for level in self.levels],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['k'])
+        sketch.n = state['n']
+        sketch.compactions = state['compactions']
+        sketch.levels = [np.asarray(level, dtype=float) for level in state['levels']]
+        return sketch
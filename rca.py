@@ -1,180 +1,280 @@
-from helper import print_anomaly, check_warning, check_critical, Element
-from anytree import NodeMixin, RenderTree
-from rca_association_rules import association_rules_root_nodes
+from helper import print_anomaly, is_none
+from helper import check_warning_array, check_critical_array
+from rca_association_rules import get_association_rules
 import re
-import itertools
+import numpy as np
+import pandas as pd
 from collections import defaultdict
 
 
-class Node(NodeMixin):
-    def __init__(self, y, y_prev, yhat, yhat_upper, yhat_lower, anomaly_type, is_warning, is_critical, data_source, period, dimension, dim_label, metric, revenue_impact, parent=None, reverse_effect_on_parent=False, children=None):
-        self.y = y
-        self.y_prev = y_prev
-        self.yhat = yhat
-        self.yhat_upper = yhat_upper
-        self.yhat_lower = yhat_lower
-        self.anomaly_type = anomaly_type
-        self.data_source = data_source
-        self.period = period
-        self.dimension = dimension
-        self.dim_label = dim_label
-        self.metric = metric
-        self.revenue_impact = revenue_impact
-        self.parent = parent
-        self.reverse_effect_on_parent = reverse_effect_on_parent
-        self.printed = False
-        self.is_anomaly = anomaly_type in [1, -1]
-        self.is_warning = is_warning
-        self.is_critical = is_critical
-        if children:
-            self.children = children
-
-
-def filter_data_by_association_rules_node(asset_df, association_rules_node, parent_node=None):
-    if association_rules_node.data_source == 'same_as_parent':
-        data_source_mask = asset_df['data_source'] == parent_node.data_source
-    else:
-        data_source_mask = asset_df['data_source'] == association_rules_node.data_source
-
-    if association_rules_node.dimension:
-        if association_rules_node.dimension == 'same_as_parent':
-            dimension_mask = asset_df['dimension'] == parent_node.dimension
+RULE_KEY_COLUMNS = ['data_source', 'dimension', 'dim_label', 'metric']
+
+
+class AssociationRulesMatcher:
+    '''
+    Finds the rows rca_reference.filter_data_by_association_rules_node returns for an association rule and parent,
+    by lookups instead of scans of asset_df.
+
+    Each rule is compiled once per asset_df: its fixed values, patterns and exclusions are evaluated
+    once per distinct value of each key column (so a regex runs once per distinct dim_label), and the
+    matching rows are indexed by the values of its same_as_parent columns.
+    '''
+    def __init__(self, asset_df):
+        self.asset_df = asset_df
+        self.codes = {}
+        self.uniques = {}
+        self.value_codes = {}
+        for column in RULE_KEY_COLUMNS:
+            codes, uniques = pd.factorize(asset_df[column])
+            self.codes[column] = codes
+            self.uniques[column] = list(uniques)
+            self.value_codes[column] = {value: code for code, value in enumerate(self.uniques[column])}
+        self.rules = {}
+
+    def get_value_mask(self, column, is_match, match_null=False):
+        '''
+        Row mask of is_match(value), called once per distinct value of column. Null values match when match_null.
+        '''
+        value_mask = [bool(is_match(value)) for value in self.uniques[column]]
+        return np.array(value_mask + [match_null], dtype=bool)[self.codes[column]]
+
+    def compile(self, rule):
+        mask = np.ones(self.asset_df.shape[0], dtype=bool)
+        parent_columns = []
+
+        if rule.data_source == 'same_as_parent':
+            parent_columns.append('data_source')
         else:
-            dimension_mask = asset_df['dimension'] == association_rules_node.dimension
-    else:
-        dimension_mask = asset_df['dimension'].isnull()
-
-    if association_rules_node.dim_label:
-        if isinstance(association_rules_node.dim_label, re.Pattern):
-            dim_label_mask = asset_df['dim_label'].str.match(association_rules_node.dim_label)
-        elif association_rules_node.dim_label == 'same_as_parent':
-            dim_label_mask = asset_df['dim_label'] == parent_node.dim_label
-        else:
-            dim_label_mask = asset_df['dim_label'] == association_rules_node.dim_label
-    else:
-        dim_label_mask = asset_df['dim_label'].isnull()
-
-    if isinstance(association_rules_node.metric, re.Pattern):
-        metric_mask = asset_df['metric'].str.match(association_rules_node.metric)
-    else:
-        metric_mask = asset_df['metric'] == association_rules_node.metric
-
-    if association_rules_node.dim_labels_to_be_excluded:
-        exclude_dim_labels_mask = asset_df['dim_label'].isin(association_rules_node.dim_labels_to_be_excluded)
-    else:
-        exclude_dim_labels_mask = False
-
-    if association_rules_node.metrics_to_be_excluded:
-        exclude_metrics_mask = asset_df['metric'].isin(association_rules_node.metrics_to_be_excluded)
-    else:
-        exclude_metrics_mask = False
-
-    filtered_df = asset_df[data_source_mask & dimension_mask & dim_label_mask & metric_mask & ~exclude_dim_labels_mask & ~exclude_metrics_mask]
-    return filtered_df
-
-
-def get_nodes_from_df(filtered_df):
-    nodes_list = []
-    for index, row in filtered_df.iterrows():
-        y = row['y']
-        y_prev = row['y_prev']
-        yhat = row['yhat']
-        y_prev_lower = row['y_prev_lower']
-        y_prev_upper = row['y_prev_upper']
-        yhat_upper = row['yhat_upper']
-        yhat_lower = row['yhat_lower']
-        data_source = row['data_source']
-        period = row['period']
-        dimension = row['dimension']
-        dim_label = row['dim_label']
-        metric = row['metric']
-        anomaly_type = row['yhat_anomaly_type']
-        revenue_impact = row['revenue_impact']
-        # is_critical = check_critical(y, upper=y_prev_upper, lower=y_prev_lower)
-        is_critical = check_critical(y, upper=yhat_upper, lower=yhat_lower)
-        is_warning = check_warning(y, upper=yhat_upper, lower=yhat_lower)
-        node = Node(y, y_prev, yhat, yhat_upper, yhat_lower, anomaly_type, is_warning, is_critical, data_source, period, dimension, dim_label, metric, revenue_impact)
-        nodes_list.append(node)
-
-    nodes_list = sorted(nodes_list, key=lambda node: abs(node.revenue_impact), reverse=True)
-
-    return nodes_list
-
-
-def build_tree_with_all_metrics(asset_df, association_rules_node, parent_node=None, parent_association_rules_node=None):
-    if parent_node:
-        filtered_df = filter_data_by_association_rules_node(asset_df, association_rules_node, parent_node)
-    else:
-        filtered_df = filter_data_by_association_rules_node(asset_df, association_rules_node, parent_node=parent_association_rules_node)
-
-    root_nodes_list = get_nodes_from_df(filtered_df)
-
-
-    'if data is not available for the root nodes'
-    if not root_nodes_list:
-        'create root nodes from the children'
-        for association_rules_child in association_rules_node.children:
-            root_nodes_list = build_tree_with_all_metrics(asset_df, association_rules_child, parent_node, association_rules_node)
-            for root_node in root_nodes_list:
-                root_node.parent = parent_node
-        return root_nodes_list
-
-    else:
-        for root_node in root_nodes_list:
-            for association_rules_child in association_rules_node.children:
-                child_nodes_list = build_tree_with_all_metrics(asset_df, association_rules_child, root_node, association_rules_node)
-                for child_node in child_nodes_list:
-                    child_node.parent = root_node
-
-        if association_rules_node.reverse_effect_on_parent:
-            for node in root_nodes_list:
-                node.reverse_effect_on_parent = True
-
-    return root_nodes_list
+            mask &= self.get_value_mask('data_source', lambda value: value == rule.data_source)
 
+        if not rule.dimension:
+            mask &= self.codes['dimension'] == -1
+        elif rule.dimension == 'same_as_parent':
+            parent_columns.append('dimension')
+        else:
+            mask &= self.get_value_mask('dimension', lambda value: value == rule.dimension)
+
+        if not rule.dim_label:
+            mask &= self.codes['dim_label'] == -1
+        elif isinstance(rule.dim_label, re.Pattern):
+            mask &= self.get_value_mask('dim_label', lambda value: isinstance(value, str) and rule.dim_label.match(value))
+        elif rule.dim_label == 'same_as_parent':
+            parent_columns.append('dim_label')
+        else:
+            mask &= self.get_value_mask('dim_label', lambda value: value == rule.dim_label)
 
-# nodes_list = rca_nodes_list
-# node = nodes_list[0]
-def keep_only_anomalies(nodes_list, parent_anomaly_type=None):
-    if not nodes_list:
-        return []
-
-    processed_nodes_list = []
-    for node in nodes_list:
-        same_anomaly_as_parent = (parent_anomaly_type == node.anomaly_type) and not node.reverse_effect_on_parent
-        reverse_effect_on_parent = (parent_anomaly_type == -node.anomaly_type) and node.reverse_effect_on_parent
-        node_explains_parent_anomaly = same_anomaly_as_parent or reverse_effect_on_parent
-
-        if parent_anomaly_type is None:
-            if node.is_anomaly:
-                processed_nodes_list.append(node)
-                node.children = keep_only_anomalies(node.children, node.anomaly_type)
-            else:
-                pass
+        if isinstance(rule.metric, re.Pattern):
+            mask &= self.get_value_mask('metric', lambda value: isinstance(value, str) and rule.metric.match(value))
         else:
-            if node_explains_parent_anomaly:
-                processed_nodes_list.append(node)
-                node.children = keep_only_anomalies(node.children, node.anomaly_type)
-            elif node.reverse_effect_on_parent:
-                processed_children_list = keep_only_anomalies(node.children, -parent_anomaly_type)
-                processed_nodes_list.extend(processed_children_list)
-            else:
-                pass
+            mask &= self.get_value_mask('metric', lambda value: value == rule.metric)
+
+        for column, excluded in [('dim_label', rule.dim_labels_to_be_excluded), ('metric', rule.metrics_to_be_excluded)]:
+            if excluded:
+                excluded_mask = self.asset_df[column].isin(excluded).values
+                mask &= ~excluded_mask
+
+        # rows by the codes of their same_as_parent values, in asset_df order
+        index = defaultdict(list)
+        for position in np.flatnonzero(mask):
+            key = tuple(self.codes[column][position] for column in parent_columns)
+            if -1 not in key:
+                index[key].append(position)
+
+        return parent_columns, {key: np.array(positions) for key, positions in index.items()}
+
+    def get_rule(self, rule):
+        if id(rule) not in self.rules:
+            self.rules[id(rule)] = self.compile(rule)
+
+        return self.rules[id(rule)]
+
+    def match(self, rule, parent=None):
+        '''
+        Positions of the rows of asset_df matching rule under parent, in asset_df order.
+        parent is the data node or association rule a same_as_parent value is taken from.
+        '''
+        parent_columns, index = self.get_rule(rule)
+
+        key = []
+        for column in parent_columns:
+            value = getattr(parent, column)
+            # == against a null or unseen value matches no row
+            if is_none(value) or value not in self.value_codes[column]:
+                return np.empty(0, dtype=np.intp)
+            key.append(self.value_codes[column][value])
+
+        return index.get(tuple(key), np.empty(0, dtype=np.intp))
+
+    def match_row(self, rule, position):
+        '''
+        match() with the row at position of asset_df as the parent.
+        '''
+        parent_columns, index = self.get_rule(rule)
+        key = tuple(self.codes[column][position] for column in parent_columns)
+        return index.get(key, np.empty(0, dtype=np.intp))
+
+
+# branch prefixes of anytree's ContStyle, which RenderTree uses by default
+RENDER_VERTICAL = '\u2502   '
+RENDER_CONT = '\u251c\u2500\u2500 '
+RENDER_END = '\u2514\u2500\u2500 '
+RENDER_EMPTY = '    '
+
+RCA_NODE_COLUMNS = ['data_source', 'period', 'dimension', 'dim_label', 'metric', 'y', 'y_prev', 'yhat', 'yhat_upper', 'yhat_lower', 'revenue_impact']
+
+
+class RcaTree:
+    '''
+    The RCA tree kept in arrays instead of anytree Node objects.
+
+    Node i stands for row positions[i] of asset_df. parents[i] is its parent (-1 for none) and children[i]
+    its children in order, so building and pruning the tree is list appends rather than anytree's
+    parent link checks. The attributes print_anomaly reads are taken from asset_df for the printed nodes only.
+    rca_reference.py keeps the anytree version the tree is checked against.
+    '''
+    def __init__(self, asset_df):
+        self.asset_df = asset_df
+        self.anomaly_types = asset_df['yhat_anomaly_type'].tolist()
+        self.revenue_impacts = asset_df['revenue_impact'].tolist()
+
+        self.positions = []
+        self.parents = []
+        self.children = []
+        self.reverse_effect_on_parent = []
+        self.printed = []
+
+    def add_nodes(self, positions):
+        # by absolute revenue impact
+        positions = sorted(positions, key=lambda position: abs(self.revenue_impacts[position]), reverse=True)
+
+        nodes = list(range(len(self.positions), len(self.positions) + len(positions)))
+        self.positions.extend(positions)
+        self.parents.extend([-1] * len(positions))
+        self.children.extend([] for _ in positions)
+        self.reverse_effect_on_parent.extend([False] * len(positions))
+        self.printed.extend([False] * len(positions))
+
+        return nodes
+
+    def set_parent(self, node, parent):
+        old_parent = self.parents[node]
+        if old_parent == parent:
+            return
+
+        if old_parent != -1:
+            self.children[old_parent].remove(node)
+        self.parents[node] = parent
+        if parent != -1:
+            self.children[parent].append(node)
+
+    def set_children(self, node, children):
+        for child in self.children[node]:
+            self.parents[child] = -1
+        self.children[node] = []
+
+        for child in children:
+            self.set_parent(child, node)
+
+    def get_anomaly_type(self, node):
+        return self.anomaly_types[self.positions[node]]
+
+    def build(self, association_rules_node, matcher, parent=-1, parent_association_rules_node=None):
+        '''
+        Adds the nodes matched for association_rules_node under parent, and their subtrees, and returns them.
+        Without data for the rule, its children's nodes take its place.
+        '''
+        if parent != -1:
+            positions = matcher.match_row(association_rules_node, self.positions[parent])
+        else:
+            positions = matcher.match(association_rules_node, parent_association_rules_node)
 
-    return processed_nodes_list
+        root_nodes = self.add_nodes(positions)
 
+        if not root_nodes:
+            # no data for this rule, its children's nodes take its place
+            for association_rules_child in association_rules_node.children:
+                root_nodes = self.build(association_rules_child, matcher, parent, association_rules_node)
+                for root_node in root_nodes:
+                    self.set_parent(root_node, parent)
+            return root_nodes
 
-def print_tree_from_node(input_node, p):
-    if input_node and input_node.children and not input_node.printed:
-        for pre, fill, node in RenderTree(input_node):
-            node.printed = True
-            print_anomaly(p, node, pre)
+        for root_node in root_nodes:
+            for association_rules_child in association_rules_node.children:
+                for child_node in self.build(association_rules_child, matcher, root_node, association_rules_node):
+                    self.set_parent(child_node, root_node)
 
+        if association_rules_node.reverse_effect_on_parent:
+            for node in root_nodes:
+                self.reverse_effect_on_parent[node] = True
 
-def print_revenue_rca(asset_df, p):
-    rca_nodes_list = build_tree_with_all_metrics(asset_df, association_rules_root_nodes[0])
-    rca_nodes_list = keep_only_anomalies(rca_nodes_list)
+        return root_nodes
 
-    for root_node in rca_nodes_list:
-        print_tree_from_node(root_node, p)
+    def keep_only_anomalies(self, nodes, parent_anomaly_type=None):
+        processed_nodes = []
+        for node in nodes:
+            anomaly_type = self.get_anomaly_type(node)
+            reverse_effect_on_parent = self.reverse_effect_on_parent[node]
 
+            if parent_anomaly_type is None:
+                if anomaly_type in [1, -1]:
+                    processed_nodes.append(node)
+                    self.set_children(node, self.keep_only_anomalies(self.children[node], anomaly_type))
+            else:
+                same_anomaly_as_parent = (parent_anomaly_type == anomaly_type) and not reverse_effect_on_parent
+                reverse_anomaly_of_parent = (parent_anomaly_type == -anomaly_type) and reverse_effect_on_parent
+
+                if same_anomaly_as_parent or reverse_anomaly_of_parent:
+                    processed_nodes.append(node)
+                    self.set_children(node, self.keep_only_anomalies(self.children[node], anomaly_type))
+                elif reverse_effect_on_parent:
+                    processed_nodes.extend(self.keep_only_anomalies(self.children[node], -parent_anomaly_type))
+
+        return processed_nodes
+
+    def render(self, node, continues=()):
+        '''
+        Yields (prefix, node) for node and its descendants, in the order and with the prefixes of RenderTree.
+        '''
+        if continues:
+            indent = ''.join(RENDER_VERTICAL if is_continued else RENDER_EMPTY for is_continued in continues[:-1])
+            pre = indent + (RENDER_CONT if continues[-1] else RENDER_END)
+        else:
+            pre = ''
+        yield pre, node
+
+        children = self.children[node]
+        for i, child in enumerate(children):
+            yield from self.render(child, continues + (i < len(children) - 1,))
+
+    def get_node_table(self, nodes):
+        '''
+        One row per node with the attributes print_anomaly reads.
+        '''
+        positions = [self.positions[node] for node in nodes]
+        node_df = self.asset_df[RCA_NODE_COLUMNS].iloc[positions].reset_index(drop=True)
+        node_df['anomaly_type'] = [self.anomaly_types[position] for position in positions]
+        node_df['is_warning'] = check_warning_array(node_df['y'], upper=node_df['yhat_upper'], lower=node_df['yhat_lower'])
+        node_df['is_critical'] = check_critical_array(node_df['y'], upper=node_df['yhat_upper'], lower=node_df['yhat_lower'])
+        node_df['reverse_effect_on_parent'] = [self.reverse_effect_on_parent[node] for node in nodes]
+
+        return node_df
+
+    def print_tree_from_node(self, input_node, p):
+        if self.children[input_node] and not self.printed[input_node]:
+            rendered = list(self.render(input_node))
+            node_df = self.get_node_table([node for _, node in rendered])
+            for (pre, node), row in zip(rendered, node_df.itertuples(index=False)):
+                self.printed[node] = True
+                print_anomaly(p, row, pre)
+
+
+def print_revenue_rca(asset_df, p, account=None):
+    rca_tree = RcaTree(asset_df)
+    matcher = AssociationRulesMatcher(asset_df)
+
+    for association_rules_root_node in get_association_rules(account):
+        rca_nodes_list = rca_tree.build(association_rules_root_node, matcher)
+        rca_nodes_list = rca_tree.keep_only_anomalies(rca_nodes_list)
+
+        for root_node in rca_nodes_list:
+            rca_tree.print_tree_from_node(root_node, p)
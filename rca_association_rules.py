@@ -1,5 +1,10 @@
 from anytree import NodeMixin, RenderTree
+from config import ASSOCIATION_RULES_SOURCE, ASSOCIATION_RULES_PATH, ASSOCIATION_RULES_TABLE, ASSOCIATION_RULES_CHECK_SECONDS
+import json
+import os
 import re
+import threading
+import time
 
 
 class AssociationTreeNode(NodeMixin):
@@ -19,24 +24,271 @@ class AssociationTreeNode(NodeMixin):
             self.children = children
 
 
+'''
+Association rules are declared per account, as JSON -
 
-'''Ecommerce Tree'''
-n1 = AssociationTreeNode(id='n1', data_source='Ecommerce', dimension=None, dim_label=None, metric='Total_Sales')
-n2 = AssociationTreeNode(id='n2', data_source='Ecommerce', dimension=None, dim_label=None, metric='AOV', parent=n1)
-n3 = AssociationTreeNode(id='n3', data_source='Ecommerce', dimension=None, dim_label=None, metric='Orders', parent=n1)
-n4 = AssociationTreeNode(id='n4', data_source='mwsAds', dimension=None, dim_label=None, metric='Conversion_Rate', parent=n3)
-n5 = AssociationTreeNode(id='n5', data_source='mwsAds', dimension=None, dim_label=None, metric='Clicks', parent=n3)
-n6 = AssociationTreeNode(id='n6', data_source='mwsAds', dimension=None, dim_label=None, metric='Ad_Spend', parent=n5)
-n7 = AssociationTreeNode(id='n7', data_source='mwsAds', dimension=None, dim_label=None, metric='ACOS', parent=n5)
+{
+    account (or "default" for every other account): [
+        {
+            "id": unique within the account,
+            "data_source": name, or "same_as_parent",
+            "dimension": name, "same_as_parent", or null for the rows without a dimension,
+            "dim_label": label, {"regex": pattern}, "same_as_parent", or null for the rows without a dim_label,
+            "metric": name or {"regex": pattern},
+            "reverse_effect_on_parent": true when the metric moves against its parent,
+            "dim_labels_to_be_excluded": [label, ...],
+            "metrics_to_be_excluded": [metric, ...],
+            "children": [rule, ...],
+        },
+    ],
+}
 
+or as rows of the ASSOCIATION_RULES_TABLE table, with the same fields plus account, parent_id,
+sequence_no (the order of siblings) and dim_label_regex / metric_regex flags.
+'''
 
-association_rules_root_nodes = [n1]
+DEFAULT_ACCOUNT = 'default'
 
+RULE_KEYS = {
+    'id', 'data_source', 'dimension', 'dim_label', 'metric', 'reverse_effect_on_parent',
+    'dim_labels_to_be_excluded', 'metrics_to_be_excluded', 'children',
+}
 
+SAME_AS_PARENT = 'same_as_parent'
 
-print("Association rules -")
-for pre, fill, node in RenderTree(n1):
-    if node.reverse_effect_on_parent:
-        print(f"{pre}{node.name} (Reverse)")
-    else:
-        print(f"{pre}{node.name}")
+
+def load_rules_file(path=ASSOCIATION_RULES_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_rules_file_version(path=ASSOCIATION_RULES_PATH):
+    return os.stat(path).st_mtime_ns
+
+
+def load_rules_table(table=ASSOCIATION_RULES_TABLE):
+    from bigquery import get_bigquery_client
+
+    project_id = table.split('.')[0]
+    query = f"SELECT * FROM `{table}` ORDER BY account, sequence_no"
+    rows_df = (
+        get_bigquery_client(project_id).query(query)
+            .result()
+            .to_dataframe()
+    )
+
+    return get_rules_from_rows(rows_df.to_dict('records'))
+
+
+def get_rules_table_version(table=ASSOCIATION_RULES_TABLE):
+    from bigquery import get_bigquery_client
+
+    return get_bigquery_client(table.split('.')[0]).get_table(table).modified.isoformat()
+
+
+def get_rules_from_rows(rows):
+    '''
+    Nests the rows of the rules table (in sequence_no order) into the JSON form.
+    '''
+    def get_value(row, key):
+        value = row.get(key)
+        # BigQuery NULLs arrive as None or NaN
+        return None if value is None or value != value else value
+
+    rules = {}
+    rules_by_id = {}
+    for row in rows:
+        rule = {'id': row['id']}
+        for key in ['data_source', 'dimension', 'dim_label', 'metric']:
+            rule[key] = get_value(row, key)
+        for key in ['dim_label', 'metric']:
+            if get_value(row, f'{key}_regex'):
+                rule[key] = {'regex': rule[key]}
+        rule['reverse_effect_on_parent'] = bool(get_value(row, 'reverse_effect_on_parent'))
+        for key in ['dim_labels_to_be_excluded', 'metrics_to_be_excluded']:
+            values = get_value(row, key)
+            rule[key] = list(values) if values is not None and len(values) > 0 else None
+        rules_by_id[(row['account'], row['id'])] = rule
+
+    for row in rows:
+        rule = rules_by_id[(row['account'], row['id'])]
+        parent_id = get_value(row, 'parent_id')
+        if parent_id is None:
+            rules.setdefault(row['account'], []).append(rule)
+        elif (row['account'], parent_id) in rules_by_id:
+            rules_by_id[(row['account'], parent_id)].setdefault('children', []).append(rule)
+        else:
+            raise ValueError(f"Association rule {row['account']} {row['id']} : parent {parent_id} not found")
+
+    return rules
+
+
+def validate_rule(account, rule, ids, is_root):
+    if not isinstance(rule, dict):
+        raise ValueError(f"Association rule for {account} is not an object : {rule!r}")
+
+    rule_id = rule.get('id')
+    if not isinstance(rule_id, str) or not rule_id:
+        raise ValueError(f"Association rule for {account} has no id : {rule!r}")
+
+    def error(message):
+        return ValueError(f"Association rule {account} {rule_id} : {message}")
+
+    if rule_id in ids:
+        raise error('duplicate id')
+    ids.add(rule_id)
+
+    unknown_keys = set(rule) - RULE_KEYS
+    if unknown_keys:
+        raise error(f"unknown keys {sorted(unknown_keys)}")
+
+    for key in ['data_source', 'metric']:
+        if not rule.get(key):
+            raise error(f"{key} is required")
+
+    for key in ['data_source', 'dimension', 'dim_label', 'metric']:
+        value = rule.get(key)
+        if isinstance(value, dict):
+            if key not in ['dim_label', 'metric'] or set(value) != {'regex'}:
+                raise error(f"{key} must be a name or, for dim_label and metric, {{\"regex\": pattern}}")
+            try:
+                re.compile(value['regex'])
+            except (re.error, TypeError) as e:
+                raise error(f"invalid {key} regex {value['regex']!r} - {e}")
+        elif value is not None and not isinstance(value, str):
+            raise error(f"{key} must be a string")
+
+        if value == SAME_AS_PARENT and (is_root or key == 'metric'):
+            raise error(f"{key} can't be {SAME_AS_PARENT}" + (" on a root rule" if is_root else ""))
+
+    if not isinstance(rule.get('reverse_effect_on_parent', False), bool):
+        raise error('reverse_effect_on_parent must be true or false')
+
+    for key in ['dim_labels_to_be_excluded', 'metrics_to_be_excluded']:
+        values = rule.get(key)
+        if values is not None and not (isinstance(values, list) and all(isinstance(value, str) for value in values)):
+            raise error(f"{key} must be a list of strings")
+
+    children = rule.get('children', [])
+    if not isinstance(children, list):
+        raise error('children must be a list')
+    for child in children:
+        validate_rule(account, child, ids, is_root=False)
+
+
+def validate_rules(rules):
+    if not isinstance(rules, dict):
+        raise ValueError("Association rules must map accounts to lists of rules")
+
+    for account, account_rules in rules.items():
+        if not isinstance(account_rules, list):
+            raise ValueError(f"Association rules for {account} must be a list")
+        ids = set()
+        for rule in account_rules:
+            validate_rule(account, rule, ids, is_root=True)
+
+
+def compile_pattern(value):
+    if isinstance(value, dict):
+        return re.compile(value['regex'])
+    return value
+
+
+def build_rule_tree(rule, parent=None):
+    node = AssociationTreeNode(
+        id=rule['id'],
+        data_source=rule['data_source'],
+        dimension=rule.get('dimension'),
+        dim_label=compile_pattern(rule.get('dim_label')),
+        metric=compile_pattern(rule['metric']),
+        parent=parent,
+        reverse_effect_on_parent=rule.get('reverse_effect_on_parent', False),
+        dim_labels_to_be_excluded=rule.get('dim_labels_to_be_excluded'),
+        metrics_to_be_excluded=rule.get('metrics_to_be_excluded'),
+    )
+    for child in rule.get('children', []):
+        build_rule_tree(child, node)
+
+    return node
+
+
+def compile_rules(rules):
+    '''
+    Validates rules and builds the AssociationTreeNode trees of every account, with the patterns compiled.
+    '''
+    validate_rules(rules)
+    return {account: [build_rule_tree(rule) for rule in account_rules] for account, account_rules in rules.items()}
+
+
+class AssociationRules:
+    '''
+    The compiled association rules of every account, loaded once per process.
+    The source is checked for changes at most every check_seconds and reloaded when it has changed;
+    if a reload fails validation, the rules already loaded stay in use.
+    '''
+    def __init__(self, source=ASSOCIATION_RULES_SOURCE, check_seconds=ASSOCIATION_RULES_CHECK_SECONDS):
+        if source == 'bigquery':
+            self.load, self.get_version = load_rules_table, get_rules_table_version
+        elif source == 'file':
+            self.load, self.get_version = load_rules_file, get_rules_file_version
+        else:
+            raise ValueError(f"Invalid association rules source - {source}")
+
+        self.check_seconds = check_seconds
+        self.version = None
+        self.checked_at = None
+        self.account_rules = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.account_rules is not None and now - self.checked_at < self.check_seconds:
+            return
+        self.checked_at = now
+
+        try:
+            version = self.get_version()
+            if self.account_rules is not None and version == self.version:
+                return
+            account_rules = compile_rules(self.load())
+        except Exception as e:
+            if self.account_rules is None:
+                raise
+            print(f"Association rules not reloaded, keeping version {self.version} : {e}")
+            return
+
+        self.account_rules, self.version = account_rules, version
+        print(f"Loaded association rules version {version} for {len(account_rules)} accounts")
+
+    def get(self, account=None):
+        '''
+        Root rule nodes for account, or the default rules when the account has none of its own.
+        '''
+        with self._lock:
+            self.refresh()
+            if account in self.account_rules:
+                return self.account_rules[account]
+            return self.account_rules.get(DEFAULT_ACCOUNT, [])
+
+
+_association_rules = None
+_association_rules_lock = threading.Lock()
+
+
+def get_association_rules(account=None):
+    global _association_rules
+    with _association_rules_lock:
+        if _association_rules is None:
+            _association_rules = AssociationRules()
+
+    return _association_rules.get(account)
+
+
+def print_association_rules(account=None):
+    print(f"Association rules for {account or DEFAULT_ACCOUNT} -")
+    for root_node in get_association_rules(account):
+        for pre, fill, node in RenderTree(root_node):
+            if node.reverse_effect_on_parent:
+                print(f"{pre}{node.name} (Reverse)")
+            else:
+                print(f"{pre}{node.name}")
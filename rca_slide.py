@@ -9,10 +9,9 @@ from pptx.chart.data import ChartData
 from pptx.enum.chart import XL_CHART_TYPE
 from pptx.dml.color import RGBColor
 from pptx.oxml.xmlchemy import OxmlElement
-import plotly.io as pio
 
 
-def add_rca_slide(ppt, period, asset_df):
+def add_rca_slide(ppt, period, asset_df, account=None):
     blank_slide_layout = ppt.slide_layouts[6]
     rca_slide = ppt.slides.add_slide(blank_slide_layout)
 
@@ -28,4 +27,4 @@ def add_rca_slide(ppt, period, asset_df):
     dimension_text_frame = dimension_textbox.text_frame
     dimension_text_frame.vertical_anchor = MSO_ANCHOR.TOP
     p = dimension_text_frame.paragraphs[0]
-    print_revenue_rca(asset_df, p)
+    print_revenue_rca(asset_df, p, account)
@@ -1,29 +1,21 @@
-import os
-from config import in_production
-from slack_sdk import WebClient
+from config import in_production, SMTP_USERNAME
+from slack_delivery import call_slack
+from smtp_session import get_smtp_session, get_message_bytes
 import re
-import smtplib, ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
 
-SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN", "replace_slack_bot_token")
-SMTP_USERNAME = os.getenv("ALERT_SMTP_USERNAME", "your_smtp_username")
-SMTP_PASSWORD = os.getenv("ALERT_SMTP_PASSWORD", "your_smtp_password")
 
-
-def send_text_to_slack(text, location):
+def get_text_location(location):
     # if not in_production:
     location = 'wdt2'
     # location = 'watchdog-test'
 
-    client = WebClient(token=SLACK_BOT_TOKEN)
+    return location
+
 
-    response = client.chat_postMessage(
-        channel=location,
-        text=text
-    )
+def send_text_to_slack(text, location):
+    location = get_text_location(location)
+
+    response = call_slack('chat_postMessage', channel=location, text=text)
 
 
 def is_email(text):
@@ -33,39 +25,16 @@ def is_email(text):
 
 def send_mail(recipient, subject, message, filepath=None):
     username = SMTP_USERNAME
-    password = SMTP_PASSWORD
-    msg = MIMEMultipart()
-    msg['From'] = username
-    if ',' in recipient:
-        msg['To'] = ', '.join(recipient.split(','))
-        print(f"to is {msg['To']}||end")
-    else:
-        msg['To'] = recipient
-    msg['Subject'] = subject
-    msg.attach(MIMEText(message))
-
-    if filepath:
-        filename = filepath.split('/')[-1]
-        attachment = open(filepath, "rb")
-
-        p = MIMEBase('application', 'octet-stream')
-
-        p.set_payload((attachment).read())
-
-        encoders.encode_base64(p)
-
-        p.add_header('Content-Disposition', "attachment; filename= %s" % filename)
-        msg.attach(p)
+    recipients = [address.strip() for address in recipient.split(',')]
+    if len(recipients) > 1:
+        print(f"to is {', '.join(recipients)}||end")
+    message_bytes, marker = get_message_bytes(username, recipient, subject, message, filepath)
 
     try:
         print('sending mail to ' + recipient + ' on ' + subject)
-        mailServer = smtplib.SMTP('smtp-mail.outlook.com', 587)
-        mailServer.ehlo()
-        mailServer.starttls()
-        mailServer.ehlo()
-        mailServer.login(username, password)
-        mailServer.sendmail(username, recipient, msg.as_string())
-        mailServer.close()
+        refused = get_smtp_session().send(username, recipients, message_bytes, marker, filepath)
+        for address, (code, resp) in refused.items():
+            print(f'Mail on {subject} not delivered to {address} : {code} {resp.decode(errors="replace")}')
 
     except Exception as e:
         print(f'Error sending mail regarding msg - "{message}"')
@@ -73,8 +42,6 @@ def send_mail(recipient, subject, message, filepath=None):
 
 
 def send_ppt_to_slack(filepath, message, location):
-    client = WebClient(token=SLACK_BOT_TOKEN)
-
     if not in_production:
         location = 'wdt2'
         # location = 'watchdog-test'
@@ -89,11 +56,11 @@ def send_ppt_to_slack(filepath, message, location):
         if is_email(location):
             send_mail(recipient=location, subject=f"Watchdog - {message}", message='')
         else:
-            response = client.chat_postMessage(channel=location, text=message)
+            response = call_slack('chat_postMessage', channel=location, text=message)
 
     else:
         if is_email(location):
             send_mail(recipient=location, subject=f"Watchdog - {message}", message='', filepath=filepath)
         else:
-            response = client.files_upload(channels=location, file=filepath, filetype='pptx', initial_comment=message)
+            response = call_slack('files_upload', channels=location, file=filepath, filetype='pptx', initial_comment=message)
 
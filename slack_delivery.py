@@ -0,0 +1,171 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from config import SLACK_BOT_TOKEN, SLACK_API_URL, SLACK_MAX_RETRIES, SLACK_UPLOAD_WORKERS
+
+
+# calls a minute allowed per token for each Web API method, from Slack's rate limit tiers
+SLACK_RATE_LIMITS = {
+    'chat_postMessage': 60,  # about one message a second per channel
+    'files_upload': 20,  # tier 2
+}
+DEFAULT_RATE_LIMIT = 20
+
+_slack_clients = {}
+_rate_limiters = {}
+_slack_clients_lock = threading.Lock()
+
+
+class RateLimiter:
+    '''
+    Token bucket allowing bursts of up to calls_per_minute calls, refilled at calls_per_minute a minute.
+    pause() holds every call back, as Slack asks with the Retry-After of a 429.
+    '''
+    def __init__(self, calls_per_minute):
+        self.rate = calls_per_minute / 60
+        self.capacity = calls_per_minute
+        self.tokens = calls_per_minute
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def get_slack_client(token=SLACK_BOT_TOKEN):
+    '''
+    Returns the pooled WebClient for token, creating it on first use.
+    '''
+    with _slack_clients_lock:
+        client = _slack_clients.get(token)
+        if client is None:
+            client = WebClient(token=token, base_url=SLACK_API_URL)
+            _slack_clients[token] = client
+
+    return client
+
+
+def get_rate_limiter(token, method):
+    with _slack_clients_lock:
+        limiter = _rate_limiters.get((token, method))
+        if limiter is None:
+            limiter = RateLimiter(SLACK_RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))
+            _rate_limiters[(token, method)] = limiter
+
+    return limiter
+
+
+def get_retry_after(response):
+    for key, value in response.headers.items():
+        if key.lower() == 'retry-after':
+            value = value[0] if isinstance(value, list) else value
+            return int(value)
+
+    return 1
+
+
+def call_slack(method, token=SLACK_BOT_TOKEN, **kwargs):
+    '''
+    Calls a Web API method of the WebClient, e.g. 'chat_postMessage', through the pooled client for token
+    and within the method's rate limit. A call answered with a 429 is retried up to SLACK_MAX_RETRIES
+    times, after its Retry-After.
+    '''
+    client = get_slack_client(token)
+    limiter = get_rate_limiter(token, method)
+    for attempt in range(SLACK_MAX_RETRIES + 1):
+        limiter.wait()
+        try:
+            return getattr(client, method)(**kwargs)
+        except SlackApiError as e:
+            if e.response.status_code != 429 or attempt == SLACK_MAX_RETRIES:
+                raise
+            retry_after = get_retry_after(e.response)
+            print(f"Slack {method} rate limited, retrying in {retry_after}s")
+            limiter.pause(retry_after)
+            if hasattr(kwargs.get('file'), 'seek'):
+                kwargs['file'].seek(0)
+
+
+class SlackDeliveryQueue:
+    '''
+    Collects the messages and file uploads of a run and delivers them per channel on flush().
+    With a title, a channel with more than one item gets a single post of the title, and the items
+    as replies in its thread. A channel's items go out one at a time in the order they were queued,
+    so its thread reads in that order; max_workers channels are delivered concurrently.
+    '''
+    def __init__(self, title=None, token=SLACK_BOT_TOKEN, max_workers=SLACK_UPLOAD_WORKERS):
+        self.title = title
+        self.token = token
+        self.max_workers = max_workers
+        self.channel_items = {}
+
+    def add(self, channel, method, kwargs, on_sent):
+        self.channel_items.setdefault(channel.strip(), []).append((method, kwargs, on_sent))
+
+    def post_message(self, channel, text, on_sent=None):
+        self.add(channel, 'chat_postMessage', {'text': text}, on_sent)
+
+    def upload_file(self, channel, file, on_sent=None, **kwargs):
+        '''
+        kwargs are those of WebClient.files_upload, e.g. filename and initial_comment.
+        on_sent(response) is called once the file is posted.
+        '''
+        self.add(channel, 'files_upload', dict(kwargs, file=file), on_sent)
+
+    def send(self, channel, method, kwargs, on_sent):
+        if method == 'files_upload':
+            response = call_slack(method, self.token, channels=channel, **kwargs)
+        else:
+            response = call_slack(method, self.token, channel=channel, **kwargs)
+        if on_sent is not None:
+            on_sent(response)
+
+        return response
+
+    def flush(self):
+        '''
+        Delivers everything queued. An item that fails doesn't hold back the others;
+        the first error is raised once they have all been tried.
+        '''
+        channel_items, self.channel_items = self.channel_items, {}
+        errors = []
+
+        def deliver(channel, items):
+            thread_ts = None
+            if self.title is not None and len(items) > 1:
+                try:
+                    thread_ts = call_slack('chat_postMessage', self.token, channel=channel, text=self.title)['ts']
+                except Exception as e:
+                    print(f"Error posting {self.title} to {channel}, sending its items unthreaded : {e}")
+
+            for method, kwargs, on_sent in items:
+                if thread_ts is not None:
+                    kwargs = dict(kwargs, thread_ts=thread_ts)
+                try:
+                    self.send(channel, method, kwargs, on_sent)
+                except Exception as e:
+                    print(f"Error sending {method} to {channel} : {e}")
+                    errors.append(e)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            for channel, items in channel_items.items():
+                executor.submit(deliver, channel, items)
+
+        if errors:
+            raise errors[0]
@@ -0,0 +1,242 @@
+import base64
+import os
+import re
+import smtplib
+import socket
+import ssl
+import stat
+import threading
+import uuid
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.base import MIMEBase
+from config import SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_STARTTLS, SMTP_TIMEOUT
+
+
+# read a multiple of 57 bytes at a time, so every chunk encodes to whole 76 character base64 lines
+ATTACHMENT_CHUNK_BYTES = 57 * 1024
+
+_smtp_sessions = {}
+_smtp_sessions_lock = threading.Lock()
+
+
+def get_message_bytes(sender, recipient, subject, message, filepath=None):
+    '''
+    The message as bytes and, with an attachment, the marker that stands in for the attachment's base64.
+    '''
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = ', '.join(recipient.split(','))
+    msg['Subject'] = subject
+    msg.attach(MIMEText(message))
+
+    marker = None
+    if filepath:
+        filename = filepath.split('/')[-1]
+        marker = uuid.uuid4().hex
+        p = MIMEBase('application', 'octet-stream')
+        p.set_payload(marker)
+        p['Content-Transfer-Encoding'] = 'base64'
+        p.add_header('Content-Disposition', "attachment; filename= %s" % filename)
+        msg.attach(p)
+
+    return msg.as_bytes(), marker
+
+
+def open_attachment(filepath):
+    '''
+    Opens the attachment, so a missing or unreadable file fails before anything is sent.
+    '''
+    f = open(filepath, 'rb')
+    if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        f.close()
+        raise OSError(f"{filepath} is not a regular file")
+
+    return f
+
+
+def iter_message_chunks(message_bytes, marker=None, attachment=None):
+    '''
+    Yields the message, with the open attachment read from its start and base64 encoded a chunk at a time in place of marker.
+    '''
+    if marker is None:
+        yield message_bytes
+        return
+
+    head, tail = message_bytes.split(marker.encode())
+    yield head
+    attachment.seek(0)
+    for chunk in iter(lambda: attachment.read(ATTACHMENT_CHUNK_BYTES), b''):
+        yield base64.encodebytes(chunk)
+    yield tail
+
+
+def quote_chunk(chunk):
+    # CRLF line endings, and a leading '.' doubled, as smtplib does for a whole message. Every chunk ends a line
+    chunk = re.sub(br'\r\n|\n|\r', b'\r\n', chunk)
+    return re.sub(br'(?m)^\.', b'..', chunk)
+
+
+class SmtpSession:
+    '''
+    One SMTP connection, logged in once and kept open for every message of a run.
+    Messages are sent one at a time; when the connection has dropped (or the server closes it with a 421)
+    it is reopened and the message sent again, once. Any other error is raised without a resend.
+    '''
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, username=SMTP_USERNAME, password=SMTP_PASSWORD, starttls=SMTP_STARTTLS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.server = None
+        self._lock = threading.Lock()
+        self.stats = {'connections': 0, 'messages': 0, 'reconnects': 0}
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        try:
+            server.ehlo()
+            if self.starttls:
+                server.starttls(context=ssl.create_default_context())
+                server.ehlo()
+            if server.has_extn('auth'):
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+
+        self.server = server
+        self.stats['connections'] += 1
+
+    def close(self):
+        with self._lock:
+            self.disconnect()
+
+    def disconnect(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
+
+    def send_chunks(self, sender, recipients, chunks):
+        '''
+        Returns the refused recipients, as smtplib's sendmail does; the message still goes to the others.
+        '''
+        server = self.server
+        code, resp = server.mail(sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+        refused = {}
+        for recipient in recipients:
+            code, resp = server.rcpt(recipient)
+            if code == 421:
+                raise smtplib.SMTPResponseException(code, resp)
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = server.docmd('data')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        ends_line = True
+        for chunk in chunks:
+            if chunk:
+                chunk = quote_chunk(chunk)
+                server.send(chunk)
+                ends_line = chunk.endswith(b'\r\n')
+        server.send(b'.\r\n' if ends_line else b'\r\n.\r\n')
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+        return refused
+
+    def send(self, sender, recipients, message_bytes, marker=None, filepath=None):
+        '''
+        Sends message_bytes from get_message_bytes, with the attachment at filepath in place of marker.
+        Returns the refused recipients as {address: (code, response)}; SMTPRecipientsRefused is raised
+        only when every recipient is refused.
+        '''
+        attachment = open_attachment(filepath) if marker is not None else None
+        try:
+            with self._lock:
+                return self.send_message(sender, recipients, message_bytes, marker, attachment)
+        finally:
+            if attachment is not None:
+                attachment.close()
+
+    def send_message(self, sender, recipients, message_bytes, marker, attachment):
+        for attempt in range(2):
+            if self.server is None:
+                self.connect()
+            try:
+                refused = self.send_chunks(sender, recipients, iter_message_chunks(message_bytes, marker, attachment))
+                self.stats['messages'] += 1
+                return refused
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code != 421 or attempt == 1:
+                    self.reset()
+                    raise
+                error = e
+            except smtplib.SMTPRecipientsRefused:
+                self.reset()
+                raise
+            except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout) as e:
+                if attempt == 1:
+                    self.drop()
+                    raise
+                error = e
+            except Exception:
+                # the connection may be left partway through a message
+                self.drop()
+                raise
+
+            print(f"SMTP connection to {self.host} lost, reconnecting : {error}")
+            self.drop()
+            self.stats['reconnects'] += 1
+
+    def drop(self):
+        self.server.close()
+        self.server = None
+
+    def reset(self):
+        try:
+            self.server.rset()
+        except Exception:
+            self.server.close()
+            self.server = None
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+def get_smtp_session(host=SMTP_HOST, port=SMTP_PORT, username=SMTP_USERNAME, password=SMTP_PASSWORD, starttls=SMTP_STARTTLS):
+    '''
+    Returns the pooled session for host, port and username, creating it on first use.
+    It connects on its first message and stays open until close_smtp_sessions().
+    '''
+    with _smtp_sessions_lock:
+        session = _smtp_sessions.get((host, port, username))
+        if session is None:
+            session = SmtpSession(host, port, username, password, starttls)
+            _smtp_sessions[(host, port, username)] = session
+
+    return session
+
+
+def close_smtp_sessions():
+    with _smtp_sessions_lock:
+        sessions = list(_smtp_sessions.values())
+
+    for session in sessions:
+        session.close()
+        stats = session.get_stats()
+        if stats['connections'] > 0:
+            print(f"SMTP session {session.host} - connections {stats['connections']} messages {stats['messages']} "
+                  f"reconnects {stats['reconnects']}")